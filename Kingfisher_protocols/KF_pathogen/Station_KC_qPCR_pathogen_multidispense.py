@@ -32,11 +32,12 @@ air_gap_sample = 2
 run_id = $run_id
 
 # Tune variables
-size_transfer = 5  # Number of wells the distribute function will fill
 volume_mmix = 20  # Volume of transfered master mix
 volume_sample = 5  # Volume of the sample
-volume_mmix_available = (NUM_SAMPLES * 1.1 * volume_mmix)  # Total volume of first screwcap
-extra_dispensal = 10  # Extra volume for master mix in each distribute transfer
+cv_target = 0.05  # Target CV of the master mix volume dispensed in each well
+min_extra_dispensal = 5  # Minimum extra volume of each distribute transfer (blown back to the tube)
+air_gap_mmix = 20  # Air gap between the dispensals of a distribute transfer
+max_volume_screwcap = 1800  # Maximum master mix volume to fill in a 2 ml screwcap
 diameter_screwcap = 8.25  # Diameter of the screwcap
 temperature = 25  # Temperature of temp module
 volume_cone = 50  # Volume in ul that fit in the screwcap cone
@@ -64,7 +65,7 @@ def run(ctx: protocol_api.ProtocolContext):
             STEPS[s]['wait_time'] = 0
 
     #Folder and file_path for log time
-    folder_path = '/var/lib/jupyter/notebooks/'+run_id'
+    folder_path = '/var/lib/jupyter/notebooks/'+run_id
     if not ctx.is_simulating():
         if not os.path.isdir(folder_path):
             os.mkdir(folder_path)
@@ -95,8 +96,8 @@ def run(ctx: protocol_api.ProtocolContext):
                       rinse = False,
                       flow_rate_aspirate = 1,
                       flow_rate_dispense = 1,
-                      reagent_reservoir_volume = volume_mmix_available,
-                      num_wells = 2, #change with num samples
+                      reagent_reservoir_volume = NUM_SAMPLES * volume_mmix, # set by the plan
+                      num_wells = 1, # set by the plan
                       delay = 0,
                       h_cono = h_cone,
                       v_fondo = volume_cone  # V cono
@@ -120,24 +121,58 @@ def run(ctx: protocol_api.ProtocolContext):
     # Custom functions
 
 
-    def divide_destinations(l, n):
-        # Divide the list of destinations in size n lists.
-        for i in range(0, len(l), n):
-            yield l[i:i + n]
-
-    def distribute_custom(pipette, volume, src, dest, waste_pool, pickup_height, extra_dispensal, disp_height=0):
+    def plan_mmix_dispenses(wells, volume, max_volume, air_gap, cv_target,
+                            min_extra, tube_volume, dead_volume):
+        '''
+        Chunks of [wells] for distribute_custom with the fewest aspirations.
+        Each aspiration takes the volume of its wells plus an extra volume,
+        blown back to the tube at the end, of three times the [cv_target] of
+        that volume (at least [min_extra]); all of it plus the [air_gap] must
+        fit in [max_volume] (pipette or tip, the smallest). The wells are
+        spread evenly among the aspirations and the chunks are packed in
+        screwcaps of [tube_volume] that keep [dead_volume] in the cone.
+        Returns the chunks, the extra volume of each chunk, the tube of each
+        chunk and the volume to fill in each tube.
+        '''
+        def extra(n):
+            return max(min_extra, 3 * cv_target * n * volume)
+        per_aspiration = 1
+        while (per_aspiration < len(wells) and (per_aspiration + 1) * volume
+               + extra(per_aspiration + 1) + air_gap <= max_volume):
+            per_aspiration += 1
+        num_aspirations = math.ceil(len(wells) / per_aspiration)
+        bounds = [round(i * len(wells) / num_aspirations) for i in range(num_aspirations + 1)]
+        chunks = [wells[a:b] for a, b in zip(bounds, bounds[1:])]
+        extras = [extra(len(chunk)) for chunk in chunks]
+        tubes = []
+        liquid = [] # dispensed from each tube
+        borrowed = [] # largest extra volume of each tube
+        for chunk, extra_vol in zip(chunks, extras):
+            need = len(chunk) * volume
+            if (not liquid or liquid[-1] + need + max(borrowed[-1], extra_vol)
+                    + dead_volume > tube_volume):
+                liquid.append(0)
+                borrowed.append(0)
+            liquid[-1] += need
+            borrowed[-1] = max(borrowed[-1], extra_vol)
+            tubes.append(len(liquid) - 1)
+        fill = [l + b + dead_volume for l, b in zip(liquid, borrowed)]
+        return chunks, extras, tubes, fill
+
+    def distribute_custom(pipette, volume, src, dest, waste_pool, pickup_height, extra_dispensal,
+                          disp_height = 0, air_gap = 20):
         # Custom distribute function that allows for blow_out in different location and adjustement of touch_tip
         pipette.aspirate((len(dest) * volume) +
                          extra_dispensal, src.bottom(pickup_height))
         pipette.touch_tip(speed=20, v_offset=-5)
         pipette.move_to(src.top(z=5))
-        pipette.aspirate(20)  # air gap
+        pipette.aspirate(air_gap)  # air gap
         for d in dest:
-            pipette.dispense(20, d.top())
+            pipette.dispense(air_gap, d.top())
             drop = d.top(z = disp_height)
             pipette.dispense(volume, drop)
             pipette.move_to(d.top(z=5))
-            pipette.aspirate(20)  # air gap
+            pipette.aspirate(air_gap)  # air gap
         try:
             pipette.blow_out(waste_pool.wells()[0].bottom(pickup_height + 3))
         except:
@@ -266,17 +301,11 @@ def run(ctx: protocol_api.ProtocolContext):
     ]
 
     ################################################################################
-    # Declare which reagents are in each reservoir as well as deepwell and elution plate
-    MMIX.reagent_reservoir = tuberack.rows()[0][:MMIX.num_wells] # 1 row, 2 columns (first ones)
-    ctx.comment('Wells in: '+ str(tuberack.rows()[0][:MMIX.num_wells]) + ' element: '+str(MMIX.reagent_reservoir[MMIX.col]))
     # setup up sample sources and destinations
     samples = source_plate.wells()[:NUM_SAMPLES]
     samples_multi = source_plate.rows()[0][:num_cols]
     pcr_wells = qpcr_plate.wells()[:NUM_SAMPLES]
     pcr_wells_multi = qpcr_plate.rows()[0][:num_cols]
-    # Divide destination wells in small groups for P300 pipette
-    dests = list(divide_destinations(pcr_wells, size_transfer))
-
 
     # pipettes
     m20 = ctx.load_instrument(
@@ -284,6 +313,21 @@ def run(ctx: protocol_api.ProtocolContext):
     p300 = ctx.load_instrument(
         'p300_single_gen2', mount='left', tip_racks=tips200)
 
+    # Divide destination wells in groups for the P300 pipette and plan the
+    # master mix screwcaps they need
+    [dests, extra_dispensals, dest_tubes, mmix_fill] = plan_mmix_dispenses(
+        pcr_wells, volume_mmix, min(p300.max_volume, tips200[0].wells()[0].max_volume),
+        air_gap_mmix, cv_target, min_extra_dispensal, max_volume_screwcap, volume_cone)
+    MMIX.num_wells = len(mmix_fill)
+    MMIX.reagent_reservoir = tuberack.rows()[0][:MMIX.num_wells] # 1 row, first screwcaps
+    MMIX.vol_well = mmix_fill[0]
+    ctx.comment('Master mix: ' + str(len(dests)) + ' aspirations of up to ' +
+                str(max(len(dest) for dest in dests)) + ' wells, ' +
+                str(NUM_SAMPLES * volume_mmix) + '\u03BCl dispensed')
+    for tube, fill in zip(MMIX.reagent_reservoir, mmix_fill):
+        ctx.comment('Fill the 2 ml screwcap ' + tube.well_name + ' with ' +
+                    str(math.ceil(fill)) + '\u03BCl of master mix')
+
     # used tip counter and set maximum tips available
     tip_track = {
         'counts': {p300: 0,
@@ -299,13 +343,18 @@ def run(ctx: protocol_api.ProtocolContext):
         p300.pick_up_tip()
 
         used_vol=[]
-        for dest in dests:
+        for dest, extra_dispensal, tube in zip(dests, extra_dispensals, dest_tubes):
+            if tube != MMIX.col:
+                MMIX.unused.append(MMIX.vol_well)
+                MMIX.col = tube
+                MMIX.vol_well = mmix_fill[tube]
             aspirate_volume=volume_mmix * len(dest) + extra_dispensal
             [pickup_height,col_change]=calc_height(MMIX, area_section_screwcap, aspirate_volume)
             used_vol_temp = distribute_custom(
             p300, volume = volume_mmix, src = MMIX.reagent_reservoir[MMIX.col], dest = dest,
             waste_pool = MMIX.reagent_reservoir[MMIX.col], pickup_height = pickup_height,
-            extra_dispensal = extra_dispensal)
+            extra_dispensal = extra_dispensal, air_gap = air_gap_mmix)
+            MMIX.vol_well += extra_dispensal # blown back to the tube
             used_vol.append(used_vol_temp)
         p300.drop_tip()
         tip_track['counts'][p300]+=1
@@ -374,10 +423,10 @@ def run(ctx: protocol_api.ProtocolContext):
         total_needed_volume = total_used_vol
         ctx.comment('Total Master Mix used volume is: ' + str(total_used_vol) + '\u03BCl.')
         ctx.comment('Needed Master Mix volume is ' +
-                    str(total_needed_volume + extra_dispensal*len(dests)) +'\u03BCl')
+                    str(math.ceil(np.sum(mmix_fill))) + '\u03BCl in ' + str(len(mmix_fill)) + ' tubes')
         ctx.comment('Used Master Mix volumes per run are: ' + str(used_vol) + '\u03BCl.')
         ctx.comment('Master Mix Volume remaining in tubes is: ' +
-                    format(np.sum(MMIX.unused)+extra_dispensal*len(dests)+MMIX.vol_well) + '\u03BCl.')
+                    format(np.sum(MMIX.unused)+MMIX.vol_well) + '\u03BCl.')
         ctx.comment('200 ul Used tips in total: ' + str(tip_track['counts'][p300]))
         ctx.comment('200 ul Used racks in total: ' + str(tip_track['counts'][p300] / 96))
 
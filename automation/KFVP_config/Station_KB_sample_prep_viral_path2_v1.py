@@ -27,6 +27,8 @@ metadata = {
 #Defined variables
 ##################
 NUM_SAMPLES = $num_samples #last sample (PC), has been removed (done manually)
+LOG_LEVEL = $log_level # Comments in the run log: 'STEP', 'INFO' or 'DEBUG'
+TRACE = False # Record every transfer, mix and tip pick up in the _trace.bin of the run
 run_id=$run_id
 
 air_gap_vol = 15
@@ -34,6 +36,8 @@ MS_vol = 10
 air_gap_vol_MS = 2
 height_MS = -35
 temperature = 10
+cold_budget = 30  # Minutes the MS2 can spend out of the cold chain (warned in the run log)
+beads_premix_rounds = 3  # Bead premixes (10 rounds each) while the tempdeck cools (at most)
 
 x_offset = [0, 0]
 
@@ -75,26 +79,7 @@ def run(ctx: protocol_api.ProtocolContext):
             os.mkdir(folder_path)
         file_path = folder_path + '/Station_KB_sample_prep_viral_path2_time_log.txt'
 
-    # Define Reagents as objects with their properties
-    class Reagent:
-        def __init__(self, name, flow_rate_aspirate, flow_rate_dispense, rinse,
-                     reagent_reservoir_volume, delay, num_wells, h_cono, v_fondo,
-                      tip_recycling = 'none'):
-            self.name = name
-            self.flow_rate_aspirate = flow_rate_aspirate
-            self.flow_rate_dispense = flow_rate_dispense
-            self.rinse = bool(rinse)
-            self.reagent_reservoir_volume = reagent_reservoir_volume
-            self.delay = delay
-            self.num_wells = num_wells
-            self.col = 0
-            self.vol_well = 0
-            self.h_cono = h_cono
-            self.v_cono = v_fondo
-            self.unused=[]
-            self.tip_recycling = tip_recycling
-            self.vol_well_original = reagent_reservoir_volume / num_wells
-
+    $runtime
 
     # Reagents and their characteristics
     Sample = Reagent(name='Sample',
@@ -132,95 +117,11 @@ def run(ctx: protocol_api.ProtocolContext):
     Beads.vol_well = Beads.vol_well_original
     MS.vol_well = MS.reagent_reservoir_volume
 
-    def move_vol_multichannel(pipet, reagent, source, dest, vol, air_gap_vol, x_offset,
-                       pickup_height, rinse, disp_height, blow_out, touch_tip):
-        '''
-        x_offset: list with two values. x_offset in source and x_offset in destination i.e. [-1,1]
-        pickup_height: height from bottom where volume
-        rinse: if True it will do 2 rounds of aspirate and dispense before the tranfer
-        disp_height: dispense height; by default it's close to the top (z=-2), but in case it is needed it can be lowered
-        blow_out, touch_tip: if True they will be done after dispensing
-        '''
-        # Rinse before aspirating
-        if rinse == True:
-            custom_mix(pipet, reagent, location = source, vol = vol,
-                       rounds = 2, blow_out = True, mix_height = 0,
-                       x_offset = x_offset)
-        # SOURCE
-        s = source.bottom(pickup_height).move(Point(x = x_offset[0]))
-        pipet.aspirate(vol, s, rate = reagent.flow_rate_aspirate)  # aspirate liquid
-        if air_gap_vol != 0:  # If there is air_gap_vol, switch pipette to slow speed
-            pipet.aspirate(air_gap_vol, source.top(z = -2),
-                           rate = reagent.flow_rate_aspirate)  # air gap
-        # GO TO DESTINATION
-        drop = dest.top(z = disp_height).move(Point(x = x_offset[1]))
-        pipet.dispense(vol + air_gap_vol, drop,
-                       rate = reagent.flow_rate_dispense)  # dispense all
-        ctx.delay(seconds = reagent.delay) # pause for x seconds depending on reagent
-        if blow_out == True:
-            pipet.blow_out(dest.top(z = -2))
-        if touch_tip == True:
-            pipet.touch_tip(speed = 20, v_offset = -5)
-
-
-    def custom_mix(pipet, reagent, location, vol, rounds, blow_out, mix_height,
-    x_offset, source_height = 3):
-        '''
-        Function for mixing a given [vol] in the same [location] a x number of [rounds].
-        blow_out: Blow out optional [True,False]
-        x_offset = [source, destination]
-        source_height: height from bottom to aspirate
-        mix_height: height from bottom to dispense
-        '''
-        if mix_height == 0:
-            mix_height = 3
-        pipet.aspirate(1, location=location.bottom(
-            z=source_height).move(Point(x=x_offset[0])), rate=reagent.flow_rate_aspirate)
-        for _ in range(rounds):
-            pipet.aspirate(vol, location=location.bottom(
-                z=source_height).move(Point(x=x_offset[0])), rate=reagent.flow_rate_aspirate)
-            pipet.dispense(vol, location=location.bottom(
-                z=mix_height).move(Point(x=x_offset[1])), rate=reagent.flow_rate_dispense)
-        pipet.dispense(1, location=location.bottom(
-            z=mix_height).move(Point(x=x_offset[1])), rate=reagent.flow_rate_dispense)
-        if blow_out == True:
-            pipet.blow_out(location.top(z=-2))  # Blow out
-
-    def calc_height(reagent, cross_section_area, aspirate_volume, min_height = 0.5):
-        nonlocal ctx
-        ctx.comment('Remaining volume ' + str(reagent.vol_well) +
-                    '< needed volume ' + str(aspirate_volume) + '?')
-        if reagent.vol_well < aspirate_volume:
-            reagent.unused.append(reagent.vol_well)
-            ctx.comment('Next column should be picked')
-            ctx.comment('Previous to change: ' + str(reagent.col))
-            # column selector position; intialize to required number
-            reagent.col = reagent.col + 1
-            ctx.comment(str('After change: ' + str(reagent.col)))
-            reagent.vol_well = reagent.vol_well_original
-            ctx.comment('New volume:' + str(reagent.vol_well))
-            height = (reagent.vol_well - aspirate_volume - reagent.v_cono) / cross_section_area
-                    #- reagent.h_cono
-            reagent.vol_well = reagent.vol_well - aspirate_volume
-            ctx.comment('Remaining volume:' + str(reagent.vol_well))
-            if height < min_height:
-                height = min_height
-            col_change = True
-        else:
-            height = (reagent.vol_well - aspirate_volume - reagent.v_cono) / cross_section_area #- reagent.h_cono
-            reagent.vol_well = reagent.vol_well - aspirate_volume
-            ctx.comment('Calculated height is ' + str(height))
-            if height < min_height:
-                height = min_height
-            ctx.comment('Used height is ' + str(height))
-            col_change = False
-        return height, col_change
-
-
-    def divide_destinations(l, n):
-        # Divide the list of destinations in size n lists.
-        for i in range(0, len(l), n):
-            yield l[i:i + n]
+    ############################################
+    # tempdeck first: it cools down while the rest is loaded and planned
+    tempdeck = ctx.load_module('tempdeck', '4')
+    cold_chain = ColdChain(tempdeck, temperature)
+    cold_chain.track(MS, on_module = True, budget = cold_budget)
 
     ####################################
     # load labware and modules
@@ -234,11 +135,6 @@ def run(ctx: protocol_api.ProtocolContext):
         'kf_96_wellplate_2400ul', '1',
         'KF 96 Well 2400ul elution plate')
 
-    ############################################
-    # tempdeck
-    tempdeck = ctx.load_module('tempdeck', '4')
-    tempdeck.set_temperature(temperature)
-
     ##################################
     # MS plate -  plate with a column containing the internal control MS
     ms_plate = tempdeck.load_labware(
@@ -278,14 +174,32 @@ def run(ctx: protocol_api.ProtocolContext):
         'maxes': {m300: len(tips200) * 96, m20: len(tips20) * 96}
     }
 
+    # Tips of each STEP: MS is dispensed into the samples (fresh tip per
+    # column), the beads go to the top of the wells with the same tip
+    tip_plan = TipPlan()
+    ms_tips = tip_plan.add(1, m20, [(MS, True)] * num_cols)
+    tip_plan.add(2, m300, [(Beads, False)] * num_cols * 4)
+    load_tipracks(m20, tip_plan)
+    load_tipracks(m300, tip_plan)
+
     # Divide destination wells in small groups for P300 pipette
     # Declare which reagents are in each reservoir as well as deepwell and elution plate
     #destinations = list(divide_destinations(sample_plate.wells()[:NUM_SAMPLES], size_transfer))
     Beads.reagent_reservoir = reagent_res.rows()[0][:Beads.num_wells]  # 1 row, 4 columns (first ones)
+    Beads.height_model = height_model(reagent_res, bottom_height = Beads.h_cono,
+                                      bottom_volume = Beads.v_cono)
     work_destinations = sample_plate.wells()[:NUM_SAMPLES]
     work_destinations_cols = sample_plate.rows()[0][:num_cols]
     ms_origins = ms_plate.rows()[0][0]  # 1 row, 1 columns
 
+    def premix_beads():
+        # Work for the m300 while the tempdeck cools: resuspend the beads,
+        # its tip is kept for the transfer of STEP 2
+        if not m300.hw_pipette['has_tip']:
+            pick_up(m300)
+        custom_mix(m300, Beads, Beads.reagent_reservoir[Beads.col], vol=180,
+                   rounds=10, blow_out=True, mix_height=0, x_offset = x_offset)
+
     ############################################################################
     # STEP 1: Transfer MS
     ############################################################################
@@ -293,23 +207,31 @@ def run(ctx: protocol_api.ProtocolContext):
     STEP += 1
     if STEPS[STEP]['Execute'] == True:
         start = datetime.now()
-        ctx.comment('ms_wells')
+        comment('DEBUG', 'ms_wells')
+        refill_tips(m20, tip_plan.tips(m20, STEP))
+        # The MS2 is on the cold plate
+        STEPS[STEP]['wait_time'] += round(cold_chain.ready(premix_beads, beads_premix_rounds))
+        if m300.hw_pipette['has_tip'] and not any(STEPS[s]['Execute'] for s in STEPS if s > STEP):
+            # No beads STEP keeps the tip of the premix
+            m300.drop_tip()
+            tip_track['counts'][m300] += 8
         #Loop over defined wells
-        for d in work_destinations_cols:
-            m20.pick_up_tip()
+        for d, new_tip in zip(work_destinations_cols, ms_tips):
+            change_tip(m20, new_tip)
             #Source samples
             move_vol_multichannel(m20, reagent = MS, source = ms_origins, dest = d,
             vol = MS_vol, air_gap_vol = air_gap_vol_MS, x_offset = x_offset,
                    pickup_height = 1, disp_height = -35, rinse = False,
                    blow_out=True, touch_tip=True)
-            m20.drop_tip()
-            tip_track['counts'][m20]+=8
+        m20.drop_tip()
+        tip_track['counts'][m20]+=8
 
         end = datetime.now()
         time_taken = (end - start)
         ctx.comment('Step ' + str(STEP) + ': ' +
                     STEPS[STEP]['description'] + ' took ' + str(time_taken))
         STEPS[STEP]['Time:'] = str(time_taken)
+        cold_chain.step(STEP)
 
     ############################################################################
     # STEP 2: TRANSFER BEADS
@@ -319,7 +241,8 @@ def run(ctx: protocol_api.ProtocolContext):
         # Transfer parameters
         start = datetime.now()
         ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'])
-        ctx.comment('###############################################')
+        comment('DEBUG', '###############################################')
+        refill_tips(m300, tip_plan.tips(m300, STEP))
         beads_transfer_vol = [150, 150, 150, 100]  # 4 rounds of different volumes
         rinse = True
         for i in range(num_cols):
@@ -330,14 +253,12 @@ def run(ctx: protocol_api.ProtocolContext):
                 [pickup_height, change_col] = calc_height(
                     Beads, multi_well_rack_area, transfer_vol * 8, min_height = 1)
                 if change_col == True:  # If we switch column because there is not enough volume left in current reservoir column we mix new column
-                    ctx.comment(
-                        'Mixing new reservoir column: ' + str(Beads.col))
+                    comment('INFO', 'Mixing new reservoir column: {}', Beads.col)
                     custom_mix(m300, Beads, Beads.reagent_reservoir[Beads.col],
                                vol=170, rounds=10, blow_out=False, mix_height=0,
                                x_offset = x_offset)
-                ctx.comment(
-                    'Aspirate from reservoir column: ' + str(Beads.col))
-                ctx.comment('Pickup height is ' + str(pickup_height))
+                comment('DEBUG', 'Aspirate from reservoir column: {}', Beads.col)
+                comment('DEBUG', 'Pickup height is {}', pickup_height)
                 if j != 0:
                     rinse = False
                 move_vol_multichannel(m300, reagent=Beads, source=Beads.reagent_reservoir[Beads.col],
@@ -353,17 +274,21 @@ def run(ctx: protocol_api.ProtocolContext):
         ctx.comment('Step ' + str(STEP) + ': ' +
                     STEPS[STEP]['description'] + ' took ' + str(time_taken))
         STEPS[STEP]['Time:'] = str(time_taken)
+        cold_chain.step(STEP)
 
-    # Export the time log to a tsv file
+    # Export the time log to a tsv file (and the last records of the trace)
+    tracer.flush()
     if not ctx.is_simulating():
         with open(file_path, 'w') as f:
-            f.write('STEP\texecution\tdescription\twait_time\texecution_time\n')
+            f.write('STEP\texecution\tdescription\twait_time\texecution_time\tsaved_delay\n')
             for key in STEPS.keys():
-                row = str(key)
-                for key2 in STEPS[key].keys():
-                    row += '\t' + format(STEPS[key][key2])
-                f.write(row + '\n')
+                # Fixed columns, a skipped STEP has no wait or execution time
+                row = [key, STEPS[key]['Execute'], STEPS[key]['description'],
+                       STEPS[key].get('wait_time', ''), STEPS[key].get('Time:', ''),
+                       round(saved_delays.get(key, 0), 1)]
+                f.write('\t'.join(format(value) for value in row) + '\n')
         f.close()
+        cold_chain.write(run_file('_cold_chain.txt'))
 
     ############################################################################
     # Light flash end of program
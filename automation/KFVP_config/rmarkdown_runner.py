@@ -1,8 +1,8 @@
 #!/usr/bin/env python3
-import subprocess
 import os
-import time
-import shutil
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from results_watcher import ResultsWatcher, RenderPool
 
 # set path to watch
 target_dir="/run/user/1003/gvfs/smb-share:server=opn.cdb.nas.csc.es,share=opentrons/RUNS/"
@@ -11,34 +11,13 @@ target_dir="/run/user/1003/gvfs/smb-share:server=opn.cdb.nas.csc.es,share=opentr
 # set path to the script sh
 script_path="/home/jl/Documentos/code/covid19clinic/automation/KFVP_config/rmarkdown_runner.sh"
 
-def generate_list_folders(target_dir):
-    dirs = os.listdir(target_dir)
-    dirs_return = dirs.copy()
-    for d in dirs:
-        for file in os.listdir(target_dir + d + '/results/'):
-            if file.endswith('.html'):
-                dirs_return.remove(d)
-                break
-    return dirs_return
+# index of the rendered runs, local so it doesn't depend on the share
+index_path=os.path.join(os.path.expanduser('~'), '.rmarkdown_runner_KFVP.json')
 
-watching = []
-while True:
-    runs = generate_list_folders(target_dir)
-    for run in runs:
-        if run not in watching:
-            watching.append(run)
-            print('New folder detected: ' + run)
-            #os.system(script_path + ' '+ run + '&')
-    for run in watching:
-        if os.path.isdir(target_dir + run):
-            for file in os.listdir(target_dir + run + '/results/'):
-                if file.endswith('.csv'):
-                    print('Executing rmarkdown for ' + run)
-                    os.system(script_path + ' ' + run)
-                    watching.remove(run)
-                    time.sleep(30)
-                    break
-        else:
-            watching.remove(run)
-            print('Folder removed: ' + run)
-    time.sleep(30)
+# reports rendered at the same time and maximum time of each one (seconds)
+workers=3
+timeout=1800
+
+if __name__ == '__main__':
+    pool=RenderPool(lambda run: [script_path, run], target_dir, workers, timeout)
+    ResultsWatcher(target_dir, pool, index_path).run_forever()
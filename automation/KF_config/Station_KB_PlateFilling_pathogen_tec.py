@@ -26,9 +26,13 @@ metadata = {
 #Defined variables
 ##################
 NUM_SAMPLES = $num_samples #last sample (PC), has been removed (done manually)
+LOG_LEVEL = $log_level # Comments in the run log: 'STEP', 'INFO' or 'DEBUG'
+TRACE = False # Record every transfer, mix and tip pick up in the _trace.bin of the run
 
 air_gap_vol = 15
 air_gap_vol_elutionbuffer = 5
+conditioning_vol = 10 # Extra volume per aspiration when dispensing to several columns
+elution_dead_vol = 300 # Elution Buffer left in the reservoir column, not aspirated
 run_id = $run_id
 
 x_offset = [0,0]
@@ -58,25 +62,7 @@ def run(ctx: protocol_api.ProtocolContext):
             os.mkdir(folder_path)
         file_path = folder_path + '/KB_PlateFilling_pathogen_time_log.txt'
 
-    # Define Reagents as objects with their properties
-    class Reagent:
-        def __init__(self, name, flow_rate_aspirate, flow_rate_dispense, rinse,
-                     reagent_reservoir_volume, delay, num_wells, h_cono, v_fondo,
-                      tip_recycling = 'none'):
-            self.name = name
-            self.flow_rate_aspirate = flow_rate_aspirate
-            self.flow_rate_dispense = flow_rate_dispense
-            self.rinse = bool(rinse)
-            self.reagent_reservoir_volume = reagent_reservoir_volume
-            self.delay = delay #Delay of reagent in dispense
-            self.num_wells = num_wells
-            self.col = 0
-            self.vol_well = 0
-            self.h_cono = h_cono
-            self.v_cono = v_fondo
-            self.unused=[]
-            self.tip_recycling = tip_recycling
-            self.vol_well_original = reagent_reservoir_volume / num_wells
+    $runtime
 
     # Reagents and their characteristics
     WashBuffer1 = Reagent(name='Wash Buffer 1',
@@ -84,6 +70,7 @@ def run(ctx: protocol_api.ProtocolContext):
                           flow_rate_dispense=1,
                           rinse=True,
                           delay=2,
+                          delay_policy='overlap', # settles on the way back to the reservoir
                           reagent_reservoir_volume=100000,
                           num_wells=1,
                           h_cono=0,
@@ -94,6 +81,7 @@ def run(ctx: protocol_api.ProtocolContext):
                           flow_rate_dispense=1,
                           rinse=True,
                           delay=2,
+                          delay_policy='overlap', # settles on the way back to the reservoir
                           reagent_reservoir_volume=100000,
                           num_wells=1,
                           h_cono=0,
@@ -104,124 +92,19 @@ def run(ctx: protocol_api.ProtocolContext):
                             flow_rate_dispense=1,
                             rinse=False,
                             delay=0,
-                            reagent_reservoir_volume=50*NUM_SAMPLES,
+                            # Full columns, the conditioning volume of the
+                            # last aspiration and the dead volume
+                            reagent_reservoir_volume=50*8*num_cols + conditioning_vol*8 + elution_dead_vol,
                             num_wells=1,
                             h_cono=1.95,
-                            v_fondo=695)  # Prismatic
+                            v_fondo=695,  # Prismatic
+                            dead_vol=elution_dead_vol)
 
     WashBuffer1.vol_well = WashBuffer1.vol_well_original
     WashBuffer2.vol_well = WashBuffer2.vol_well_original
     ElutionBuffer.vol_well = ElutionBuffer.vol_well_original
-
-    ##################
-    # Custom functions
-    def move_vol_multichannel(pipet, reagent, source, dest, vol, air_gap_vol, x_offset,
-                       pickup_height, rinse, disp_height, blow_out, touch_tip):
-        '''
-        x_offset: list with two values. x_offset in source and x_offset in destination i.e. [-1,1]
-        pickup_height: height from bottom where volume
-        rinse: if True it will do 2 rounds of aspirate and dispense before the tranfer
-        disp_height: dispense height; by default it's close to the top (z=-2), but in case it is needed it can be lowered
-        blow_out, touch_tip: if True they will be done after dispensing
-        '''
-        # Rinse before aspirating
-        if rinse == True:
-            custom_mix(pipet, reagent, location = source, vol = vol,
-                       rounds = 2, blow_out = True, mix_height = 0,
-                       x_offset = x_offset)
-        # SOURCE
-        s = source.bottom(pickup_height).move(Point(x = x_offset[0]))
-        pipet.aspirate(vol, s, rate = reagent.flow_rate_aspirate)  # aspirate liquid
-        if air_gap_vol != 0:  # If there is air_gap_vol, switch pipette to slow speed
-            pipet.aspirate(air_gap_vol, source.top(z = -2),
-                           rate = reagent.flow_rate_aspirate)  # air gap
-        # GO TO DESTINATION
-        drop = dest.top(z = disp_height).move(Point(x = x_offset[1]))
-        pipet.dispense(vol + air_gap_vol, drop,
-                       rate = reagent.flow_rate_dispense)  # dispense all
-        ctx.delay(seconds = reagent.delay) # pause for x seconds depending on reagent
-        if blow_out == True:
-            pipet.blow_out(dest.top(z = -2))
-        if touch_tip == True:
-            pipet.touch_tip(radius=0.9, speed = 20, v_offset = -5) #radius here is 0.9
-
-
-    def custom_mix(pipet, reagent, location, vol, rounds, blow_out, mix_height,
-    x_offset, source_height = 3):
-        '''
-        Function for mixing a given [vol] in the same [location] a x number of [rounds].
-        blow_out: Blow out optional [True,False]
-        x_offset = [source, destination]
-        source_height: height from bottom to aspirate
-        mix_height: height from bottom to dispense
-        '''
-        if mix_height == 0:
-            mix_height = 3
-        pipet.aspirate(1, location=location.bottom(
-            z=source_height).move(Point(x=x_offset[0])), rate=reagent.flow_rate_aspirate)
-        for _ in range(rounds):
-            pipet.aspirate(vol, location=location.bottom(
-                z=source_height).move(Point(x=x_offset[0])), rate=reagent.flow_rate_aspirate)
-            pipet.dispense(vol, location=location.bottom(
-                z=mix_height).move(Point(x=x_offset[1])), rate=reagent.flow_rate_dispense)
-        pipet.dispense(1, location=location.bottom(
-            z=mix_height).move(Point(x=x_offset[1])), rate=reagent.flow_rate_dispense)
-        if blow_out == True:
-            pipet.blow_out(location.top(z=-2))  # Blow out
-
-    def calc_height(reagent, cross_section_area, aspirate_volume, min_height = 0.5):
-        nonlocal ctx
-        ctx.comment('Remaining volume ' + str(reagent.vol_well) +
-                    '< needed volume ' + str(aspirate_volume) + '?')
-        if reagent.vol_well < aspirate_volume:
-            reagent.unused.append(reagent.vol_well)
-            ctx.comment('Next column should be picked')
-            ctx.comment('Previous to change: ' + str(reagent.col))
-            # column selector position; intialize to required number
-            reagent.col = reagent.col + 1
-            ctx.comment(str('After change: ' + str(reagent.col)))
-            reagent.vol_well = reagent.vol_well_original
-            ctx.comment('New volume:' + str(reagent.vol_well))
-            height = (reagent.vol_well - aspirate_volume - reagent.v_cono) / cross_section_area
-                    #- reagent.h_cono
-            reagent.vol_well = reagent.vol_well - aspirate_volume
-            ctx.comment('Remaining volume:' + str(reagent.vol_well))
-            if height < min_height:
-                height = min_height
-            col_change = True
-        else:
-            height = (reagent.vol_well - aspirate_volume - reagent.v_cono) / cross_section_area #- reagent.h_cono
-            reagent.vol_well = reagent.vol_well - aspirate_volume
-            ctx.comment('Calculated height is ' + str(height))
-            if height < min_height:
-                height = min_height
-            ctx.comment('Used height is ' + str(height))
-            col_change = False
-        return height, col_change
-
-    ##########
-    # pick up tip and if there is none left, prompt user for a new rack
-    def pick_up(pip):
-        nonlocal tip_track
-        if not ctx.is_simulating():
-            if tip_track['counts'][pip] == tip_track['maxes'][pip]:
-                ctx.pause('Replace ' + str(pip.max_volume) + 'µl tipracks before \
-                resuming.')
-                pip.reset_tipracks()
-                tip_track['counts'][pip] = 0
-        pip.pick_up_tip()
-    ##########
-
-    def find_side(col):
-        '''
-        Detects if the current column has the magnet at its left or right side
-        '''
-        if col % 2 == 0:
-            side = -1  # left
-        else:
-            side = 1
-        return side
-
+    comment('INFO', 'Elution Buffer in the first column of the reservoir: {} ul',
+            ElutionBuffer.reagent_reservoir_volume)
 
 ####################################
     # load labware and modules
@@ -277,6 +160,8 @@ def run(ctx: protocol_api.ProtocolContext):
     WashBuffer1.reagent_reservoir = WashBuffer1_reservoir.wells()[0]
     WashBuffer2.reagent_reservoir = WashBuffer2_reservoir.wells()[0]
     ElutionBuffer.reagent_reservoir = reagent_res.rows()[0][0]
+    ElutionBuffer.height_model = height_model(reagent_res, bottom_height = ElutionBuffer.h_cono,
+                                              bottom_volume = ElutionBuffer.v_cono)
 
     # columns in destination plates to be filled depending the number of samples
     wb1plate1_destination = WashBuffer1_300ul_plate1.rows()[0][:num_cols]
@@ -295,6 +180,15 @@ def run(ctx: protocol_api.ProtocolContext):
         'maxes': {m300: len(tips300)*96}
     }
 
+    # Tips of each STEP: the buffers go to clean plates, one tip per STEP
+    tip_plan = TipPlan()
+    step_fills = [(WashBuffer1, wb1plate1_destination), (WashBuffer1, wb1plate2_destination),
+                  (WashBuffer2, wb2plate1_destination), (WashBuffer2, wb2plate2_destination),
+                  (ElutionBuffer, elutionbuffer_destination)]
+    for step, (reagent, destinations) in enumerate(step_fills, 1):
+        tip_plan.add(step, m300, [(reagent, False)] * len(destinations))
+    load_tipracks(m300, tip_plan)
+
     ############################################################################
     # STEP 1 Filling with WashBuffer1 plate 1
     ############################################################################
@@ -303,26 +197,21 @@ def run(ctx: protocol_api.ProtocolContext):
         start = datetime.now()
 
         ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'])
-        ctx.comment('###############################################')
+        comment('DEBUG', '###############################################')
 
         wash_buffer_vol = [150, 150]
-        rinse = False  # Only first time
 
         ########
-        # Wash buffer dispense
-        for i in range(num_cols):
-            if not m300.hw_pipette['has_tip']:
-                pick_up(m300)
-            for j, transfer_vol in enumerate(wash_buffer_vol):
-                if (i == 0 and j == 0):
-                    rinse = True #Rinse only first transfer
-                else:
-                    rinse = False
-                move_vol_multichannel(m300, reagent = WashBuffer1, source = WashBuffer1.reagent_reservoir,
-                               dest = wb1plate1_destination[i], vol = transfer_vol,
-                               air_gap_vol = air_gap_vol, x_offset = x_offset,
-                               pickup_height = 1, rinse = rinse, disp_height = -2,
-                               blow_out = True, touch_tip = True)
+        # Wash buffer dispense, several columns per aspiration
+        refill_tips(m300, tip_plan.tips(m300, STEP))
+        if not m300.hw_pipette['has_tip']:
+            pick_up(m300)
+        dispenses = [(dest, vol) for dest in wb1plate1_destination for vol in wash_buffer_vol]
+        multi_dispense(m300, reagent = WashBuffer1, source = WashBuffer1.reagent_reservoir,
+                       dispenses = dispenses, air_gap_vol = air_gap_vol, x_offset = x_offset,
+                       pickup_height = 1, rinse = True, disp_height = -2,
+                       blow_out = True, touch_tip = True, touch_tip_radius = 0.9,
+                       conditioning_vol = conditioning_vol)
         m300.drop_tip(home_after=True)
         tip_track['counts'][m300] += 8
         end = datetime.now()
@@ -339,26 +228,21 @@ def run(ctx: protocol_api.ProtocolContext):
         start = datetime.now()
 
         ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'])
-        ctx.comment('###############################################')
+        comment('DEBUG', '###############################################')
 
         wash_buffer_vol = [150, 150]
-        rinse = False  # Only first time
 
         ########
-        # Wash buffer dispense
-        for i in range(num_cols):
-            if not m300.hw_pipette['has_tip']:
-                pick_up(m300)
-            for j, transfer_vol in enumerate(wash_buffer_vol):
-                if (i == 0 and j == 0):
-                    rinse = True
-                else:
-                    rinse = False
-                move_vol_multichannel(m300, reagent = WashBuffer1, source = WashBuffer1.reagent_reservoir,
-                               dest = wb1plate2_destination[i], vol = transfer_vol,
-                               air_gap_vol = air_gap_vol, x_offset = x_offset,
-                               pickup_height = 1, rinse = rinse, disp_height = -2,
-                               blow_out = True, touch_tip = True)
+        # Wash buffer dispense, several columns per aspiration
+        refill_tips(m300, tip_plan.tips(m300, STEP))
+        if not m300.hw_pipette['has_tip']:
+            pick_up(m300)
+        dispenses = [(dest, vol) for dest in wb1plate2_destination for vol in wash_buffer_vol]
+        multi_dispense(m300, reagent = WashBuffer1, source = WashBuffer1.reagent_reservoir,
+                       dispenses = dispenses, air_gap_vol = air_gap_vol, x_offset = x_offset,
+                       pickup_height = 1, rinse = True, disp_height = -2,
+                       blow_out = True, touch_tip = True, touch_tip_radius = 0.9,
+                       conditioning_vol = conditioning_vol)
         m300.drop_tip(home_after=True)
         tip_track['counts'][m300] += 8
         end = datetime.now()
@@ -375,26 +259,21 @@ def run(ctx: protocol_api.ProtocolContext):
         start = datetime.now()
 
         ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'])
-        ctx.comment('###############################################')
+        comment('DEBUG', '###############################################')
 
         wash_buffer_vol = [150, 150, 150]
-        rinse = False  # Only first time
 
         ########
-        # Wash buffer dispense
-        for i in range(num_cols):
-            if not m300.hw_pipette['has_tip']:
-                pick_up(m300)
-            for j, transfer_vol in enumerate(wash_buffer_vol):
-                if (i == 0 and j == 0):
-                    rinse = True
-                else:
-                    rinse = False
-                move_vol_multichannel(m300, reagent = WashBuffer2, source = WashBuffer2.reagent_reservoir,
-                               dest = wb2plate1_destination[i], vol = transfer_vol,
-                               air_gap_vol = air_gap_vol, x_offset = x_offset,
-                               pickup_height = 1, rinse = rinse, disp_height = -2,
-                               blow_out = True, touch_tip = True)
+        # Wash buffer dispense, several columns per aspiration
+        refill_tips(m300, tip_plan.tips(m300, STEP))
+        if not m300.hw_pipette['has_tip']:
+            pick_up(m300)
+        dispenses = [(dest, vol) for dest in wb2plate1_destination for vol in wash_buffer_vol]
+        multi_dispense(m300, reagent = WashBuffer2, source = WashBuffer2.reagent_reservoir,
+                       dispenses = dispenses, air_gap_vol = air_gap_vol, x_offset = x_offset,
+                       pickup_height = 1, rinse = True, disp_height = -2,
+                       blow_out = True, touch_tip = True, touch_tip_radius = 0.9,
+                       conditioning_vol = conditioning_vol)
         m300.drop_tip(home_after=True)
         tip_track['counts'][m300] += 8
         end = datetime.now()
@@ -411,26 +290,21 @@ def run(ctx: protocol_api.ProtocolContext):
         start = datetime.now()
 
         ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'])
-        ctx.comment('###############################################')
+        comment('DEBUG', '###############################################')
 
         ethanol_vol = [150, 150, 150]
-        rinse = False  # Only first time
 
         ########
-        # Ethanol dispense
-        for i in range(num_cols):
-            if not m300.hw_pipette['has_tip']:
-                pick_up(m300)
-            for j, transfer_vol in enumerate(ethanol_vol):
-                if (i == 0 and j == 0):
-                    rinse = True
-                else:
-                    rinse = False
-                move_vol_multichannel(m300, reagent = WashBuffer2, source = WashBuffer2.reagent_reservoir,
-                              dest = wb2plate2_destination[i], vol = transfer_vol,
-                              air_gap_vol = air_gap_vol, x_offset = x_offset,
-                              pickup_height = 1, rinse = rinse, disp_height = -2,
-                              blow_out = True, touch_tip = True)
+        # Ethanol dispense, several columns per aspiration
+        refill_tips(m300, tip_plan.tips(m300, STEP))
+        if not m300.hw_pipette['has_tip']:
+            pick_up(m300)
+        dispenses = [(dest, vol) for dest in wb2plate2_destination for vol in ethanol_vol]
+        multi_dispense(m300, reagent = WashBuffer2, source = WashBuffer2.reagent_reservoir,
+                       dispenses = dispenses, air_gap_vol = air_gap_vol, x_offset = x_offset,
+                       pickup_height = 1, rinse = True, disp_height = -2,
+                       blow_out = True, touch_tip = True, touch_tip_radius = 0.9,
+                       conditioning_vol = conditioning_vol)
         m300.drop_tip(home_after=True)
         tip_track['counts'][m300] += 8
         end = datetime.now()
@@ -447,27 +321,23 @@ def run(ctx: protocol_api.ProtocolContext):
     if STEPS[STEP]['Execute'] == True:
         start = datetime.now()
         ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'])
-        ctx.comment('###############################################')
+        comment('DEBUG', '###############################################')
         # Elution buffer
         ElutionBuffer_vol = [50]
 
         ########
-        # Water or elution buffer
-        for i in range(num_cols):
-            if not m300.hw_pipette['has_tip']:
-                pick_up(m300)
-            for transfer_vol in ElutionBuffer_vol:
-                # Calculate pickup_height based on remaining volume and shape of container
-                [pickup_height, change_col] = calc_height(
-                    ElutionBuffer, multi_well_rack_area, transfer_vol * 8)
-                ctx.comment(
-                    'Aspirate from Reservoir column: ' + str(ElutionBuffer.col))
-                ctx.comment('Pickup height is ' + str(pickup_height))
-                move_vol_multichannel(m300, reagent = ElutionBuffer, source = ElutionBuffer.reagent_reservoir,
-                              dest = elutionbuffer_destination[i], vol = transfer_vol,
-                              air_gap_vol = air_gap_vol_elutionbuffer, x_offset = x_offset,
-                              pickup_height = pickup_height, rinse = False, disp_height = -2,
-                              blow_out = True, touch_tip = False)
+        # Water or elution buffer, several columns per aspiration
+        refill_tips(m300, tip_plan.tips(m300, STEP))
+        if not m300.hw_pipette['has_tip']:
+            pick_up(m300)
+        dispenses = [(dest, vol) for dest in elutionbuffer_destination for vol in ElutionBuffer_vol]
+        # pickup_height based on remaining volume and shape of container
+        multi_dispense(m300, reagent = ElutionBuffer, source = ElutionBuffer.reagent_reservoir,
+                       dispenses = dispenses, air_gap_vol = air_gap_vol_elutionbuffer,
+                       x_offset = x_offset, pickup_height = 0.5, rinse = False,
+                       disp_height = -2, blow_out = True, touch_tip = False,
+                       conditioning_vol = conditioning_vol,
+                       cross_section_area = multi_well_rack_area)
         m300.drop_tip(home_after=True)
         tip_track['counts'][m300] += 8
         end = datetime.now()
@@ -476,15 +346,17 @@ def run(ctx: protocol_api.ProtocolContext):
                     STEPS[STEP]['description'] + ' took ' + str(time_taken))
         STEPS[STEP]['Time:'] = str(time_taken)
 
-    # Export the time log to a tsv file
+    # Export the time log to a tsv file (and the last records of the trace)
+    tracer.flush()
     if not ctx.is_simulating():
         with open(file_path, 'w') as f:
-            f.write('STEP\texecution\tdescription\twait_time\texecution_time\n')
+            f.write('STEP\texecution\tdescription\twait_time\texecution_time\tsaved_delay\n')
             for key in STEPS.keys():
-                row = str(key)
-                for key2 in STEPS[key].keys():
-                    row += '\t' + format(STEPS[key][key2])
-                f.write(row + '\n')
+                # Fixed columns, a skipped STEP has no wait or execution time
+                row = [key, STEPS[key]['Execute'], STEPS[key]['description'],
+                       STEPS[key].get('wait_time', ''), STEPS[key].get('Time:', ''),
+                       round(saved_delays.get(key, 0), 1)]
+                f.write('\t'.join(format(value) for value in row) + '\n')
         f.close()
 
     ############################################################################
@@ -27,6 +27,8 @@ metadata = {
 # Defined variables
 ##################
 NUM_SAMPLES = $num_samples #last sample (PC), has been removed (done manually)
+LOG_LEVEL = $log_level # Comments in the run log: 'STEP', 'INFO' or 'DEBUG'
+TRACE = False # Record every transfer, mix and tip pick up in the _trace.bin of the run
 
 air_gap_vol = 15
 run_id = $run_id
@@ -35,6 +37,8 @@ MS_vol = 5
 air_gap_vol_MS = 2
 height_MS = -35
 temperature = 10
+cold_budget = 30  # Minutes the MS2 can spend out of the cold chain (warned in the run log)
+beads_premix_rounds = 3  # Bead premixes (10 rounds each) while the tempdeck cools (at most)
 x_offset = [0,0]
 L_deepwell = 8  # Deepwell side length (KingFisher deepwell)
 total_MS_volume = NUM_SAMPLES * MS_vol * 1.1  # Total volume of MS
@@ -72,28 +76,9 @@ def run(ctx: protocol_api.ProtocolContext):
     if not ctx.is_simulating():
         if not os.path.isdir(folder_path):
             os.mkdir(folder_path)
-        file_path = folder_path + '/Station_KB_sample_prep_pathogen_log.txt'
-
-    # Define Reagents as objects with their properties
-    class Reagent:
-        def __init__(self, name, flow_rate_aspirate, flow_rate_dispense, rinse,
-                     reagent_reservoir_volume, delay, num_wells, h_cono, v_fondo,
-                      tip_recycling = 'none'):
-            self.name = name
-            self.flow_rate_aspirate = flow_rate_aspirate
-            self.flow_rate_dispense = flow_rate_dispense
-            self.rinse = bool(rinse)
-            self.reagent_reservoir_volume = reagent_reservoir_volume
-            self.delay = delay
-            self.num_wells = num_wells
-            self.col = 0
-            self.vol_well = 0
-            self.h_cono = h_cono
-            self.v_cono = v_fondo
-            self.unused=[]
-            self.tip_recycling = tip_recycling
-            self.vol_well_original = reagent_reservoir_volume / num_wells
+        file_path = folder_path + '/KB_sample_prep_pathogen_time_log.txt'
 
+    $runtime
 
     # Reagents and their characteristics
     Sample = Reagent(name='Sample',
@@ -131,125 +116,11 @@ def run(ctx: protocol_api.ProtocolContext):
     Beads.vol_well = Beads.vol_well_original
     MS.vol_well = MS.reagent_reservoir_volume
 
-    def move_vol_multichannel(pipet, reagent, source, dest, vol, air_gap_vol, x_offset,
-                       pickup_height, rinse, disp_height, blow_out, touch_tip):
-        '''
-        x_offset: list with two values. x_offset in source and x_offset in destination i.e. [-1,1]
-        pickup_height: height from bottom where volume
-        rinse: if True it will do 2 rounds of aspirate and dispense before the tranfer
-        disp_height: dispense height; by default it's close to the top (z=-2), but in case it is needed it can be lowered
-        blow_out, touch_tip: if True they will be done after dispensing
-        '''
-        # Rinse before aspirating
-        if rinse == True:
-            custom_mix(pipet, reagent, location = source, vol = vol,
-                       rounds = 2, blow_out = True, mix_height = 0,
-                       x_offset = x_offset)
-        # SOURCE
-        s = source.bottom(pickup_height).move(Point(x = x_offset[0]))
-        pipet.aspirate(vol, s, rate = reagent.flow_rate_aspirate)  # aspirate liquid
-        if air_gap_vol != 0:  # If there is air_gap_vol, switch pipette to slow speed
-            pipet.aspirate(air_gap_vol, source.top(z = -2),
-                           rate = reagent.flow_rate_aspirate)  # air gap
-        # GO TO DESTINATION
-        drop = dest.top(z = disp_height).move(Point(x = x_offset[1]))
-        pipet.dispense(vol + air_gap_vol, drop,
-                       rate = reagent.flow_rate_dispense)  # dispense all
-        ctx.delay(seconds = reagent.delay) # pause for x seconds depending on reagent
-        if blow_out == True:
-            pipet.blow_out(dest.top(z = -2))
-        if touch_tip == True:
-            pipet.touch_tip(speed = 20, v_offset = -5, radius = 0.9)
-
-
-    def custom_mix(pipet, reagent, location, vol, rounds, blow_out, mix_height,
-    x_offset, source_height = 3):
-        '''
-        Function for mixing a given [vol] in the same [location] a x number of [rounds].
-        blow_out: Blow out optional [True,False]
-        x_offset = [source, destination]
-        source_height: height from bottom to aspirate
-        mix_height: height from bottom to dispense
-        '''
-        if mix_height == 0:
-            mix_height = 3
-        pipet.aspirate(1, location=location.bottom(
-            z=source_height).move(Point(x=x_offset[0])), rate=reagent.flow_rate_aspirate)
-        for _ in range(rounds):
-            pipet.aspirate(vol, location=location.bottom(
-                z=source_height).move(Point(x=x_offset[0])), rate=reagent.flow_rate_aspirate)
-            pipet.dispense(vol, location=location.bottom(
-                z=mix_height).move(Point(x=x_offset[1])), rate=reagent.flow_rate_dispense)
-        pipet.dispense(1, location=location.bottom(
-            z=mix_height).move(Point(x=x_offset[1])), rate=reagent.flow_rate_dispense)
-        if blow_out == True:
-            pipet.blow_out(location.top(z=-2))  # Blow out
-
-    def calc_height(reagent, cross_section_area, aspirate_volume, min_height = 0.5):
-        nonlocal ctx
-        ctx.comment('Remaining volume ' + str(reagent.vol_well) +
-                    '< needed volume ' + str(aspirate_volume) + '?')
-        if reagent.vol_well < aspirate_volume:
-            reagent.unused.append(reagent.vol_well)
-            ctx.comment('Next column should be picked')
-            ctx.comment('Previous to change: ' + str(reagent.col))
-            # column selector position; intialize to required number
-            reagent.col = reagent.col + 1
-            ctx.comment(str('After change: ' + str(reagent.col)))
-            reagent.vol_well = reagent.vol_well_original
-            ctx.comment('New volume:' + str(reagent.vol_well))
-            height = (reagent.vol_well - aspirate_volume - reagent.v_cono) / cross_section_area
-                    #- reagent.h_cono
-            reagent.vol_well = reagent.vol_well - aspirate_volume
-            ctx.comment('Remaining volume:' + str(reagent.vol_well))
-            if height < min_height:
-                height = min_height
-            col_change = True
-        else:
-            height = (reagent.vol_well - aspirate_volume - reagent.v_cono) / cross_section_area #- reagent.h_cono
-            reagent.vol_well = reagent.vol_well - aspirate_volume
-            ctx.comment('Calculated height is ' + str(height))
-            if height < min_height:
-                height = min_height
-            ctx.comment('Used height is ' + str(height))
-            col_change = False
-        return height, col_change
-
-    def distribute_custom(pipette, volume, src, dest, waste_pool, pickup_height, extra_dispensal, disp_height=0):
-        # Custom distribute function that allows for blow_out in different location and adjustement of touch_tip
-        pipette.aspirate((len(dest) * volume) +
-                         extra_dispensal, src.bottom(pickup_height))
-        pipette.touch_tip(speed=20, v_offset=-5)
-        pipette.move_to(src.top(z=5))
-        pipette.aspirate(20)  # air gap
-        for d in dest:
-            pipette.dispense(20, d.top())
-            drop = d.top(z = disp_height)
-            pipette.dispense(volume, drop)
-            pipette.move_to(d.top(z=5))
-            pipette.aspirate(20)  # air gap
-        try:
-            pipette.blow_out(waste_pool.wells()[0].bottom(pickup_height + 3))
-        except:
-            pipette.blow_out(waste_pool.bottom(pickup_height + 3))
-        return (len(dest) * volume)
-
-    ##########
-    # pick up tip and if there is none left, prompt user for a new rack
-    def pick_up(pip):
-        nonlocal tip_track
-        if not ctx.is_simulating():
-            if tip_track['counts'][pip] == tip_track['maxes'][pip]:
-                ctx.pause('Replace ' + str(pip.max_volume) + 'µl tipracks before \
-                resuming.')
-                pip.reset_tipracks()
-                tip_track['counts'][pip] = 0
-        pip.pick_up_tip()
-
-    def divide_destinations(l, n):
-        # Divide the list of destinations in size n lists.
-        for i in range(0, len(l), n):
-            yield l[i:i + n]
+    ############################################
+    # tempdeck first: it cools down while the rest is loaded and planned
+    tempdeck = ctx.load_module('tempdeck', '4')
+    cold_chain = ColdChain(tempdeck, temperature)
+    cold_chain.track(MS, on_module = True, budget = cold_budget)
 
     ####################################
     # load labware and modules
@@ -263,11 +134,6 @@ def run(ctx: protocol_api.ProtocolContext):
         'kf_96_wellplate_2400ul', '1',
         'KF 96 Well 2400ul elution plate')
 
-    ############################################
-    # tempdeck
-    tempdeck = ctx.load_module('tempdeck', '4')
-    tempdeck.set_temperature(temperature)
-
     ##################################
     # MS plate -  plate with a column containing the internal control MS
     ms_plate = tempdeck.load_labware(
@@ -305,14 +171,33 @@ def run(ctx: protocol_api.ProtocolContext):
         'maxes': {m300: len(tips200) * 96, m20: len(tips20) * 96}
     }
 
+    # Tips of each STEP: MS is dispensed into the samples (fresh tip per
+    # column), the beads go to the top of the wells with the same tip
+    tip_plan = TipPlan()
+    ms_tips = tip_plan.add(1, m20, [(MS, True)] * num_cols)
+    tip_plan.add(2, m300, [(Beads, False)]) # premix
+    tip_plan.add(3, m300, [(Beads, False)] * num_cols * 2, keep_tip = True)
+    load_tipracks(m20, tip_plan)
+    load_tipracks(m300, tip_plan)
+
     # Divide destination wells in small groups for P300 pipette
     #destinations = list(divide_destinations(sample_plate.wells()[:NUM_SAMPLES], size_transfer))
     Beads.reagent_reservoir = reagent_res.rows(
     )[0][:Beads.num_wells]  # 1 row, 4 columns (first ones)
+    Beads.height_model = height_model(reagent_res, bottom_height = Beads.h_cono,
+                                      bottom_volume = Beads.v_cono)
     work_destinations = sample_plate.wells()[:NUM_SAMPLES]
     work_destinations_cols = sample_plate.rows()[0][:num_cols]
     ms_origins = ms_plate.rows()[0][0]  # 1 row, 1 columns
 
+    def premix_beads():
+        # Work for the m300 while the tempdeck cools: resuspend the beads
+        # (STEP 2 premixes them again right before the transfer)
+        if not m300.hw_pipette['has_tip']:
+            pick_up(m300)
+        custom_mix(m300, Beads, Beads.reagent_reservoir[Beads.col], vol=180,
+                   rounds=10, blow_out=True, mix_height=0, x_offset = x_offset)
+
     ############################################################################
     # STEP 1: Transfer MS
     ############################################################################
@@ -320,23 +205,31 @@ def run(ctx: protocol_api.ProtocolContext):
     STEP += 1
     if STEPS[STEP]['Execute'] == True:
         start = datetime.now()
-        ctx.comment('ms_wells')
+        comment('DEBUG', 'ms_wells')
+        refill_tips(m20, tip_plan.tips(m20, STEP))
+        # The MS2 is on the cold plate
+        STEPS[STEP]['wait_time'] += round(cold_chain.ready(premix_beads, beads_premix_rounds))
+        if m300.hw_pipette['has_tip'] and not any(STEPS[s]['Execute'] for s in STEPS if s > STEP):
+            # No beads STEP keeps the tip of the premix
+            m300.drop_tip()
+            tip_track['counts'][m300] += 8
         #Loop over defined wells
-        for d in work_destinations_cols:
-            m20.pick_up_tip()
+        for d, new_tip in zip(work_destinations_cols, ms_tips):
+            change_tip(m20, new_tip)
             #Source samples
             move_vol_multichannel(m20, reagent = MS, source = ms_origins, dest = d,
             vol = MS_vol, air_gap_vol = air_gap_vol_MS, x_offset = x_offset,
                    pickup_height = 0.5, disp_height = -35, rinse = False,
-                   blow_out=True, touch_tip=True)
-            m20.drop_tip()
-            tip_track['counts'][m20]+=8
+                   blow_out=True, touch_tip=True, touch_tip_radius = 0.9)
+        m20.drop_tip()
+        tip_track['counts'][m20]+=8
 
         end = datetime.now()
         time_taken = (end - start)
         ctx.comment('Step ' + str(STEP) + ': ' +
                     STEPS[STEP]['description'] + ' took ' + str(time_taken))
         STEPS[STEP]['Time:'] = str(time_taken)
+        cold_chain.step(STEP)
 
 
 
@@ -349,23 +242,25 @@ def run(ctx: protocol_api.ProtocolContext):
 
         start = datetime.now()
         ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'])
-        ctx.comment('###############################################')
+        comment('DEBUG', '###############################################')
+        refill_tips(m300, tip_plan.tips(m300, STEP))
         if not m300.hw_pipette['has_tip']:
             pick_up(m300)
-            ctx.comment('Tip picked up')
-        ctx.comment('Mixing ' + Beads.name)
+            comment('DEBUG', 'Tip picked up')
+        comment('INFO', 'Mixing {}', Beads.name)
 
         # Mixing
         custom_mix(m300, Beads, Beads.reagent_reservoir[Beads.col], vol=180,
                    rounds=10, blow_out=True, mix_height=0, x_offset = x_offset)
-        ctx.comment('Finished premixing!')
-        ctx.comment('Now, reagents will be transferred to deepwell plate.')
+        comment('INFO', 'Finished premixing!')
+        comment('INFO', 'Now, reagents will be transferred to deepwell plate.')
 
         end = datetime.now()
         time_taken = (end - start)
         ctx.comment('Step ' + str(STEP) + ': ' +
                     STEPS[STEP]['description'] + ' took ' + str(time_taken))
         STEPS[STEP]['Time:'] = str(time_taken)
+        cold_chain.step(STEP)
 
     ############################################################################
     # STEP 3: TRANSFER BEADS
@@ -375,7 +270,8 @@ def run(ctx: protocol_api.ProtocolContext):
         # Transfer parameters
         start = datetime.now()
         ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'])
-        ctx.comment('###############################################')
+        comment('DEBUG', '###############################################')
+        refill_tips(m300, tip_plan.tips(m300, STEP))
         beads_transfer_vol = [130, 130]  # Two rounds of 130
         rinse = True
         for i in range(num_cols):
@@ -387,13 +283,12 @@ def run(ctx: protocol_api.ProtocolContext):
                     reagent = Beads, cross_section_area = multi_well_rack_area,
                     aspirate_volume = transfer_vol * 8, min_height=1)
                 if change_col == True:  # If we switch column because there is not enough volume left in current reservoir column we mix new column
-                    ctx.comment(
-                        'Mixing new reservoir column: ' + str(Beads.col))
+                    comment('INFO', 'Mixing new reservoir column: {}', Beads.col)
                     custom_mix(m300, Beads, Beads.reagent_reservoir[Beads.col],
                                vol=180, rounds=10, blow_out=True, mix_height=0,
                                x_offset = x_offset)
-                ctx.comment('Aspirate from reservoir column: ' + str(Beads.col))
-                ctx.comment('Pickup height is ' + str(pickup_height))
+                comment('DEBUG', 'Aspirate from reservoir column: {}', Beads.col)
+                comment('DEBUG', 'Pickup height is {}', pickup_height)
                 if j != 0: #Rinse only the first round
                     rinse = False
                 move_vol_multichannel(m300, reagent=Beads, source=Beads.reagent_reservoir[Beads.col],
@@ -404,7 +299,7 @@ def run(ctx: protocol_api.ProtocolContext):
                 m300.aspirate(air_gap_vol, work_destinations_cols[i].top(z = -2),
                                rate = Beads.flow_rate_aspirate)
                 m300.dispense(air_gap_vol, Beads.reagent_reservoir[Beads.col].top())
-            ctx.comment('Mixing MS with beads ')
+            comment('INFO', 'Mixing MS with beads ')
 
         m300.drop_tip(home_after=False)
         tip_track['counts'][m300] += 8
@@ -413,17 +308,21 @@ def run(ctx: protocol_api.ProtocolContext):
         ctx.comment('Step ' + str(STEP) + ': ' +
                     STEPS[STEP]['description'] + ' took ' + str(time_taken))
         STEPS[STEP]['Time:'] = str(time_taken)
+        cold_chain.step(STEP)
 
-    # Export the time log to a tsv file
+    # Export the time log to a tsv file (and the last records of the trace)
+    tracer.flush()
     if not ctx.is_simulating():
         with open(file_path, 'w') as f:
-            f.write('STEP\texecution\tdescription\twait_time\texecution_time\n')
+            f.write('STEP\texecution\tdescription\twait_time\texecution_time\tsaved_delay\n')
             for key in STEPS.keys():
-                row = str(key)
-                for key2 in STEPS[key].keys():
-                    row += '\t' + format(STEPS[key][key2])
-                f.write(row + '\n')
+                # Fixed columns, a skipped STEP has no wait or execution time
+                row = [key, STEPS[key]['Execute'], STEPS[key]['description'],
+                       STEPS[key].get('wait_time', ''), STEPS[key].get('Time:', ''),
+                       round(saved_delays.get(key, 0), 1)]
+                f.write('\t'.join(format(value) for value in row) + '\n')
         f.close()
+        cold_chain.write(run_file('_cold_chain.txt'))
 
 
     ############################################################################
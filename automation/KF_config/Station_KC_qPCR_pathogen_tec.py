@@ -25,6 +25,8 @@ metadata = {
 #Defined variables
 ##################
 NUM_SAMPLES = $num_samples #last sample (PC), has been removed (done manually)
+LOG_LEVEL = $log_level # Comments in the run log: 'STEP', 'INFO' or 'DEBUG'
+TRACE = False # Record every transfer, mix and tip pick up in the _trace.bin of the run
 
 air_gap_vol = 5
 air_gap_sample = 2
@@ -35,12 +37,14 @@ volume_mmix = 20  # Volume of transfered master mix
 volume_sample = 5  # Volume of the sample
 diameter_screwcap = 8.25  # Diameter of the screwcap
 temperature = 10  # Temperature of temp module
+cold_budget = 30  # Minutes the master mix can spend out of the cold chain (warned in the run log)
+mmix_premix_rounds = 5  # Mixing rounds of the master mix tubes while the tempdeck cools (at most)
 volume_cone = 50  # Volume in ul that fit in the screwcap cone
 x_offset = [0,0]
+mmix_mode = $mmix_mode # Master mix: 'single' well by well with the p300, 'multi' through a stage column with the m20, 'auto' the fastest
 
 # Calculated variables
 volume_mmix_available = (NUM_SAMPLES * 1.1 * volume_mmix)  # Total volume needed
-num_wells_mmix = math.ceil(volume_mmix_available/2000) #Number of wells needed
 area_section_screwcap = (np.pi * diameter_screwcap**2) / 4
 h_cone = (volume_cone * 3 / area_section_screwcap)
 num_cols = math.ceil(NUM_SAMPLES / 8)  # Columns we are working on
@@ -68,33 +72,22 @@ def run(ctx: protocol_api.ProtocolContext):
             os.mkdir(folder_path)
         file_path = folder_path + '/KC_qPCR_time_log.txt'
 
-    # Define Reagents as objects with their properties
-    class Reagent:
-        def __init__(self, name, flow_rate_aspirate, flow_rate_dispense, rinse,
-                     reagent_reservoir_volume, delay, num_wells, h_cono, v_fondo,
-                      tip_recycling = 'none'):
-            self.name = name
-            self.flow_rate_aspirate = flow_rate_aspirate
-            self.flow_rate_dispense = flow_rate_dispense
-            self.rinse = bool(rinse)
-            self.reagent_reservoir_volume = reagent_reservoir_volume
-            self.delay = delay
-            self.num_wells = num_wells
-            self.col = 0
-            self.vol_well = 0
-            self.h_cono = h_cono
-            self.v_cono = v_fondo
-            self.unused=[]
-            self.tip_recycling = tip_recycling
-            self.vol_well_original = reagent_reservoir_volume / num_wells
+    $runtime
+
+    # Master mix through a stage column with the m20: extra master mix and time saved
+    mmix_stage = StagePlan(NUM_SAMPLES, volume_mmix, 200, air_gap_vol, 20, air_gap_sample)
+    mmix_multi = mmix_mode == 'multi' or (mmix_mode == 'auto' and mmix_stage.saved_time > 0)
+    comment('INFO', 'Master mix stage column: {:.0f}\u03BCl more dead volume, {:.0f} s saved',
+            mmix_stage.dead_volume, mmix_stage.saved_time)
+    mmix_volume = volume_mmix_available + (mmix_stage.dead_volume if mmix_multi else 0)
 
     # Reagents and their characteristics
     MMIX = Reagent(name = 'Master Mix',
                       rinse = False,
                       flow_rate_aspirate = 1,
                       flow_rate_dispense = 1,
-                      reagent_reservoir_volume = volume_mmix_available,
-                      num_wells = num_wells_mmix, #changes with num samples
+                      reagent_reservoir_volume = mmix_volume,
+                      num_wells = math.ceil(mmix_volume/2000), #changes with num samples
                       delay = 0,
                       h_cono = h_cone,
                       v_fondo = volume_cone  # V cono
@@ -117,89 +110,12 @@ def run(ctx: protocol_api.ProtocolContext):
     ##################
     # Custom functions
 
-    def move_vol_multichannel(pipet, reagent, source, dest, vol, air_gap_vol, x_offset,
-                       pickup_height, rinse, disp_height, blow_out, touch_tip):
-        '''
-        x_offset: list with two values. x_offset in source and x_offset in destination i.e. [-1,1]
-        pickup_height: height from bottom where volume
-        rinse: if True it will do 2 rounds of aspirate and dispense before the tranfer
-        disp_height: dispense height; by default it's close to the top (z=-2), but in case it is needed it can be lowered
-        blow_out, touch_tip: if True they will be done after dispensing
-        '''
-        # Rinse before aspirating
-        if rinse == True:
-            custom_mix(pipet, reagent, location = source, vol = vol,
-                       rounds = 2, blow_out = True, mix_height = 0,
-                       x_offset = x_offset)
-        # SOURCE
-        s = source.bottom(pickup_height).move(Point(x = x_offset[0]))
-        pipet.aspirate(vol, s, rate = reagent.flow_rate_aspirate)  # aspirate liquid
-        if air_gap_vol != 0:  # If there is air_gap_vol, switch pipette to slow speed
-            pipet.aspirate(air_gap_vol, source.top(z = -2),
-                           rate = reagent.flow_rate_aspirate)  # air gap
-        # GO TO DESTINATION
-        drop = dest.top(z = disp_height).move(Point(x = x_offset[1]))
-        pipet.dispense(vol + air_gap_vol, drop,
-                       rate = reagent.flow_rate_dispense)  # dispense all
-        ctx.delay(seconds = reagent.delay) # pause for x seconds depending on reagent
-        if blow_out == True:
-            pipet.blow_out(dest.top(z = -2))
-        if touch_tip == True:
-            pipet.touch_tip(speed = 20, v_offset = -5, radius = 0.9)
-
-
-    def custom_mix(pipet, reagent, location, vol, rounds, blow_out, mix_height,
-    x_offset, source_height = 3):
-        '''
-        Function for mixing a given [vol] in the same [location] a x number of [rounds].
-        blow_out: Blow out optional [True,False]
-        x_offset = [source, destination]
-        source_height: height from bottom to aspirate
-        mix_height: height from bottom to dispense
-        '''
-        if mix_height == 0:
-            mix_height = 3
-        pipet.aspirate(1, location=location.bottom(
-            z=source_height).move(Point(x=x_offset[0])), rate=reagent.flow_rate_aspirate)
-        for _ in range(rounds):
-            pipet.aspirate(vol, location=location.bottom(
-                z=source_height).move(Point(x=x_offset[0])), rate=reagent.flow_rate_aspirate)
-            pipet.dispense(vol, location=location.bottom(
-                z=mix_height).move(Point(x=x_offset[1])), rate=reagent.flow_rate_dispense)
-        pipet.dispense(1, location=location.bottom(
-            z=mix_height).move(Point(x=x_offset[1])), rate=reagent.flow_rate_dispense)
-        if blow_out == True:
-            pipet.blow_out(location.top(z=-2))  # Blow out
-
-    def calc_height(reagent, cross_section_area, aspirate_volume, min_height = 0.5):
-        nonlocal ctx
-        ctx.comment('Remaining volume ' + str(reagent.vol_well) +
-                    '< needed volume ' + str(aspirate_volume) + '?')
-        if reagent.vol_well < aspirate_volume:
-            reagent.unused.append(reagent.vol_well)
-            ctx.comment('Next column should be picked')
-            ctx.comment('Previous to change: ' + str(reagent.col))
-            # column selector position; intialize to required number
-            reagent.col = reagent.col + 1
-            ctx.comment(str('After change: ' + str(reagent.col)))
-            reagent.vol_well = reagent.vol_well_original
-            ctx.comment('New volume:' + str(reagent.vol_well))
-            height = (reagent.vol_well - aspirate_volume - reagent.v_cono) / cross_section_area
-                    #- reagent.h_cono
-            reagent.vol_well = reagent.vol_well - aspirate_volume
-            ctx.comment('Remaining volume:' + str(reagent.vol_well))
-            if height < min_height:
-                height = min_height
-            col_change = True
-        else:
-            height = (reagent.vol_well - aspirate_volume - reagent.v_cono) / cross_section_area #- reagent.h_cono
-            reagent.vol_well = reagent.vol_well - aspirate_volume
-            ctx.comment('Calculated height is ' + str(height))
-            if height < min_height:
-                height = min_height
-            ctx.comment('Used height is ' + str(height))
-            col_change = False
-        return height, col_change
+    ############################################
+    # tempdeck first: it cools down while the rest is loaded and planned
+    tempdeck = ctx.load_module('tempdeck', '4')
+    cold_chain = ColdChain(tempdeck, temperature)
+    cold_chain.track(MMIX, budget = cold_budget)
+    cold_chain.track(Samples) # chilled elution plate
 
     ####################################
     # load labware and modules
@@ -208,11 +124,6 @@ def run(ctx: protocol_api.ProtocolContext):
         'opentrons_24_aluminumblock_generic_2ml_screwcap', '2',
         'Bloque Aluminio opentrons 24 screwcaps 2000 µL ')
 
-    ############################################
-    # tempdeck
-    tempdeck = ctx.load_module('tempdeck', '4')
-    tempdeck.set_temperature(temperature)
-
     ##################################
     # qPCR plate - final plate, goes to PCR
     qpcr_plate = tempdeck.load_labware(
@@ -226,6 +137,17 @@ def run(ctx: protocol_api.ProtocolContext):
         'chilled KF plate with elutions (alum opentrons)')
     samples = source_plate.wells()[:NUM_SAMPLES]
 
+    if mmix_multi:
+        ##################################
+        # Stage plate - master mix columns for the m20
+        stage_plate = ctx.load_labware(
+            'opentrons_96_aluminumblock_generic_pcr_strip_200ul', '3',
+            'chilled master mix stage strips (alum opentrons)')
+        stage_columns = stage_plate.columns()[:len(mmix_stage.stage_volumes)]
+        # Stage wells, row by row of each column, and the volume of each transfer
+        stage_fills = [(well, vol) for column, fill in zip(stage_columns, mmix_stage.stage_fills)
+                       for well in column for vol in fill]
+
     ##################################
     # Load Tipracks
     tips20 = [
@@ -241,7 +163,10 @@ def run(ctx: protocol_api.ProtocolContext):
     ################################################################################
     # Declare which reagents are in each reservoir as well as deepwell and elution plate
     MMIX.reagent_reservoir = tuberack.rows()[0][:MMIX.num_wells] # 1 row, 2 columns (first ones)
-    ctx.comment('Wells in: '+ str(tuberack.rows()[0][:MMIX.num_wells]) + ' element: '+str(MMIX.reagent_reservoir[MMIX.col]))
+    # volume -> height of the screwcaps, with the cone of the old formula
+    MMIX.height_model = height_model(tuberack, bottom_height = h_cone, bottom_volume = volume_cone)
+    comment('DEBUG', 'Wells in: {} element: {}', tuberack.rows()[0][:MMIX.num_wells],
+            MMIX.reagent_reservoir[MMIX.col])
     # setup up sample sources and destinations
     samples = source_plate.wells()[:NUM_SAMPLES]
     samples_multi = source_plate.rows()[0][:num_cols]
@@ -257,25 +182,69 @@ def run(ctx: protocol_api.ProtocolContext):
     # used tip counter and set maximum tips available
     tip_track = {
         'counts': {p300: 0,
-                   m20: 0}
+                   m20: 0},
+        'maxes': {p300: len(tips200) * 96, m20: len(tips20) * 96}
     }
 
+    # Tips of each STEP: the master mix goes to the empty plate with one
+    # tip, the samples are dispensed into the master mix (fresh tip each)
+    tip_plan = TipPlan()
+    if mmix_multi:
+        tip_plan.add(1, p300, [(MMIX, False)] * len(stage_fills))
+        tip_plan.add(1, m20, [(MMIX, False)] * len(pcr_wells_multi))
+    else:
+        tip_plan.add(1, p300, [(MMIX, False)] * len(pcr_wells))
+    sample_tips = tip_plan.add(2, m20, [(Samples, True)] * len(samples_multi))
+    load_tipracks(p300, tip_plan)
+    load_tipracks(m20, tip_plan)
+
+    def premix_mmix():
+        # Work for the p300 while the tempdeck cools: mix the master mix tubes
+        for tube in MMIX.reagent_reservoir:
+            custom_mix(p300, MMIX, tube, vol = min(100, MMIX.vol_well_original / 2),
+                       rounds = 1, blow_out = False, mix_height = 0, x_offset = x_offset)
+
     ############################################################################
     # STEP 1: Transfer Master MIX
     ############################################################################
     STEP += 1
     if STEPS[STEP]['Execute'] == True:
         start = datetime.now()
-        p300.pick_up_tip()
+        refill_tips(p300, tip_plan.tips(p300, STEP))
+        pick_up(p300)
 
-        for dest in pcr_wells:
-            [pickup_height, col_change] = calc_height(MMIX, area_section_screwcap, volume_mmix)
-            move_vol_multichannel(p300, reagent = MMIX, source = MMIX.reagent_reservoir[MMIX.col],
-            dest = dest, vol = volume_mmix, air_gap_vol = air_gap_vol, x_offset = x_offset,
+        # Single channel transfers: to the stage wells or to every qPCR well
+        if mmix_multi:
+            mmix_transfers = stage_fills
+        else:
+            mmix_transfers = [(dest, volume_mmix) for dest in pcr_wells]
+        # Pickup heights and screwcaps for all the transfers at once
+        [mmix_heights, mmix_cols] = plan_heights(MMIX, [vol for dest, vol in mmix_transfers])
+        if not mmix_multi:
+            # The first transfer goes to the cold plate
+            STEPS[STEP]['wait_time'] += round(cold_chain.ready(premix_mmix, mmix_premix_rounds))
+        for (dest, vol), pickup_height, col in zip(mmix_transfers, mmix_heights, mmix_cols):
+            move_vol_multichannel(p300, reagent = MMIX, source = MMIX.reagent_reservoir[col],
+            dest = dest, vol = vol, air_gap_vol = air_gap_vol, x_offset = x_offset,
                    pickup_height = pickup_height, disp_height = -10, rinse = False,
-                   blow_out=True, touch_tip=True)
+                   blow_out=True, touch_tip=True, touch_tip_radius = 0.9)
         p300.drop_tip()
         tip_track['counts'][p300]+=1
+
+        if mmix_multi:
+            # Stage column to the qPCR plate, one tip for all the columns
+            refill_tips(m20, tip_plan.tips(m20, STEP))
+            pick_up(m20)
+            # The stage was filled while the tempdeck cooled
+            STEPS[STEP]['wait_time'] += round(cold_chain.ready())
+            for dest, col in zip(pcr_wells_multi, mmix_stage.stage_col):
+                for vol in mmix_stage.trips:
+                    move_vol_multichannel(m20, reagent = MMIX, source = stage_columns[col][0],
+                    dest = dest, vol = vol, air_gap_vol = air_gap_sample, x_offset = x_offset,
+                           pickup_height = 0.2, disp_height = -10, rinse = False,
+                           blow_out = True, touch_tip = True, touch_tip_radius = 0.9)
+            m20.drop_tip()
+            tip_track['counts'][m20]+=8
         #MMIX.unused_two = MMIX.vol_well
 
         end = datetime.now()
@@ -283,6 +252,7 @@ def run(ctx: protocol_api.ProtocolContext):
         ctx.comment('Step ' + str(STEP) + ': ' +
                     STEPS[STEP]['description'] + ' took ' + str(time_taken))
         STEPS[STEP]['Time:'] = str(time_taken)
+        cold_chain.step(STEP)
 
     ############################################################################
     # STEP 2: TRANSFER Samples
@@ -291,34 +261,40 @@ def run(ctx: protocol_api.ProtocolContext):
     STEP += 1
     if STEPS[STEP]['Execute'] == True:
         start = datetime.now()
-        ctx.comment('pcr_wells')
+        comment('DEBUG', 'pcr_wells')
+        refill_tips(m20, tip_plan.tips(m20, STEP))
+        STEPS[STEP]['wait_time'] += round(cold_chain.ready()) # if STEP 1 was skipped
         #Loop over defined wells
-        for s, d in zip(samples_multi, pcr_wells_multi):
-            m20.pick_up_tip()
+        for s, d, new_tip in zip(samples_multi, pcr_wells_multi, sample_tips):
+            change_tip(m20, new_tip)
             #Source samples
             move_vol_multichannel(m20, reagent = Samples, source = s, dest = d,
             vol = volume_sample, air_gap_vol = air_gap_sample, x_offset = x_offset,
                    pickup_height = 0.2, disp_height = -10, rinse = False,
-                   blow_out = True, touch_tip = True)
-            m20.drop_tip()
-            tip_track['counts'][m20]+=8
+                   blow_out = True, touch_tip = True, touch_tip_radius = 0.9)
+        m20.drop_tip()
+        tip_track['counts'][m20]+=8
 
         end = datetime.now()
         time_taken = (end - start)
         ctx.comment('Step ' + str(STEP) + ': ' +
                     STEPS[STEP]['description'] + ' took ' + str(time_taken))
         STEPS[STEP]['Time:'] = str(time_taken)
+        cold_chain.step(STEP)
 
-    # Export the time log to a tsv file
+    # Export the time log to a tsv file (and the last records of the trace)
+    tracer.flush()
     if not ctx.is_simulating():
         with open(file_path, 'w') as f:
-            f.write('STEP\texecution\tdescription\twait_time\texecution_time\n')
+            f.write('STEP\texecution\tdescription\twait_time\texecution_time\tsaved_delay\n')
             for key in STEPS.keys():
-                row = str(key)
-                for key2 in STEPS[key].keys():
-                    row += '\t' + format(STEPS[key][key2])
-                f.write(row + '\n')
+                # Fixed columns, a skipped STEP has no wait or execution time
+                row = [key, STEPS[key]['Execute'], STEPS[key]['description'],
+                       STEPS[key].get('wait_time', ''), STEPS[key].get('Time:', ''),
+                       round(saved_delays.get(key, 0), 1)]
+                f.write('\t'.join(format(value) for value in row) + '\n')
         f.close()
+        cold_chain.write(run_file('_cold_chain.txt'))
 
     ############################################################################
     # Light flash end of program
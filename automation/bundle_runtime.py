@@ -0,0 +1,56 @@
+#How to use
+#python3 bundle_runtime.py KF_config/Station_KC_qPCR_pathogen_tec.py output.py
+#
+# Copy the shared protocol runtime (functions/runtime.py) into a station
+# template. The template marks the place with a line containing only $runtime
+# inside run(); the runtime is indented to the level of that line.
+import ast
+import math
+import os
+import re
+import sys
+
+runtime_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            '..', 'functions', 'runtime.py')
+runtime_line = re.compile(r'^([ \t]*)\$runtime[ \t]*$', re.M)
+_runtime_cache = {}
+
+def read_runtime(path = runtime_path):
+    '''
+    Read the runtime once per generation, even when bundling many protocols
+    '''
+    if path not in _runtime_cache:
+        with open(path, 'rt') as f:
+            _runtime_cache[path] = f.read().rstrip('\n').split('\n')
+    return _runtime_cache[path]
+
+def bundle_runtime(data, path = runtime_path):
+    '''
+    Replace the $runtime line of a protocol with the indented runtime code
+    '''
+    if runtime_line.search(data) is None:
+        return data
+    lines = read_runtime(path)
+    def indent(match):
+        prefix = match.group(1)
+        return '\n'.join(prefix + line if line.strip() else ''
+                         for line in lines)
+    return runtime_line.sub(indent, data)
+
+def runtime_definitions(names, path = runtime_path):
+    '''
+    {name: object} of top level functions/classes of the runtime that don't
+    need the protocol context (e.g. StagePlan for the generator). Only the
+    [names] definitions are executed, with math in scope.
+    '''
+    tree = ast.parse('\n'.join(read_runtime(path)))
+    body = [node for node in tree.body if getattr(node, 'name', None) in names]
+    namespace = {'math': math}
+    exec(compile(ast.Module(body = body, type_ignores = []), path, 'exec'), namespace)
+    return {name: namespace[name] for name in names}
+
+if __name__ == '__main__':
+    with open(sys.argv[1], 'rt') as fin:
+        data = fin.read()
+    with open(sys.argv[2], 'wt') as fout:
+        fout.write(bundle_runtime(data))
@@ -1,13 +1,34 @@
 # This script aims to update and customize the protocol for each sample
 # run. Set the number of samples, date, register technician name and create
 # the directories to run
+#
+#How to use
+#python3 input_file_tecnico_macs.py (interactive, one run)
+#python3 input_file_tecnico_macs.py --batch runs.csv (all the runs of the file)
+#
+# The batch manifest is a csv with a header or a json list of objects with the
+# fields: id, num_samples, technician, protocol (KFVP or PANTHER), tube (5 or
+# 2, KFVP) and pool_size (PANTHER, samples per pool or prevalence in %, e.g.
+# 2%). Optional: excel (default muestras.xlsx), racked (KFVP, S/N: samples in
+# a 96 rack, moved by columns in station A), mmix_mode (KFVP, station C:
+# single, multi or auto) and pool_strategy (PANTHER, 'fixed' or 'balanced',
+# see pools.py, default balanced).
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import csv
+import json
 import os
 import os.path
-import pandas as pd
+import re
 import string
 import math
 import time
+import zipfile
+from bundle_runtime import bundle_runtime, runtime_definitions
+from run_layouts import load_layouts, save_layouts, count_samples
+from pools import plan_pools, parse_pool_size, write_pools, robot_pools
+from thermoqpcr_generate_template import generate_template
 homedir = os.path.expanduser("~")
 main_path = '/Volumes/opentrons/'
 code_path = main_path + 'code/covid19clinic/automation/'
@@ -15,6 +36,18 @@ code_path = main_path + 'code/covid19clinic/automation/'
 KFVP_path = code_path + 'KFVP_config/'
 panther_path = code_path + 'panther_config/'
 excel = main_path + 'barcode_template/muestras.xlsx'
+# Comments written by the protocols to the run log: 'STEP' (only step start
+# and end), 'INFO' or 'DEBUG' (pickup heights, reservoir column changes...)
+log_level = 'INFO'
+# Last pool of the PANTHER runs when the samples are not a multiple of the pool
+# size: 'balanced' (sizes differ by one sample) or 'fixed' (smaller last pool),
+# see pools.py
+pool_strategy = 'balanced'
+# Master mix of station C: 'single' well by well, 'multi' through a stage
+# column (more master mix in the tubes) or 'auto' (multi when it saves time)
+mmix_mode = 'single'
+protocol_paths = {'PANTHER': panther_path, 'KFVP': KFVP_path}
+placeholder = re.compile(r'\$(num_samples|log_level|technician|date|run_id|five_ml_rack|racked_samples|mmix_mode|pool_size|pools|THERUN)\b')
 
 # Function to distinguish between KF protocols
 def select_protocol_type(p1, p2):
@@ -33,36 +66,200 @@ def select_protocol_type(p1, p2):
             print('Please, try again')
     return pr,p
 
-def rep_data(file, n, name, f, d, run_name, five_ml_rack, pool_size):
-    d=d.replace('$num_samples', str(n))
-    d=d.replace('$technician', '\'' + str(name) + '\'')
-    d=d.replace('$date', '\'' + str(f) + '\'')
-    d=d.replace('$run_id','\'' + str(run_name) + '\'')
+def parse_template(d):
+    '''
+    Bundle the runtime and split the template in literal text (even
+    positions) and $placeholder names (odd positions), so that each run is
+    rendered with a single join
+    '''
+    return placeholder.split(bundle_runtime(d))
+
+def render_template(parts, values):
+    '''
+    Join a parsed template, placeholders without value are left as they are
+    '''
+    out=list(parts)
+    for i in range(1, len(out), 2):
+        out[i]=values.get(out[i], '$' + out[i])
+    return ''.join(out)
+
+def template_values(file, n, name, f, run_name, five_ml_rack, pool_size, log_level = log_level,
+                    pools = None, racked_samples = False, mmix_mode = mmix_mode):
+    values={'num_samples': str(n),
+            'log_level': '\'' + str(log_level) + '\'',
+            'technician': '\'' + str(name) + '\'',
+            'date': '\'' + str(f) + '\'',
+            'run_id': '\'' + str(run_name) + '\''}
     if 'SampleSetup' in file:
-        d=d.replace('$five_ml_rack', str(five_ml_rack))
+        values['five_ml_rack']=str(five_ml_rack)
+        values['racked_samples']=str(racked_samples)
+    if 'qPCR' in file:
+        values['mmix_mode']='\'' + str(mmix_mode) + '\''
     if 'pool' in file:
-            d=d.replace('$pool_size', str(pool_size))
-    return d
+        values['pool_size']=str(pool_size)
+        if pools is not None:
+            values['pools']=robot_pools(pools)
+    return values
+
+def rep_data(file, n, name, f, d, run_name, five_ml_rack, pool_size, log_level = log_level):
+    # shared functions (functions/runtime.py) inside run
+    return render_template(parse_template(d), template_values(file, n, name, f,
+                           run_name, five_ml_rack, pool_size, log_level))
+
+def read_templates(protocol_path):
+    '''
+    Read and parse the station templates (.py) and the report (.Rmd) of a
+    protocol folder once, for all the runs that use it
+    '''
+    templates=[]
+    for file in sorted(os.listdir(protocol_path)): # look for all protocols in folder
+        if (file.endswith('.py') and 'rmarkdown' not in file) or file.endswith('.Rmd'):
+            with open(protocol_path+file, "rt") as fin:
+                data=fin.read()
+            if file.endswith('.py'):
+                templates.append((file, parse_template(data)))
+            else:
+                templates.append((file, placeholder.split(data)))
+    return templates
+
+def write_file(path, data, tries = 5):
+    '''
+    Write a file in the shared folder, retrying up to [tries] times with 1 sec
+    delay
+    '''
+    for i in range(tries):
+        try:
+            with open(path, "wt") as fout:
+                fout.write(data)
+            return
+        except OSError:
+            if i == tries - 1:
+                raise
+            time.sleep(1)
+
+def run_folder(dia_registro, id, protocol):
+    #determine output path
+    run_name = str(dia_registro)+'_OT'+str(id)+'_'+protocol
+    return run_name, os.path.join(main_path+'RUNS/',run_name)
+
+def generate_run(run, templates):
+    '''
+    Create the folder of a run with its protocols, qPCR template, report and
+    volumes or pools files. [run] is a dictionary with id, num_samples (without
+    the PC in KFVP), tec_name, protocol, five_ml_rack, racked_samples,
+    mmix_mode, pool_size, pool_strategy, t_registro, dia_registro, excel and
+    layouts (parsed excel). Returns the line of the run history.
+    '''
+    id=run['id']
+    num_samples=run['num_samples']
+    protocol=run['protocol']
+    dia_registro=run['dia_registro']
+    [run_name, final_path]=run_folder(dia_registro, id, protocol)
+
+    # create folder in case it doesn't already exist and copy excel registry file there
+    if not os.path.isdir(final_path):
+        os.mkdir(final_path)
+        os.mkdir(final_path+'/scripts')
+        os.mkdir(final_path+'/results')
+        os.mkdir(final_path+'/logs')
+    os.system('cp ' + run['excel'] +' '+ final_path+'/OT'+str(id)+'_samples.xlsx')
+    # Parsed layouts for the generators, instead of reading the xlsx again
+    layouts_file = final_path+'/OT'+str(id)+'_samples.json'
+    save_layouts(run['layouts'], layouts_file)
+
+    pools=None
+    if protocol == 'PANTHER':
+        # Samples of each pool, for the pools file and the KA station
+        pools=plan_pools(run['layouts'], num_samples, run['pool_size'],
+                         run.get('pool_strategy', pool_strategy))
+    if protocol == 'KFVP':
+        file_name = 'qpcr_template_OT'+str(id)+'_'+protocol+'.txt'
+        generate_template(final_path + '/' + file_name, run['layouts']['deepwell'])
+    for file, parts in templates:
+        if file.endswith('.py'):
+            final_protocol=render_template(parts, template_values(file, num_samples,
+                run['tec_name'], run['t_registro'], run_name, run['five_ml_rack'],
+                run['pool_size'], pools = pools,
+                racked_samples = run.get('racked_samples', False),
+                mmix_mode = run.get('mmix_mode', mmix_mode))) #replace data
+            position=file.find('_',12) # find _ position after the name and get value
+            filename=str(dia_registro)+'_'+file[:position]+'_OT'+str(id)+'.py' # assign a filename date + station name + id
+            write_file(os.path.join(final_path+'/scripts/',filename), final_protocol)
+        if file.endswith('.Rmd'):
+            final_protocol=render_template(parts, {'THERUN': str(run_name)})
+            filename=str(dia_registro)+'_OT'+str(id)+'.Rmd' # assign a filename date + station name + id
+            write_file(os.path.join(final_path+'/scripts/',filename), final_protocol)
+
+    if protocol=='KFVP':
+        # Volumes for KFVP pathogen stations
+        security_volume_mmix = 50
+        security_volume_beads = 800
+        mmix_volume = 20
+        beads_volume = 20
+        isoprop_volume = 530 #It's actually a buffer, not isoprop
+        #Calculate needed volumes and wells in stations B and C
+        bead_vol = beads_volume * 8 * math.ceil(num_samples/8) * 1.1
+        isoprop_vol = isoprop_volume * 8 * math.ceil(num_samples/8) * 1.1
+        num_wells = math.ceil(num_samples / 32) #Number of wells needed
+
+        #Add security volume according to proportion
+        bead_vol = bead_vol + (security_volume_beads/(beads_volume + isoprop_volume)) * beads_volume * num_wells #Add security volume in each well
+        isoprop_vol = isoprop_vol + (security_volume_beads/(beads_volume + isoprop_volume)) * isoprop_volume * num_wells #Add security volume in each well
+        total_bead = bead_vol + isoprop_vol
+
+        mmix_vol = (num_samples * 1.1 * mmix_volume)
+        # Stage column of station C (p300 and m20 with their air gaps, as in
+        # the template): its dead volume comes from the tubes
+        stage = runtime_definitions(['divide_volume', 'StagePlan'])['StagePlan'](
+            num_samples, mmix_volume, 200, 5, 20, 2)
+        mode = run.get('mmix_mode', mmix_mode)
+        stage_vol = stage.dead_volume if mode == 'multi' or (mode == 'auto' and stage.saved_time > 0) else 0
+        mmix_vol = mmix_vol + stage_vol
+        num_wells_mmix = math.ceil(mmix_vol/2000) # Number of wells needed
+        mmix_vol = mmix_vol + (security_volume_mmix) * num_wells_mmix # Add security volume in each well
+        reac1_vol = mmix_vol / 20 * 6.25
+        reac2_vol = mmix_vol / 20 * 1.25
+        nfree_vol = mmix_vol / 20 * 12.5
+
+        #Print the information to a txt file
+        f = open(final_path + '/OT' + str(id) + "volumes.txt", "wt")
+        print('######### Station B ##########', file=f)
+        print('Volumen y localización de beads para',num_samples,'muestras', file=f)
+        print('##############################', file=f)
+        print('Nota: Es importante no vortear la mezcla de beads + buffer', file=f)
+        print('Es necesario un volumen de beads total de',format(round(total_bead)),' \u03BCl', file=f)
+        print('La proporción de reactivos es:\n', round(bead_vol),'\u03BCl de beads \n',round(isoprop_vol), '\u03BCl de buffer\n', file=f)
+        print('A dividir en',format(num_wells),'pocillos', file=f)
+        print('Volumen por pocillo:',format(round(total_bead/num_wells)),'\u03BCl', file=f)
+        print('',file=f)
+        print('######### Station C ##########', file=f)
+        print('Volumen y número tubos de MMIX para',num_samples,'muestras', file=f)
+        print('###############################', file=f)
+        print('Serán necesarios',format(round(mmix_vol)),'\u03BCl', file=f)
+        if stage_vol:
+            print('Incluye',format(round(stage_vol)),'\u03BCl de volumen muerto de la columna intermedia (modo multi)', file=f)
+        print('La proporción de reactivos es:\n', round(reac1_vol),'\u03BCl de 1-Step Multiplex Master Mix (No ROX, 4X)\n',round(reac2_vol), '\u03BCl de COVID-19 Assay Multiplex \n', round(nfree_vol),'\u03BCl de Nuclease-free water\n',file=f)
+        print('A dividir en',format(num_wells_mmix),'pocillos', file=f)
+        print('Volumen por pocillo:',format(round(mmix_vol/num_wells_mmix)),'\u03BCl', file=f)
+        f.close()
+        print('Revisa los volúmenes y pocillos necesarios en el archivo OT' + str(id) + 'volumes.txt dentro de la carpeta '+run_name)
+    elif protocol=='PANTHER':
+        write_pools(pools, final_path+'/logs/OT'+ str(id) + 'pools.txt')
+        os.system('cp '+final_path+'/logs/OT'+ str(id) + 'pools.txt '+main_path+'/Pools/')
+    return '\t'.join([run_name, str(num_samples), protocol, run['tec_name'], run['t_registro']])
+
+def write_history(lines):
+    f2 = open(main_path + 'summary/run_history.txt','a')
+    for line in lines:
+        print(line, file=f2)
+    f2.close()
 
 ###############################################################################
 def main():
 
-    # Read the excel file from the run and obtain the dictionary of samples
-    # muestras.xlsx
-    df = pd.read_excel (excel,
-     sheet_name='Deepwell layout', header = None, index_col = 0)
-    df = df.iloc[1:]
-    df_dict = df.to_dict('index')
-    merged_dict={}
-    for key in df_dict:
-        for key2 in df_dict[key]:
-            merged_dict[str(key)+format(key2)]=df_dict[key][key2]
-
-    # count number of declared elements in Dictionary
-    num_samples_control = 0
-    for elem in merged_dict.values():
-        if elem != 0:
-            num_samples_control += 1
+    # Read the excel file from the run (muestras.xlsx) once
+    layouts = load_layouts(excel)
+    num_samples_control = count_samples(layouts)
 
     # Get sample data from user
     control = False
@@ -110,35 +307,38 @@ def main():
                 control=True
             else:
                 print('Por favor, elije un valor numérico: 5 o 2: ')
+        control=False
+        while control==False:
+            answer = input('¿Muestras en gradilla de 96 (se transfieren por columnas)? Sí (S) o No (N): ')
+            if answer in ('S', 'N'):
+                racked_samples=answer=='S'
+                control=True
+            else:
+                print('Por favor, elija Sí (S) o No (N): ')
         num_samples = num_samples - 1 #Substract PC
     elif protocol== 'PANTHER':
         #Always use 2ml tubes
         five_ml_rack=True
-        answer = input('Selecciona el tamaño del pool: ')
-        pool_size=int(answer)
-        if num_samples % pool_size != 0:
-            control_answer=False
-        else:
-            control_answer=True
+        racked_samples=False
+        answer = input('Selecciona el tamaño del pool (o la prevalencia en %, p.ej. 2%): ')
+        control_answer=False
         while control_answer==False:
-            answer = input('El número de muestras no es divisible por ese tamaño de pool. Indica otro valor numérico o elige Cancelar (C): ')
-            if num_samples % int(answer) == 0:
-                pool_size=int(answer)
-                control_answer=True
-            elif answer == 'C':
+            if answer == 'C':
                 exit()
-            else:
-                print('Por favor, indica otro valor numérico o elige Cancelar (C): ')
-                control_answer=False
+            try:
+                pool_size=parse_pool_size(answer)
+                pools=plan_pools(layouts, num_samples, pool_size, pool_strategy)
+                control_answer=True
+            except ValueError as e:
+                answer = input('Tamaño de pool no válido (' + str(e) + '). Indica otro valor o elige Cancelar (C): ')
+        print('Muestras por pool: ' + ' '.join(str(len(p['samples'])) for p in pools))
 
     # Get run session ID
     control=False
     while control==False:
         id = int(input('ID run: '))
         if isinstance(id, int):
-            #determine output path
-            run_name = str(dia_registro)+'_OT'+str(id)+'_'+protocol
-            final_path=os.path.join(main_path+'RUNS/',run_name)
+            [run_name, final_path]=run_folder(dia_registro, id, protocol)
             control_answer=False
             if os.path.isdir(final_path):
             	while control_answer==False:
@@ -159,125 +359,128 @@ def main():
         else:
             print('Por favor, asigna un ID numérico para éste RUN')
 
-    # create folder in case it doesn't already exist and copy excel registry file there
-    if not os.path.isdir(final_path):
-        os.mkdir(final_path)
-        os.mkdir(final_path+'/scripts')
-        os.mkdir(final_path+'/results')
-        os.mkdir(final_path+'/logs')
-    os.system('cp ' + excel +' '+ final_path+'/OT'+str(id)+'_samples.xlsx')
+    run={'id': id, 'num_samples': num_samples, 'tec_name': tec_name,
+         'protocol': protocol, 'five_ml_rack': five_ml_rack,
+         'racked_samples': racked_samples, 'mmix_mode': mmix_mode, 'pool_size': pool_size,
+         'pool_strategy': pool_strategy, 't_registro': t_registro,
+         'dia_registro': dia_registro, 'excel': excel, 'layouts': layouts}
+    write_history([generate_run(run, read_templates(protocol_path))])
 
-    if protocol == 'KFVP':
-        file_name = 'qpcr_template_OT'+str(id)+'_'+protocol+'.txt'
-        os.system('python3 '+code_path+'thermoqpcr_generate_template.py "' + final_path + '/'+ file_name+'" "'+ final_path+'/OT'+str(id)+'_samples.xlsx"')
-    for file in os.listdir(protocol_path): # look for all protocols in folder
-        if file.endswith('.py') and 'rmarkdown' not in file:
-            fin = open(protocol_path+file, "rt") # open file and copy protocol
-            data = fin.read()
-            fin.close()
-            final_protocol=rep_data(file, num_samples, tec_name, t_registro, data, run_name, five_ml_rack, pool_size) #replace data
-            position=file.find('_',12) # find _ position after the name and get value
-            filename=str(dia_registro)+'_'+file[:position]+'_OT'+str(id)+'.py' # assign a filename date + station name + id
-            for i in range(0,5): #Try up to 5 times with 1 sec delay
-                while True:
-                    try:
-                        fout = open(os.path.join(final_path+'/scripts/',filename), "wt")
-                        fout.write(final_protocol)
-                        fout.close()
-                    except SomeSpecificException:
-                        time.sleep(1)
-                        continue
-                    break
-        if file.endswith('.Rmd'):
-            fin = open(protocol_path+file, "rt") # open file and copy protocol
-            data = fin.read()
-            fin.close()
-            final_protocol=data.replace('$THERUN', str(run_name))
-            filename=str(dia_registro)+'_OT'+str(id)+'.Rmd' # assign a filename date + station name + id
-            fout = open(os.path.join(final_path+'/scripts/',filename), "wt")
-            fout.write(final_protocol)
-            fout.close()
+###############################################################################
+def read_manifest(path):
+    '''
+    List of runs (dictionaries) of a csv or json manifest
+    '''
+    with open(path, 'rt') as f:
+        if path.endswith('.json'):
+            return json.load(f)
+        return list(csv.DictReader(f))
 
-    if protocol=='KFVP':
-        # Volumes for KFVP pathogen stations
-        security_volume_mmix = 50
-        security_volume_beads = 800
-        mmix_volume = 20
-        beads_volume = 20
-        isoprop_volume = 530 #It's actually a buffer, not isoprop
-        #Calculate needed volumes and wells in stations B and C
-        bead_vol = beads_volume * 8 * math.ceil(num_samples/8) * 1.1
-        isoprop_vol = isoprop_volume * 8 * math.ceil(num_samples/8) * 1.1
-        num_wells = math.ceil(num_samples / 32) #Number of wells needed
+def manifest_runs(rows, overwrite = False):
+    '''
+    Validate the rows of a manifest as the interactive questions do. Returns
+    the runs to generate and the errors of the rejected rows.
+    '''
+    fecha = datetime.now()
+    t_registro = fecha.strftime("%m/%d/%Y, %H:%M:%S")
+    dia_registro = fecha.strftime("%Y_%m_%d")
+    excel_layouts={}
+    runs=[]
+    errors=[]
+    folders=set() # run folders of the manifest
+    for row in rows:
+        try:
+            id=int(row['id'])
+            num_samples=int(row['num_samples'])
+            protocol=str(row['protocol']).strip().upper()
+            excel_file=row.get('excel') or excel
+            if protocol not in protocol_paths:
+                raise ValueError('protocolo desconocido: ' + protocol)
+            folder=run_folder(dia_registro, id, protocol)[1]
+            if folder in folders:
+                raise ValueError('run repetido en el manifiesto')
+            folders.add(folder)
+            if not (num_samples>0 and num_samples<=96):
+                raise ValueError('el número de muestras debe ser un número entre 1 y 96')
+            if excel_file not in excel_layouts: # each workbook is read once
+                excel_layouts[excel_file]=load_layouts(excel_file)
+            num_samples_control=count_samples(excel_layouts[excel_file])
+            if num_samples_control!=num_samples:
+                raise ValueError('el número de muestras reportadas NO coincide con plantilla Excel ('
+                                 + str(num_samples_control) + ')')
+            pool_size='NA'
+            strategy=pool_strategy
+            five_ml_rack=True
+            racked_samples=False
+            mode=mmix_mode
+            if protocol=='KFVP':
+                tube=int(row.get('tube') or 2)
+                if tube not in (5, 2):
+                    raise ValueError('el tipo de tubo debe ser 5 o 2')
+                five_ml_rack=str(tube==5)
+                racked=str(row.get('racked') or 'N').strip().upper()
+                if racked not in ('S', 'N'):
+                    raise ValueError('racked debe ser S o N')
+                racked_samples=racked=='S'
+                mode=str(row.get('mmix_mode') or mmix_mode).strip().lower()
+                if mode not in ('single', 'multi', 'auto'):
+                    raise ValueError('mmix_mode debe ser single, multi o auto')
+                num_samples=num_samples - 1 #Substract PC
+            else:
+                pool_size=parse_pool_size(row['pool_size'])
+                strategy=row.get('pool_strategy') or pool_strategy
+                plan_pools(excel_layouts[excel_file], num_samples, pool_size, strategy) # check the pools fit
+            if os.path.isdir(folder) and not overwrite:
+                raise ValueError('éste run ya existe')
+            runs.append({'id': id, 'num_samples': num_samples,
+                         'tec_name': str(row['technician']), 'protocol': protocol,
+                         'five_ml_rack': five_ml_rack, 'racked_samples': racked_samples,
+                         'mmix_mode': mode,
+                         'pool_size': pool_size, 'pool_strategy': strategy,
+                         't_registro': t_registro, 'dia_registro': dia_registro,
+                         'excel': excel_file, 'layouts': excel_layouts[excel_file]})
+        except (KeyError, ValueError, OSError, zipfile.BadZipFile) as e:
+            # OSError, BadZipFile: workbook missing or unreadable
+            errors.append('Run ' + str(row.get('id')) + ': ' + str(e))
+    return runs, errors
 
-        #Add security volume according to proportion
-        bead_vol = bead_vol + (security_volume_beads/(beads_volume + isoprop_volume)) * beads_volume * num_wells #Add security volume in each well
-        isoprop_vol = isoprop_vol + (security_volume_beads/(beads_volume + isoprop_volume)) * isoprop_volume * num_wells #Add security volume in each well
-        total_bead = bead_vol + isoprop_vol
+_templates={}
 
-        mmix_vol = (num_samples * 1.1 * mmix_volume)
-        num_wells_mmix = math.ceil(mmix_vol/2000) # Number of wells needed
-        mmix_vol = mmix_vol + (security_volume_mmix) * num_wells_mmix # Add security volume in each well
-        reac1_vol = mmix_vol / 20 * 6.25
-        reac2_vol = mmix_vol / 20 * 1.25
-        nfree_vol = mmix_vol / 20 * 12.5
+def init_worker(templates):
+    _templates.update(templates)
+
+def generate_batch_run(run):
+    return generate_run(run, _templates[run['protocol']])
+
+def batch(manifest, workers = None, overwrite = False):
+    '''
+    Generate all the runs of a manifest. The templates are read and parsed
+    once and the runs are rendered in parallel with a process pool.
+    '''
+    [runs, errors]=manifest_runs(read_manifest(manifest), overwrite)
+    for error in errors:
+        print('Error: ' + error)
+    templates={protocol: read_templates(path) for protocol, path in protocol_paths.items()
+               if any(run['protocol']==protocol for run in runs)}
+    with ProcessPoolExecutor(max_workers = workers, initializer = init_worker,
+                             initargs = (templates,)) as executor:
+        history=list(executor.map(generate_batch_run, runs))
+    write_history(history)
+    for line in history:
+        print('Generado: ' + line.split('\t')[0])
+    return not errors
 
-        #Print the information to a txt file
-        f = open(final_path + '/OT' + str(id) + "volumes.txt", "wt")
-        print('######### Station B ##########', file=f)
-        print('Volumen y localización de beads para',num_samples,'muestras', file=f)
-        print('##############################', file=f)
-        print('Nota: Es importante no vortear la mezcla de beads + buffer', file=f)
-        print('Es necesario un volumen de beads total de',format(round(total_bead)),' \u03BCl', file=f)
-        print('La proporción de reactivos es:\n', round(bead_vol),'\u03BCl de beads \n',round(isoprop_vol), '\u03BCl de buffer\n', file=f)
-        print('A dividir en',format(num_wells),'pocillos', file=f)
-        print('Volumen por pocillo:',format(round(total_bead/num_wells)),'\u03BCl', file=f)
-        print('',file=f)
-        print('######### Station C ##########', file=f)
-        print('Volumen y número tubos de MMIX para',num_samples,'muestras', file=f)
-        print('###############################', file=f)
-        print('Serán necesarios',format(round(mmix_vol)),'\u03BCl', file=f)
-        print('La proporción de reactivos es:\n', round(reac1_vol),'\u03BCl de 1-Step Multiplex Master Mix (No ROX, 4X)\n',round(reac2_vol), '\u03BCl de COVID-19 Assay Multiplex \n', round(nfree_vol),'\u03BCl de Nuclease-free water\n',file=f)
-        print('A dividir en',format(num_wells_mmix),'pocillos', file=f)
-        print('Volumen por pocillo:',format(round(mmix_vol/num_wells_mmix)),'\u03BCl', file=f)
-        f.close()
-        print('Revisa los volúmenes y pocillos necesarios en el archivo OT' + str(id) + 'volumes.txt dentro de la carpeta '+run_name)
-    elif protocol=='PANTHER':
-        # Read the excel file from the run and obtain the dictionary of pools
-        df = pd.read_excel (excel, sheet_name='Pool_rack24_layout', header = None, index_col = 0)
-        df = df.iloc[1:]
-        df_dict = df.to_dict('index')
-        merged_dict_pools={}
-        key_sorted=list()
-        for key in df_dict:
-            for key2 in df_dict[key]:
-                merged_dict_pools[str(key)+format(key2)]=df_dict[key][key2]
-        for key in merged_dict_pools:
-            key_sorted.append(key)
-            key_sorted.sort (key = lambda x: (int (x [1:]), x [0]))
-
-        # Read the excel file from the run and obtain the list of samples sorted
-        df = pd.read_excel (excel, sheet_name='Input layout', header = None, index_col = 0)
-        samples=list(df.iloc[2:][2]) #Samples as a list
-        # Assign samples to the pools
-        n_dest=0
-        i=0
-        current_pool=merged_dict_pools[key_sorted[n_dest]]
-        f3 = open(final_path+'/logs/OT'+ str(id) + "pools.txt", "wt")
-        for s in range(0, num_samples):
-            if i >= pool_size:
-                i=0
-                n_dest+=1
-                current_pool=merged_dict_pools[key_sorted[n_dest]]
-            i+=1
-            print(current_pool,samples[s], sep=',', file=f3)
-        f3.close()
-        os.system('cp '+final_path+'/logs/OT'+ str(id) + 'pools.txt '+main_path+'/Pools/')
-    f2 = open(main_path + 'summary/run_history.txt','a')
-    print(run_name, num_samples, protocol, tec_name, t_registro, sep='\t', file=f2)
-    f2.close()
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description = 'Generate the protocols of the runs')
+    parser.add_argument('--batch', help = 'csv or json manifest of runs, no questions asked')
+    parser.add_argument('--workers', type = int, default = None)
+    parser.add_argument('--overwrite', action = 'store_true', help = 'overwrite existing runs (batch)')
+    args = parser.parse_args()
+    if args.batch:
+        if not batch(args.batch, args.workers, args.overwrite):
+            exit(1)
+    else:
+        main()
     print('Success!')
 
 
@@ -25,14 +25,19 @@ metadata = {
 #Defined variables
 ##################
 NUM_SAMPLES = $num_samples
+LOG_LEVEL = $log_level # Comments in the run log: 'STEP', 'INFO' or 'DEBUG'
+TRACE = False # Record every transfer, mix and tip pick up in the _trace.bin of the run
 run_id=$run_id
 five_ml_rack = $five_ml_rack
 pool_size = $pool_size
+pools = $pools # [pool tube, number of samples] in the order of the samples (automation/pools.py)
 air_gap_vol = 15
 p_height = 15 #Sample pickup height
 
-volume_sample = (1500/pool_size)
+volume_sample = (1500/pool_size) # also in the smaller pools
+
 x_offset = [0,0]
+sample_order = 'column' # Order of the tubes in the racks: 'column', 'row' or 'serpentine'
 
 # Screwcap variables
 #diameter_screwcap = 8.25  # Diameter of the screwcap
@@ -48,7 +53,7 @@ def run(ctx: protocol_api.ProtocolContext):
     # Define the STEPS of the protocol
     STEP = 0
     STEPS = {  # Dictionary with STEP activation, description, and times
-        1: {'Execute': True, 'description': 'Add ' + str(pool_size) + ' samples into pool tubes ('+str(volume_sample)+'ul)'},
+        1: {'Execute': True, 'description': 'Add up to ' + str(pool_size) + ' samples into ' + str(len(pools)) + ' pool tubes ('+str(volume_sample)+'ul)'},
     }
     for s in STEPS:  # Create an empty wait_time
         if 'wait_time' not in STEPS[s]:
@@ -61,25 +66,7 @@ def run(ctx: protocol_api.ProtocolContext):
             os.mkdir(folder_path)
         file_path = folder_path + '/KA_SampleSetup_panther_pool_time_log.txt'
 
-    # Define Reagents as objects with their properties
-    class Reagent:
-        def __init__(self, name, flow_rate_aspirate, flow_rate_dispense, rinse,
-                     reagent_reservoir_volume, delay, num_wells, h_cono, v_fondo,
-                      tip_recycling = 'none'):
-            self.name = name
-            self.flow_rate_aspirate = flow_rate_aspirate
-            self.flow_rate_dispense = flow_rate_dispense
-            self.rinse = bool(rinse)
-            self.reagent_reservoir_volume = reagent_reservoir_volume
-            self.delay = delay
-            self.num_wells = num_wells
-            self.col = 0
-            self.vol_well = 0
-            self.h_cono = h_cono
-            self.v_cono = v_fondo
-            self.unused=[]
-            self.tip_recycling = tip_recycling
-            self.vol_well_original = reagent_reservoir_volume / num_wells
+    $runtime
 
     Samples = Reagent(name = 'Samples',
                       flow_rate_aspirate = 1,
@@ -94,115 +81,6 @@ def run(ctx: protocol_api.ProtocolContext):
 
     Samples.vol_well = 700
 
-    ##################
-    # Custom functions
-    def generate_source_table(source):
-        '''
-        Concatenate the wells from the different origin racks
-        '''
-        for rack_number in range(len(source)):
-            if rack_number == 0:
-                s = source[rack_number].wells()
-            else:
-                s = s + source[rack_number].wells()
-        return s
-
-    def move_vol_multichannel(pipet, reagent, source, dest, vol, air_gap_vol, x_offset,
-                       pickup_height, rinse, disp_height, blow_out, touch_tip):
-        '''
-        x_offset: list with two values. x_offset in source and x_offset in destination i.e. [-1,1]
-        pickup_height: height from bottom where volume
-        rinse: if True it will do 2 rounds of aspirate and dispense before the tranfer
-        disp_height: dispense height; by default it's close to the top (z=-2), but in case it is needed it can be lowered
-        blow_out, touch_tip: if True they will be done after dispensing
-        '''
-        # Rinse before aspirating
-        if rinse == True:
-            custom_mix(pipet, reagent, location = source, vol = vol,
-                       rounds = 2, blow_out = True, mix_height = 0,
-                       x_offset = x_offset)
-        # SOURCE
-        s = source.bottom(pickup_height).move(Point(x = x_offset[0]))
-        pipet.aspirate(vol, s, rate = reagent.flow_rate_aspirate)  # aspirate liquid
-        if air_gap_vol != 0:  # If there is air_gap_vol, switch pipette to slow speed
-            pipet.aspirate(air_gap_vol, source.top(z = -2),
-                           rate = reagent.flow_rate_aspirate)  # air gap
-        # GO TO DESTINATION
-        drop = dest.top(z = disp_height).move(Point(x = x_offset[1]))
-        pipet.dispense(vol + air_gap_vol, drop,
-                       rate = reagent.flow_rate_dispense)  # dispense all
-        ctx.delay(seconds = reagent.delay) # pause for x seconds depending on reagent
-        if blow_out == True:
-            pipet.blow_out(dest.top(z = -5))
-        if touch_tip == True:
-            pipet.touch_tip(radius = 0.9, speed = 20, v_offset = -5)
-
-
-    def custom_mix(pipet, reagent, location, vol, rounds, blow_out, mix_height,
-    x_offset, source_height = 3):
-        '''
-        Function for mixing a given [vol] in the same [location] a x number of [rounds].
-        blow_out: Blow out optional [True,False]
-        x_offset = [source, destination]
-        source_height: height from bottom to aspirate
-        mix_height: height from bottom to dispense
-        '''
-        if mix_height == 0:
-            mix_height = 3
-        pipet.aspirate(1, location=location.bottom(
-            z=source_height).move(Point(x=x_offset[0])), rate=reagent.flow_rate_aspirate)
-        for _ in range(rounds):
-            pipet.aspirate(vol, location=location.bottom(
-                z=source_height).move(Point(x=x_offset[0])), rate=reagent.flow_rate_aspirate)
-            pipet.dispense(vol, location=location.bottom(
-                z=mix_height).move(Point(x=x_offset[1])), rate=reagent.flow_rate_dispense)
-        pipet.dispense(1, location=location.bottom(
-            z=mix_height).move(Point(x=x_offset[1])), rate=reagent.flow_rate_dispense)
-        if blow_out == True:
-            pipet.blow_out(location.top(z=-2))  # Blow out
-
-    def calc_height(reagent, cross_section_area, aspirate_volume, min_height = 0.5):
-        nonlocal ctx
-        ctx.comment('Remaining volume ' + str(reagent.vol_well) +
-                    '< needed volume ' + str(aspirate_volume) + '?')
-        if reagent.vol_well < aspirate_volume:
-            reagent.unused.append(reagent.vol_well)
-            ctx.comment('Next column should be picked')
-            ctx.comment('Previous to change: ' + str(reagent.col))
-            # column selector position; intialize to required number
-            reagent.col = reagent.col + 1
-            ctx.comment(str('After change: ' + str(reagent.col)))
-            reagent.vol_well = reagent.vol_well_original
-            ctx.comment('New volume:' + str(reagent.vol_well))
-            height = (reagent.vol_well - aspirate_volume - reagent.v_cono) / cross_section_area
-                    #- reagent.h_cono
-            reagent.vol_well = reagent.vol_well - aspirate_volume
-            ctx.comment('Remaining volume:' + str(reagent.vol_well))
-            if height < min_height:
-                height = min_height
-            col_change = True
-        else:
-            height = (reagent.vol_well - aspirate_volume - reagent.v_cono) / cross_section_area #- reagent.h_cono
-            reagent.vol_well = reagent.vol_well - aspirate_volume
-            ctx.comment('Calculated height is ' + str(height))
-            if height < min_height:
-                height = min_height
-            ctx.comment('Used height is ' + str(height))
-            col_change = False
-        return height, col_change
-
-    ##########
-    # pick up tip and if there is none left, prompt user for a new rack
-    def pick_up(pip):
-        nonlocal tip_track
-        if not ctx.is_simulating():
-            if tip_track['counts'][pip] == tip_track['maxes'][pip]:
-                ctx.pause('Replace ' + str(pip.max_volume) + 'µl tipracks before \
-                resuming.')
-                pip.reset_tipracks()
-                tip_track['counts'][pip] = 0
-        pip.pick_up_tip()
-
     ####################################
     # load labware and modules
 
@@ -210,7 +88,7 @@ def run(ctx: protocol_api.ProtocolContext):
     # Load Sample racks
     if NUM_SAMPLES < 96:
         rack_num = math.ceil(NUM_SAMPLES / 24)
-        ctx.comment('Used source racks are ' + str(rack_num))
+        comment('INFO', 'Used source racks are {}', rack_num)
         samples_last_rack = NUM_SAMPLES - rack_num * 24
     else:
         rack_num = 4
@@ -240,9 +118,13 @@ def run(ctx: protocol_api.ProtocolContext):
     # Declare which reagents are in each reservoir as well as deepwell and elution plate
 
     # setup samples and destinations
-    sample_sources_full = generate_source_table(source_racks)
-    sample_sources = sample_sources_full[:NUM_SAMPLES]
-    destinations = dest_rack.wells()[:NUM_SAMPLES]
+    sample_sources = well_index(source_racks, sample_order)[:NUM_SAMPLES]
+    if sum(size for well, size in pools) != NUM_SAMPLES:
+        raise ValueError('The pools have ' + str(sum(size for well, size in pools)) +
+                         ' samples instead of ' + str(NUM_SAMPLES))
+    if max(size for well, size in pools) > pool_size:
+        raise ValueError('Pools of more than ' + str(pool_size) + ' samples')
+    destinations = [dest_rack[well] for well, size in pools for _ in range(size)]
 
     # p20 = ctx.load_instrument(
     # 'p20_single_gen2', mount='right', tip_racks=tips20)
@@ -255,38 +137,37 @@ def run(ctx: protocol_api.ProtocolContext):
         'maxes': {p1000: len(tips1000) * 96}  # ,p20: len(tips20)*96,
     }
 
+    # Tips of each STEP: a sample needs a fresh tip
+    tip_plan = TipPlan()
+    sample_tips = tip_plan.add(1, p1000, [(Samples, True)] * NUM_SAMPLES)
+    load_tipracks(p1000, tip_plan)
+
     ############################################################################
     # STEP 1: Add Samples
     ############################################################################
     STEP += 1
     if STEPS[STEP]['Execute'] == True:
         ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'])
-        ctx.comment('###############################################')
+        comment('DEBUG', '###############################################')
 
         # Transfer parameters
         start = datetime.now()
-        i=0
-        n_dest=0
-        for s in sample_sources:
-            if i >= pool_size:
-                n_dest+=1
-                i=0
-            d = destinations[n_dest]
-            i+=1
-            if not p1000.hw_pipette['has_tip']:
-                pick_up(p1000)
+        refill_tips(p1000, tip_plan.tips(p1000, STEP))
+        for s, d, new_tip in zip(sample_sources, destinations, sample_tips):
+            change_tip(p1000, new_tip)
 
             # Mix the sample BEFORE dispensing
             #custom_mix(p1000, reagent = Samples, location = s, vol = volume_sample, rounds = 2, blow_out = True, mix_height = 15)
             move_vol_multichannel(p1000, reagent = Samples, source = s, dest = d,
             vol=volume_sample, air_gap_vol = air_gap_vol, x_offset = x_offset,
                                pickup_height = p_height, rinse = Samples.rinse, disp_height = -10,
-                               blow_out = False, touch_tip = True)
+                               blow_out = False, touch_tip = True, touch_tip_radius = 0.9)
             # Mix the sample AFTER dispensing
             #custom_mix(p1000, reagent = Samples, location = d, vol = volume_sample, rounds = 2, blow_out = True, mix_height = 15)
-            # Drop tip and update counter
-            p1000.drop_tip()
-            tip_track['counts'][p1000] += 1
+
+        # Drop tip and update counter
+        p1000.drop_tip()
+        tip_track['counts'][p1000] += 1
 
         # Time statistics
         end = datetime.now()
@@ -295,15 +176,17 @@ def run(ctx: protocol_api.ProtocolContext):
                     ' took ' + str(time_taken))
         STEPS[STEP]['Time:'] = str(time_taken)
 
-    # Export the time log to a tsv file
+    # Export the time log to a tsv file (and the last records of the trace)
+    tracer.flush()
     if not ctx.is_simulating():
         with open(file_path, 'w') as f:
-            f.write('STEP\texecution\tdescription\twait_time\texecution_time\n')
+            f.write('STEP\texecution\tdescription\twait_time\texecution_time\tsaved_delay\n')
             for key in STEPS.keys():
-                row = str(key)
-                for key2 in STEPS[key].keys():
-                    row += '\t' + format(STEPS[key][key2])
-                f.write(row + '\n')
+                # Fixed columns, a skipped STEP has no wait or execution time
+                row = [key, STEPS[key]['Execute'], STEPS[key]['description'],
+                       STEPS[key].get('wait_time', ''), STEPS[key].get('Time:', ''),
+                       round(saved_delays.get(key, 0), 1)]
+                f.write('\t'.join(format(value) for value in row) + '\n')
         f.close()
     ############################################################################
     # Light flash end of program
@@ -0,0 +1,136 @@
+#How to use
+#python3 pools.py OT1_samples.json 96 5 [--strategy fixed] [-o OT1pools.txt]
+#python3 pools.py OT1_samples.json 96 2% (pool size from the prevalence)
+#
+# Assignment of the samples of a Panther run to the pool tubes, computed once
+# from the layouts of the run (the Pool_rack24_layout and Input layout sheets
+# of muestras.xlsx, see run_layouts.py). The generator writes the pools file of
+# the run from it and the KA station receives it serialized ($pools), so the
+# robot and the pools file can't disagree.
+#
+# Strategies for the last pool when the samples are not a multiple of the pool
+# size: 'balanced' (as many pools as 'fixed' with sizes that differ by one
+# sample at most) or 'fixed' (full pools and a smaller last one). Every sample
+# keeps the volume of a full pool (1500 ul / pool size in the KA station), so
+# the smaller pools have less volume. Pools of a single sample are rejected.
+import argparse
+import json
+import math
+
+strategies = ['fixed', 'balanced']
+max_pool_size = 10 # Largest pool size proposed from the prevalence
+
+def well_order(well):
+    # Pool tubes are filled by columns: A1, B1, C1, D1, A2...
+    return (int(well[1:]), well[0])
+
+def pool_positions(layout):
+    '''
+    [(well, pool name)] of the pool rack layout in the order the tubes are
+    filled, sorted once
+    '''
+    return sorted(layout.items(), key = lambda item: well_order(item[0]))
+
+def pool_size_for_prevalence(prevalence, max_size = max_pool_size):
+    '''
+    Pool size with the fewest expected tests per sample for two-stage
+    (Dorfman) pooling, 1/k + 1 - (1 - p)**k. ValueError when pooling doesn't
+    save tests at that prevalence (0-1).
+    '''
+    if not 0 <= prevalence < 1:
+        raise ValueError('la prevalencia debe estar entre 0 y 1')
+    best_size = 1
+    best_tests = 1
+    for k in range(2, max_size + 1):
+        tests = 1 / k + 1 - (1 - prevalence)**k
+        if tests < best_tests:
+            best_size, best_tests = k, tests
+    if best_size == 1:
+        raise ValueError('con esa prevalencia los pools no ahorran pruebas')
+    return best_size
+
+def parse_pool_size(value, max_size = max_pool_size):
+    '''
+    Pool size of an answer or manifest field: a number of samples ('5') or a
+    prevalence in % ('2%')
+    '''
+    value = str(value).strip()
+    if value.endswith('%'):
+        return pool_size_for_prevalence(float(value[:-1]) / 100, max_size)
+    return int(value)
+
+def pool_sizes(num_samples, pool_size, strategy = 'balanced'):
+    '''
+    Number of samples of each pool, none of a single sample
+    '''
+    if pool_size < 2:
+        raise ValueError('el tamaño del pool debe ser 2 o más')
+    if strategy not in strategies:
+        raise ValueError('estrategia de pools desconocida: ' + str(strategy))
+    num_pools = math.ceil(num_samples / pool_size)
+    if strategy == 'balanced':
+        size, larger = divmod(num_samples, num_pools)
+        sizes = [size + 1] * larger + [size] * (num_pools - larger)
+    else:
+        sizes = [pool_size] * (num_samples // pool_size)
+        if num_samples % pool_size:
+            sizes.append(num_samples % pool_size)
+    if sizes[-1] < 2:
+        raise ValueError('el último pool tendría una sola muestra con la estrategia ' + strategy)
+    return sizes
+
+def assign_pools(samples, positions, sizes):
+    '''
+    [{'well', 'pool', 'samples'}] of the pools: consecutive [samples] go to
+    each of the [positions] (well, pool name) with the [sizes] of the pools
+    '''
+    if len(sizes) > len(positions):
+        raise ValueError('hacen falta ' + str(len(sizes)) + ' pools y la gradilla tiene '
+                         + str(len(positions)) + ' posiciones')
+    if sum(sizes) > len(samples):
+        raise ValueError('la plantilla Excel tiene ' + str(len(samples)) + ' muestras')
+    pools = []
+    first = 0
+    for (well, name), size in zip(positions, sizes):
+        pools.append({'well': well, 'pool': name, 'samples': samples[first:first + size]})
+        first += size
+    return pools
+
+def plan_pools(layouts, num_samples, pool_size, strategy = 'balanced'):
+    '''
+    Pools of a run from its layouts (run_layouts.load_layouts)
+    '''
+    return assign_pools(layouts['samples'], pool_positions(layouts['pools']),
+                        pool_sizes(num_samples, pool_size, strategy))
+
+def write_pools(pools, path):
+    '''
+    Pools file of the run: a 'pool,sample' line per sample
+    '''
+    with open(path, 'wt') as f:
+        for pool in pools:
+            for sample in pool['samples']:
+                print(pool['pool'], sample, sep = ',', file = f)
+
+def robot_pools(pools):
+    '''
+    Pools for the KA station ($pools): [[pool tube, number of samples]] in
+    the order of the sample tubes
+    '''
+    return json.dumps([[pool['well'], len(pool['samples'])] for pool in pools])
+
+if __name__ == '__main__':
+    from run_layouts import read_layouts
+    parser = argparse.ArgumentParser(description = 'Assign the samples of a run to the pools')
+    parser.add_argument('layouts', help = 'json sidecar or xlsx of the run')
+    parser.add_argument('num_samples', type = int)
+    parser.add_argument('pool_size', help = 'samples per pool or prevalence in %% (2%%)')
+    parser.add_argument('--strategy', choices = strategies, default = 'balanced')
+    parser.add_argument('-o', '--output', help = 'write the pools file')
+    args = parser.parse_args()
+    pools = plan_pools(read_layouts(args.layouts), args.num_samples,
+                       parse_pool_size(args.pool_size), args.strategy)
+    for pool in pools:
+        print(pool['well'], pool['pool'], len(pool['samples']), sep = '\t')
+    if args.output:
+        write_pools(pools, args.output)
@@ -0,0 +1,365 @@
+# Watcher of the results folders of the runs, used by the rmarkdown_runner.py
+# of each protocol folder. A run is rendered when csv files that were not there
+# in its last render appear in RUNS/<run>/results/. The rendered runs are kept
+# in a json index, so a restart doesn't render them again. Failed renders are
+# retried with a backoff (doubled after each failure).
+#
+# Changes are detected with inotify when the inotify_simple package is
+# installed and the folder is on a local filesystem; otherwise (e.g. the SMB
+# share mounted with gvfs, where inotify doesn't see the files written by
+# other hosts) with an incremental scan that only lists the results folders
+# whose modification time changed.
+#
+# The reports are rendered by a RenderPool: a job queue served by a bounded
+# number of worker threads, with a timeout per render, retries when the output
+# shows a transient error of the share, and a status file per run
+# (RUNS/<run>/logs/report_status.txt: queued, rendering, done or failed).
+from datetime import datetime
+import json
+import os
+import queue
+import signal
+import subprocess
+import threading
+import time
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+# Filesystems where inotify sees every change
+local_filesystems = {'ext2', 'ext3', 'ext4', 'xfs', 'btrfs', 'zfs', 'f2fs', 'tmpfs', 'overlay'}
+
+
+def filesystem_type(path, mounts = '/proc/mounts'):
+    '''
+    Type of the filesystem of [path] (the mount point that contains it in
+    [mounts]), None if it can't be read (e.g. not Linux)
+    '''
+    path = os.path.realpath(path)
+    best = None
+    fstype = None
+    try:
+        with open(mounts, 'rt') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                # Spaces in mount points are escaped as \040
+                point = fields[1].replace('\\040', ' ')
+                inside = path == point or path.startswith(point.rstrip('/') + '/')
+                if inside and (best is None or len(point) > len(best)):
+                    best, fstype = point, fields[2]
+    except OSError:
+        return None
+    return fstype
+
+
+class RunIndex:
+    '''
+    Persistent {run: {'csv': [...], 'ok': bool, 'failures': n, 'time': t}} of
+    the rendered runs. A failed render is retried [retry_delay] seconds after
+    the first failure, doubled after each one up to [max_retry_delay].
+    '''
+    def __init__(self, path, retry_delay = 300, max_retry_delay = 6 * 3600):
+        self.path = path
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.runs = {}
+        self.lock = threading.Lock() # marked from the render workers
+        self.new = not os.path.isfile(path)
+        if not self.new:
+            with open(path, 'rt') as f:
+                self.runs = json.load(f)
+
+    def retry_due(self, entry, now = None):
+        delay = min(self.retry_delay * 2 ** (entry.get('failures', 1) - 1), self.max_retry_delay)
+        return (now or time.time()) - entry.get('time', 0) >= delay
+
+    def rendered(self, run, csvs, now = None):
+        '''
+        True if the [csvs] of [run] have been rendered, failed renders only
+        until their retry is due
+        '''
+        entry = self.runs.get(run)
+        if entry is None or not set(csvs) <= set(entry['csv']):
+            return False
+        return entry['ok'] or not self.retry_due(entry, now)
+
+    def failed(self, now = None):
+        '''
+        Runs with a failed render whose retry is due
+        '''
+        with self.lock:
+            return set(run for run, entry in self.runs.items()
+                       if not entry['ok'] and self.retry_due(entry, now))
+
+    def mark(self, run, csvs, ok = True):
+        with self.lock:
+            failures = 0 if ok else self.runs.get(run, {}).get('failures', 0) + 1
+            self.runs[run] = {'csv': sorted(csvs), 'ok': ok, 'failures': failures,
+                              'time': time.time()}
+            self.save()
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wt') as f:
+            json.dump(self.runs, f, indent = 1)
+        os.replace(tmp, self.path)
+
+
+class ResultsScanner:
+    '''
+    Incremental scan of the results folders. Only the folders with a new
+    modification time are listed; csv files modified less than [settle]
+    seconds ago (still being copied) are checked again in the next scan.
+    '''
+    def __init__(self, target_dir, settle = 10):
+        self.target_dir = target_dir
+        self.settle = settle
+        self.mtimes = {} # run -> mtime of its results folder
+        self.unsettled = set()
+
+    def results_dir(self, run):
+        return os.path.join(self.target_dir, run, 'results')
+
+    def csv_files(self, run):
+        '''
+        Settled csv files and html presence of a run, None if not settled yet
+        '''
+        now = time.time()
+        csvs = []
+        html = False
+        with os.scandir(self.results_dir(run)) as entries:
+            for entry in entries:
+                if entry.name.endswith('.html'):
+                    html = True
+                elif entry.name.endswith('.csv'):
+                    if now - entry.stat().st_mtime < self.settle:
+                        return None, html
+                    csvs.append(entry.name)
+        return csvs, html
+
+    def changed(self):
+        '''
+        Runs whose results folder changed (or has unsettled files) since the
+        last scan, and the runs that were removed
+        '''
+        changed = set(self.unsettled)
+        current = set()
+        with os.scandir(self.target_dir) as entries:
+            for entry in entries:
+                if not entry.is_dir():
+                    continue
+                current.add(entry.name)
+                try:
+                    mtime = os.stat(self.results_dir(entry.name)).st_mtime
+                except OSError:
+                    continue # run without results folder (yet)
+                if self.mtimes.get(entry.name) != mtime:
+                    self.mtimes[entry.name] = mtime
+                    changed.add(entry.name)
+        removed = set(self.mtimes) - current
+        for run in removed:
+            del self.mtimes[run]
+            self.unsettled.discard(run)
+        return changed & current, removed
+
+
+# Messages of the share (gvfs/SMB) going away for a moment
+transient_errors = ('Input/output error', 'Resource temporarily unavailable',
+                    'Stale file handle', 'Host is down', 'Connection timed out',
+                    'Transport endpoint is not connected')
+
+
+class RenderPool:
+    '''
+    Renders the queued runs with [workers] threads. command(run) is the
+    command line of a render; it is killed after [timeout] seconds and
+    retried up to [retries] times if it fails with a transient error.
+    '''
+    def __init__(self, command, target_dir, workers = 2, timeout = 1800,
+                 retries = 3, retry_delay = 30):
+        self.command = command
+        self.target_dir = target_dir
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.jobs = queue.Queue()
+        for i in range(workers):
+            threading.Thread(target = self.worker, daemon = True).start()
+
+    def status(self, run, state, detail = ''):
+        '''
+        Write the state of the report in the logs folder of the run
+        '''
+        line = '\t'.join([state, datetime.now().strftime('%Y/%m/%d %H:%M:%S'), detail])
+        try:
+            with open(os.path.join(self.target_dir, run, 'logs', 'report_status.txt'), 'wt') as f:
+                f.write(line + '\n')
+        except OSError:
+            pass # the status is informative, the share may be down
+        print(run + ': ' + line)
+
+    def submit(self, run, done):
+        '''
+        Queue the render of [run], done(ok) is called when it finishes
+        '''
+        self.status(run, 'queued')
+        self.jobs.put((run, done))
+
+    def execute(self, run):
+        '''
+        Run the command once, returns (ok, transient error, output)
+        '''
+        try:
+            process = subprocess.Popen(self.command(run), stdout = subprocess.PIPE,
+                                       stderr = subprocess.STDOUT,
+                                       universal_newlines = True,
+                                       start_new_session = True)
+        except OSError as e:
+            return False, True, str(e)
+        try:
+            output = process.communicate(timeout = self.timeout)[0]
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL) # Rscript is a child of the sh
+            process.communicate()
+            return False, False, 'timeout after ' + str(self.timeout) + ' s'
+        transient = any(error in output for error in transient_errors)
+        return process.returncode == 0, transient, output
+
+    def worker(self):
+        while True:
+            run, done = self.jobs.get()
+            ok = False
+            for attempt in range(1, self.retries + 2):
+                self.status(run, 'rendering', 'attempt ' + str(attempt))
+                ok, transient, output = self.execute(run)
+                if ok or not transient or attempt > self.retries:
+                    break
+                time.sleep(self.retry_delay * attempt)
+            if ok:
+                self.status(run, 'done')
+            else:
+                lines = output.strip().split('\n')
+                self.status(run, 'failed', lines[-1] if lines else '')
+            try:
+                done(ok)
+            finally:
+                self.jobs.task_done()
+
+
+class ResultsWatcher:
+    '''
+    Sends to the render [pool] every run with new csv files in its results
+    folder
+    '''
+    def __init__(self, target_dir, pool, index_path, interval = 5,
+                 rescan_interval = 600, settle = 10):
+        self.target_dir = target_dir
+        self.pool = pool
+        self.index = RunIndex(index_path)
+        self.scanner = ResultsScanner(target_dir, settle)
+        self.interval = interval # seconds between scans without inotify
+        self.rescan_interval = rescan_interval # full scans with inotify
+        self.rendering = set() # queued or rendering runs
+
+    def check(self, runs):
+        '''
+        Queue the [runs] that have csv files not rendered yet
+        '''
+        for run in sorted(runs):
+            if run in self.rendering:
+                # Checked again when it finishes, in case more csv arrive
+                self.scanner.unsettled.add(run)
+                continue
+            try:
+                csvs, html = self.scanner.csv_files(run)
+            except OSError:
+                continue
+            if csvs is None:
+                self.scanner.unsettled.add(run)
+                continue
+            self.scanner.unsettled.discard(run)
+            if not csvs or self.index.rendered(run, csvs):
+                continue
+            if self.index.new and html:
+                # First start: the runs with a report are already done
+                self.index.mark(run, csvs)
+                continue
+            self.rendering.add(run)
+            self.pool.submit(run, lambda ok, run = run, csvs = csvs: self.finished(run, csvs, ok))
+
+    def finished(self, run, csvs, ok):
+        self.index.mark(run, csvs, ok)
+        self.rendering.discard(run)
+
+    def scan(self):
+        changed, removed = self.scanner.changed()
+        for run in sorted(removed):
+            print('Folder removed: ' + run)
+        self.check(changed | self.index.failed())
+
+    def run_forever(self):
+        self.scan()
+        if self.index.new:
+            self.index.new = False
+            self.index.save()
+        fstype = filesystem_type(self.target_dir)
+        if INotify is not None and fstype not in local_filesystems:
+            print('Results on ' + str(fstype) + ', scanning every ' + str(self.interval) + ' s')
+        elif INotify is not None:
+            try:
+                self.watch_inotify()
+                return
+            except OSError as e:
+                print('inotify not available (' + str(e) + '), scanning every '
+                      + str(self.interval) + ' s')
+        while True:
+            time.sleep(self.interval)
+            self.scan()
+
+    def watch_inotify(self):
+        inotify = INotify()
+        run_mask = flags.CREATE | flags.MOVED_TO | flags.DELETE | flags.ONLYDIR
+        results_mask = flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE
+        inotify.add_watch(self.target_dir, run_mask)
+        watched = {} # watch descriptor -> run
+        def watch_run(run):
+            try:
+                wd = inotify.add_watch(self.scanner.results_dir(run), results_mask)
+            except OSError:
+                return False
+            watched[wd] = run
+            return True
+        waiting = set() # new runs without results folder yet
+        for run in self.scanner.mtimes:
+            watch_run(run)
+        last_scan = time.time()
+        while True:
+            runs = set()
+            for event in inotify.read(timeout = self.interval * 1000):
+                if event.wd in watched:
+                    if event.mask & flags.IGNORED: # results folder removed
+                        del watched[event.wd]
+                    elif event.name.endswith('.csv'):
+                        runs.add(watched[event.wd])
+                elif not event.mask & flags.ISDIR:
+                    continue
+                elif event.mask & flags.DELETE:
+                    print('Folder removed: ' + event.name)
+                    waiting.discard(event.name)
+                else:
+                    waiting.add(event.name)
+            for run in list(waiting):
+                if watch_run(run):
+                    waiting.discard(run)
+                    runs.add(run)
+            self.check(runs | self.scanner.unsettled | self.index.failed())
+            if time.time() - last_scan > self.rescan_interval:
+                # Safety net for missed events (e.g. queue overflow)
+                last_scan = time.time()
+                self.scan()
+                for run in set(self.scanner.mtimes) - set(watched.values()):
+                    watch_run(run)
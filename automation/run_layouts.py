@@ -0,0 +1,76 @@
+#How to use
+#python3 run_layouts.py muestras.xlsx OT1_samples.json
+#
+# The sample workbook (muestras.xlsx) is read once per run: the sheets used by
+# the generators are parsed into well keyed dictionaries and saved as a json
+# sidecar next to the run, so the qPCR template, pools and checks don't parse
+# the xlsx again over the shared folder.
+import json
+import math
+import sys
+
+deepwell_sheet = 'Deepwell layout'
+pools_sheet = 'Pool_rack24_layout'
+input_sheet = 'Input layout'
+
+def native(value):
+    '''
+    Python value of a cell, empty cells (NaN) are None
+    '''
+    if hasattr(value, 'item'):
+        value = value.item()
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+def well_map(df):
+    '''
+    {'A1': value, ...} of a plate/rack sheet: first row with the column
+    numbers, first column with the row letters
+    '''
+    df = df.iloc[1:]
+    df_dict = df.to_dict('index')
+    merged_dict = {}
+    for key in df_dict:
+        for key2 in df_dict[key]:
+            merged_dict[str(key)+format(key2)] = native(df_dict[key][key2])
+    return merged_dict
+
+def load_layouts(excel):
+    '''
+    Open the workbook once and parse the deepwell layout, the pool rack
+    layout and the list of samples of the input layout (when present)
+    '''
+    import pandas as pd
+    book = pd.ExcelFile(excel)
+    layouts = {'deepwell': {}, 'pools': {}, 'samples': []}
+    if deepwell_sheet in book.sheet_names:
+        layouts['deepwell'] = well_map(book.parse(deepwell_sheet, header = None, index_col = 0))
+    if pools_sheet in book.sheet_names:
+        layouts['pools'] = well_map(book.parse(pools_sheet, header = None, index_col = 0))
+    if input_sheet in book.sheet_names:
+        df = book.parse(input_sheet, header = None, index_col = 0)
+        layouts['samples'] = [native(s) for s in df.iloc[2:][2]] #Samples as a list
+    book.close()
+    return layouts
+
+def save_layouts(layouts, path):
+    with open(path, 'wt') as f:
+        json.dump(layouts, f)
+
+def read_layouts(path):
+    '''
+    Layouts of a run from its json sidecar, or from the workbook if an xlsx
+    is given
+    '''
+    if path.endswith('.json'):
+        with open(path, 'rt') as f:
+            return json.load(f)
+    return load_layouts(path)
+
+def count_samples(layouts):
+    # count number of declared elements in the deepwell layout
+    return sum(1 for elem in layouts['deepwell'].values() if elem != 0)
+
+if __name__ == '__main__':
+    save_layouts(load_layouts(sys.argv[1]), sys.argv[2])
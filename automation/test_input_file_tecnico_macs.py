@@ -0,0 +1,88 @@
+#How to use
+#python3 -m pytest automation/test_input_file_tecnico_macs.py
+import json
+import os
+import re
+import zipfile
+
+import pytest
+
+import input_file_tecnico_macs
+from input_file_tecnico_macs import (parse_template, render_template, template_values,
+                                     placeholder, manifest_runs)
+from pools import plan_pools
+
+automation_path = os.path.dirname(os.path.abspath(__file__))
+templates = [os.path.join(folder, file)
+             for folder in ('KFVP_config', 'panther_config')
+             for file in sorted(os.listdir(os.path.join(automation_path, folder)))
+             if file.startswith('Station_') and file.endswith('.py')]
+
+
+def test_parse_template():
+    parts = parse_template('n = $num_samples\nt = $technician\ncost = $5\n')
+    assert parts == ['n = ', 'num_samples', '\nt = ', 'technician', '\ncost = $5\n']
+
+
+def test_render_template():
+    parts = parse_template('NUM_SAMPLES = $num_samples\nrun = $run_id\npools = $pools\n')
+    assert render_template(parts, {'num_samples': '96', 'run_id': '\'R1\''}) == \
+        'NUM_SAMPLES = 96\nrun = \'R1\'\npools = $pools\n'
+    # The parsed template is not modified, it serves the next run
+    assert render_template(parts, {'num_samples': '8'}).startswith('NUM_SAMPLES = 8\n')
+
+
+def test_template_values():
+    values = template_values('Station_KC_qPCR_viral_path2_v2.py', 96, 'tec', '2020_11_02',
+                             'R1', 2, 4, mmix_mode = 'auto')
+    assert values['mmix_mode'] == '\'auto\''
+    assert values['num_samples'] == '96'
+    assert 'racked_samples' not in values and 'pools' not in values
+    values = template_values('Station_KA_SampleSetup_viral_path2_v1.py', 96, 'tec',
+                             '2020_11_02', 'R1', 5, 4, racked_samples = True)
+    assert values['racked_samples'] == 'True' and values['five_ml_rack'] == '5'
+
+
+@pytest.mark.parametrize('template', templates)
+def test_rendered_stations_compile(template):
+    with open(os.path.join(automation_path, template), 'rt') as f:
+        parts = parse_template(f.read())
+    layouts = {'samples': ['S' + str(n) for n in range(1, 97)],
+               'pools': {row + str(col): 'P' + str(col) + row
+                         for col in range(1, 7) for row in 'ABCD'}}
+    pools = plan_pools(layouts, 94, 4)
+    data = render_template(parts, template_values(template, 94, 'tec', '2020_11_02', 'R1',
+                                                  2, 4, pools = pools))
+    assert re.search(r'^\s*\$runtime\s*$', data, re.M) is None
+    assert placeholder.search(data) is None
+    compile(data, template, 'exec')
+    if 'panther' in template:
+        assert json.dumps([[pool['well'], len(pool['samples'])] for pool in pools]) in data
+
+
+def fake_load_layouts(path):
+    if path == 'missing.xlsx':
+        raise FileNotFoundError('No such file: ' + path)
+    if path == 'bad.xlsx':
+        raise zipfile.BadZipFile('File is not a zip file')
+    return {'deepwell': {'A' + str(col): 'S' + str(col) for col in range(1, 9)},
+            'pools': {'A1': 'P1', 'B1': 'P2'}, 'samples': ['S' + str(n) for n in range(1, 9)]}
+
+
+def test_manifest_runs(monkeypatch):
+    monkeypatch.setattr(input_file_tecnico_macs, 'load_layouts', fake_load_layouts)
+    row = {'num_samples': '8', 'protocol': 'KFVP', 'technician': 'tec', 'excel': 'ok.xlsx'}
+    rows = [dict(row, id = '1'),
+            dict(row, id = '2', excel = 'missing.xlsx'),
+            dict(row, id = '3', excel = 'bad.xlsx'),
+            dict(row, id = '1'), # same run folder as the first row
+            dict(row, id = '1', protocol = 'PANTHER', pool_size = '4'),
+            dict(row, id = '4', num_samples = '7'),
+            dict(row, id = '5', mmix_mode = 'auto', racked = 'S')]
+    runs, errors = manifest_runs(rows)
+    assert [(run['id'], run['protocol']) for run in runs] == [(1, 'KFVP'), (1, 'PANTHER'),
+                                                              (5, 'KFVP')]
+    assert runs[0]['num_samples'] == 7 # without the PC
+    assert runs[2]['mmix_mode'] == 'auto' and runs[2]['racked_samples']
+    assert [error.split(':')[0] for error in errors] == ['Run 2', 'Run 3', 'Run 1', 'Run 4']
+    assert 'repetido' in errors[2]
@@ -0,0 +1,76 @@
+#How to use
+#python3 -m pytest automation/test_pools.py
+import json
+
+import pytest
+
+from pools import (pool_sizes, pool_size_for_prevalence, parse_pool_size, assign_pools,
+                   pool_positions, plan_pools, robot_pools, write_pools)
+
+
+@pytest.mark.parametrize('num_samples, pool_size, expected', [
+    (8, 4, [4, 4]),
+    (10, 4, [4, 3, 3]),
+    (13, 3, [3, 3, 3, 2, 2]),
+    (94, 10, [10, 10, 10, 10, 9, 9, 9, 9, 9, 9])])
+def test_balanced_sizes(num_samples, pool_size, expected):
+    assert pool_sizes(num_samples, pool_size) == expected
+
+
+def test_balanced_96_by_5():
+    assert pool_sizes(96, 5) == [5] * 16 + [4] * 4
+
+
+def test_fixed_sizes():
+    assert pool_sizes(100, 5, 'fixed') == [5] * 20
+    assert pool_sizes(97, 5, 'fixed') == [5] * 19 + [2]
+    assert pool_sizes(95, 5, 'fixed') == [5] * 19
+
+
+def test_single_sample_pools_rejected():
+    # 96 = 19 x 5 + 1, the last pool would have a single sample
+    with pytest.raises(ValueError):
+        pool_sizes(96, 5, 'fixed')
+    # Pairs of an odd number of samples always leave one alone
+    with pytest.raises(ValueError):
+        pool_sizes(9, 2)
+    with pytest.raises(ValueError):
+        pool_sizes(1, 4)
+    with pytest.raises(ValueError):
+        pool_sizes(10, 1)
+    with pytest.raises(ValueError):
+        pool_sizes(10, 4, 'random')
+
+
+def test_pool_size_for_prevalence():
+    assert pool_size_for_prevalence(0.01) == 10
+    assert pool_size_for_prevalence(0.05) == 5
+    assert parse_pool_size('2%') == pool_size_for_prevalence(0.02)
+    assert parse_pool_size(' 4 ') == 4
+    with pytest.raises(ValueError):
+        pool_size_for_prevalence(0.5)
+    with pytest.raises(ValueError):
+        parse_pool_size('120%')
+
+
+def test_plan_pools(tmp_path):
+    layouts = {'samples': ['S' + str(n) for n in range(1, 11)],
+               'pools': {'A2': 'P4', 'A1': 'P1', 'B1': 'P2', 'C1': 'P3'}}
+    assert [well for well, name in pool_positions(layouts['pools'])] == ['A1', 'B1', 'C1', 'A2']
+    pools = plan_pools(layouts, 10, 4)
+    assert [len(pool['samples']) for pool in pools] == [4, 3, 3]
+    assert pools[1] == {'well': 'B1', 'pool': 'P2', 'samples': ['S5', 'S6', 'S7']}
+    assert json.loads(robot_pools(pools)) == [['A1', 4], ['B1', 3], ['C1', 3]]
+    path = tmp_path / 'OT1pools.txt'
+    write_pools(pools, str(path))
+    lines = path.read_text().splitlines()
+    assert len(lines) == 10
+    assert lines[0] == 'P1,S1' and lines[-1] == 'P3,S10'
+
+
+def test_assign_pools_errors():
+    positions = [('A1', 'P1'), ('B1', 'P2')]
+    with pytest.raises(ValueError):
+        assign_pools(['S1'] * 9, positions, [3, 3, 3])
+    with pytest.raises(ValueError):
+        assign_pools(['S1'] * 5, positions, [3, 3])
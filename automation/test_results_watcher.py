@@ -0,0 +1,42 @@
+#How to use
+#python3 -m pytest automation/test_results_watcher.py
+import time
+
+from results_watcher import RunIndex, filesystem_type, local_filesystems
+
+mounts = '''sysfs /sys sysfs rw 0 0
+/dev/sda1 / ext4 rw,relatime 0 0
+tmpfs /tmp tmpfs rw 0 0
+gvfsd-fuse /run/user/1000/gvfs fuse.gvfsd-fuse rw 0 0
+//nas/opentrons /mnt/open\\040trons cifs rw 0 0
+'''
+
+
+def test_filesystem_type(tmp_path):
+    path = tmp_path / 'mounts'
+    path.write_text(mounts)
+    assert filesystem_type('/home/user/RUNS', str(path)) == 'ext4'
+    assert filesystem_type('/mnt/open trons/RUNS', str(path)) == 'cifs'
+    assert filesystem_type('/run/user/1000/gvfs/smb-share:server=nas/RUNS', str(path)) == \
+        'fuse.gvfsd-fuse'
+    assert filesystem_type('/tmpdir', str(path)) == 'ext4'
+    assert filesystem_type('/', str(tmp_path / 'missing')) is None
+    assert 'cifs' not in local_filesystems and 'fuse.gvfsd-fuse' not in local_filesystems
+
+
+def test_run_index_retry(tmp_path):
+    index = RunIndex(str(tmp_path / 'index.json'), retry_delay = 100)
+    index.mark('run1', ['a.csv'], ok = False)
+    now = index.runs['run1']['time']
+    assert index.rendered('run1', ['a.csv'], now + 50)
+    assert not index.rendered('run1', ['a.csv'], now + 100)
+    assert index.failed(now + 100) == {'run1'}
+    # The delay doubles after each failure
+    index.mark('run1', ['a.csv'], ok = False)
+    now = index.runs['run1']['time']
+    assert index.rendered('run1', ['a.csv'], now + 150)
+    assert index.failed(now + 200) == {'run1'}
+    index.mark('run1', ['a.csv'])
+    assert index.rendered('run1', ['a.csv'], time.time() + 10**6)
+    assert not index.rendered('run1', ['a.csv', 'b.csv'])
+    assert RunIndex(index.path).runs == index.runs
@@ -0,0 +1,30 @@
+#How to use
+#python3 -m pytest automation/test_thermoqpcr_generate_template.py
+from thermoqpcr_generate_template import generate_template
+
+
+def sample_names(path):
+    '''
+    {well: sample name} of the sample lines of a plate setup
+    '''
+    names = {}
+    with open(path, 'rt', newline = '') as f:
+        for line in f:
+            assert line.endswith('\r\n')
+            fields = line.split('\t')
+            if fields[0].isdigit():
+                names.setdefault(fields[1], set()).add(fields[2])
+    return names
+
+
+def test_generate_template(tmp_path):
+    layout = {row + str(col): 0 for row in 'ABCDEFGH' for col in range(1, 13)}
+    layout.update({'A1': 'NC', 'B1': 'S1', 'C1': 1234, 'D1': None, 'H12': 'PC'})
+    out = tmp_path / 'OT1_qpcr.txt'
+    generate_template(str(out), layout)
+    names = sample_names(str(out))
+    assert names['B1'] == {'S1'} and names['C1'] == {'1234'}
+    # Empty cells of the workbook (None) and empty wells (0) stay empty
+    assert names['D1'] == {''} and names['E1'] == {''}
+    assert names['A1'] == {'NC'}
+    assert not any('None' in name or 'nan' in name for well in names for name in names[well])
@@ -0,0 +1,60 @@
+#How to use
+#python3 -m pytest automation/test_time_logs.py
+import sqlite3
+
+import pytest
+
+from time_logs import get_sec, station_name, read_time_log, collect, schema
+
+header = 'STEP\texecution\tdescription\twait_time\texecution_time\tsaved_delay\n'
+log = (header +
+       '1\tTrue\tAdd MMIX\t0\t0:06:12.500000\t12.0\n'
+       '2\tFalse\tAdd samples\t0\t\t0.0\n'
+       '3\tTrue\tAdd elution\t0\t1 day, 0:00:02\t0\n')
+# Log written before the saved_delay column
+old_log = (header +
+           '1\tTrue\tAdd MS2\t0\t0:01:00\n'
+           'end\n')
+
+
+def test_get_sec():
+    assert get_sec('0:06:12.5') == 372.5
+    assert get_sec('1 day, 2:03:04') == 86400 + 7384
+
+
+def test_station_name():
+    assert station_name('KC_qPCR_time_log.txt') == 'KC_qPCR'
+    assert station_name('KB_sample_prep_pathogen_time_log.txt') == 'KB_sample_prep_pathogen'
+    assert station_name('Station_KB_sample_prep_viral_path2_time_log.txt') == \
+        'KB_sample_prep_viral_path2'
+    # Other logs of the run folders are not time logs
+    assert station_name('Station_KB_sample_prep_pathogen_log.txt') is None
+    assert station_name('KC_qPCR_trace.bin') is None
+    assert station_name('OT1_samples.json') is None
+
+
+def test_read_time_log(tmp_path):
+    path = tmp_path / 'KC_qPCR_time_log.txt'
+    path.write_text(log)
+    assert read_time_log(str(path)) == [(1, 'Add MMIX', True, 372.5, 12.0),
+                                        (2, 'Add samples', False, None, 0),
+                                        (3, 'Add elution', True, 86402, 0.0)]
+    path.write_text(old_log)
+    assert read_time_log(str(path)) == [(1, 'Add MS2', True, 60, 0)]
+
+
+def test_collect(tmp_path):
+    run = tmp_path / '2020_11_02_OT1_KFVP'
+    (run / 'logs').mkdir(parents = True)
+    (run / 'logs' / 'KC_qPCR_time_log.txt').write_text(log)
+    (run / 'logs' / 'KB_sample_prep_pathogen_time_log.txt').write_text(old_log)
+    (run / 'logs' / 'rmarkdown_log.txt').write_text('not a time log')
+    db = sqlite3.connect(':memory:')
+    db.executescript(schema)
+    history = {'2020_11_02_OT1_KFVP': 48}
+    assert collect(db, str(tmp_path), history) == 2
+    assert sorted(db.execute('select distinct station from steps')) == \
+        [('KB_sample_prep_pathogen',), ('KC_qPCR',)]
+    assert list(db.execute('select num_samples from runs')) == [(48,)]
+    # Logs already read are not read again
+    assert collect(db, str(tmp_path), history) == 0
@@ -1,50 +1,41 @@
-import pandas as pd
+#How to use
+#python3 thermoqpcr_generate_template.py out_file.txt OT1_samples.json (or .xlsx)
+#
+# qPCR plate setup file of a run: the sample names of the deepwell layout are
+# written in the wells of the QuantStudio template, with windows line endings.
+# input_file_tecnico_macs.py imports generate_template and passes the layout
+# it already parsed.
 import string
 import os
 import os.path
 import sys
+from run_layouts import read_layouts
 
 #homedir = os.path.expanduser("~")
-out_file = sys.argv[1]
-main_path = '/Volumes/opentrons/'
-code_path = main_path + '/code/covid19clinic/automation/'
-input_file = code_path + 'qpcr_kf_template_new_machine.txt'
-excel = sys.argv[2]
+template_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'qpcr_kf_template_new_machine.txt')
+sample_lines = tuple(string.digits[1:])
 
-#Read the excel file from the run and obtain the dictionary of samples
-df = pd.read_excel (excel, sheet_name='Deepwell layout', header = None, index_col = 0)
-df = df.iloc[1:]
-df_dict = df.to_dict('index')
-merged_dict={}
-for key in df_dict:
-    for key2 in df_dict[key]:
-        merged_dict[str(key)+format(key2)]=df_dict[key][key2]
-
-#input file
-fin = open(input_file, "rt")
-#output file to write the result to
-fout = open(out_file+'_temp', "wt")
-#for each line in the input file
-
-for line in fin:
-	#read replace the string and write to output file
-    if line[0] in list(string.digits[1:]):
-    #if line[0] in list(string.ascii_uppercase[0:8]): #ABI 7500 template
-        well = line.rstrip().split('\t')[1] #Was 0 in previous template
-        if merged_dict[well] != 0 and well != 'A1' and well != 'H12':
-            fout.write(line.replace(well+'\t', well+'\t'+format(merged_dict[well])))
-        else:
+def generate_template(out_file, merged_dict, input_file = template_file):
+    '''
+    Stream the template line by line to [out_file] (CRLF), adding the sample
+    of [merged_dict] ({'A1': sample, ...}) to each used well. Controls (A1,
+    H12) and empty wells (0, or None for the empty cells of the workbook) are
+    left as in the template.
+    '''
+    #input file, output file to write the result to in windows format
+    with open(input_file, "rt") as fin, open(out_file, "wt", newline = '\r\n') as fout:
+        #for each line in the input file
+        for line in fin:
+            #read replace the string and write to output file
+            if line.startswith(sample_lines):
+            #if line[0] in list(string.ascii_uppercase[0:8]): #ABI 7500 template
+                well = line.rstrip().split('\t')[1] #Was 0 in previous template
+                sample = merged_dict.get(well)
+                if sample is not None and sample != 0 and well != 'A1' and well != 'H12':
+                    line = line.replace(well+'\t', well+'\t'+format(sample))
             fout.write(line)
-    else:
-        fout.write(line)
-
-#close input and output files
-fin.close()
-fout.close()
 
-#Transform into windows format
-WINDOWS_LINE_ENDING = b'\r\n'
-UNIX_LINE_ENDING = b'\n'
-contents = open(out_file+'_temp', 'rb').read()
-open(out_file, 'wb').write(contents.replace(UNIX_LINE_ENDING, WINDOWS_LINE_ENDING))
-os.system('rm '+out_file+'_temp')
+if __name__ == '__main__':
+    #Dictionary of samples of the run, from its json sidecar (or the excel file)
+    generate_template(sys.argv[1], read_layouts(sys.argv[2])['deepwell'])
@@ -0,0 +1,259 @@
+#How to use
+#python3 time_logs.py /Volumes/opentrons/RUNS/ time_logs.sqlite --report throughput.md
+#
+# Collects the time logs of the stations (*_time_log.txt: STEP, execution,
+# description, wait_time, execution time and saved_delay) of every run under
+# the RUNS folder into a SQLite database. Only new or modified logs are read
+# again. The number of samples of each run comes from summary/run_history.txt
+# (or the json sidecar of the run).
+#
+# The report has the percentiles of the time of each STEP per station and
+# number of samples (rounded up to full columns), and flags the STEPS that took
+# longer than the median of the previous runs of the same station and size
+# (rolling baseline) by more than a threshold.
+import argparse
+import math
+import os
+import re
+import sqlite3
+import sys
+
+from run_layouts import read_layouts, count_samples
+
+run_name = re.compile(r'^(\d{4}_\d{2}_\d{2})_OT(\d+)_')
+time_log_suffix = '_time_log.txt'
+
+schema = '''
+create table if not exists files (path text primary key, mtime real);
+create table if not exists runs (run text primary key, num_samples integer);
+create table if not exists steps (run text, station text, step integer,
+    description text, executed integer, seconds real, saved_delay real,
+    primary key (run, station, step));
+'''
+
+
+def get_sec(time_str):
+    '''
+    Seconds of a str(timedelta): '0:06:12.345678', '1 day, 2:03:04'
+    '''
+    days = 0
+    if 'day' in time_str:
+        d, time_str = time_str.split(',')
+        days = int(d.split()[0])
+    h, m, s = time_str.strip().split(':')
+    return days * 86400 + int(h) * 3600 + int(m) * 60 + float(s)
+
+
+def station_name(file):
+    '''
+    Station of a time log file name, None if the file is not a time log.
+    Some stations name it Station_<station>_time_log.txt.
+    '''
+    if not file.endswith(time_log_suffix):
+        return None
+    name = file[:-len(time_log_suffix)]
+    return name[len('Station_'):] if name.startswith('Station_') else name
+
+
+def read_time_log(path):
+    '''
+    Rows (step, description, executed, seconds, saved_delay) of a time log.
+    Steps that were not executed have no time (None). The logs written before
+    the saved_delay column have one column less.
+    '''
+    rows = []
+    with open(path, 'rt') as f:
+        f.readline() # header
+        for line in f:
+            fields = line.rstrip('\n').split('\t') + [''] * 6
+            if not fields[0].isdigit():
+                continue
+            executed = fields[1] == 'True'
+            seconds = get_sec(fields[4]) if executed and fields[4] else None
+            saved = float(fields[5]) if fields[5] else 0
+            rows.append((int(fields[0]), fields[2], executed, seconds, saved))
+    return rows
+
+
+def read_history(path):
+    '''
+    {run: num_samples} of summary/run_history.txt
+    '''
+    samples = {}
+    if os.path.isfile(path):
+        with open(path, 'rt') as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) > 1 and fields[1].isdigit():
+                    samples[fields[0]] = int(fields[1])
+    return samples
+
+
+def run_samples(runs_dir, run, history):
+    if run in history:
+        return history[run]
+    match = run_name.match(run)
+    if match:
+        sidecar = os.path.join(runs_dir, run, 'OT' + match.group(2) + '_samples.json')
+        if os.path.isfile(sidecar):
+            return count_samples(read_layouts(sidecar))
+    return None
+
+
+def collect(db, runs_dir, history):
+    '''
+    Read the new or modified time logs of runs_dir/<run>/**/ into [db].
+    Returns the number of logs read.
+    '''
+    known = dict(db.execute('select path, mtime from files'))
+    read = 0
+    for run in sorted(os.listdir(runs_dir)):
+        run_dir = os.path.join(runs_dir, run)
+        if not os.path.isdir(run_dir):
+            continue
+        for root, dirs, files in os.walk(run_dir):
+            for file in files:
+                station = station_name(file)
+                if station is None:
+                    continue
+                path = os.path.join(root, file)
+                try:
+                    mtime = os.stat(path).st_mtime
+                    if known.get(path) == mtime:
+                        continue
+                    rows = read_time_log(path)
+                except (OSError, ValueError) as e:
+                    print('Skipped ' + path + ': ' + str(e), file = sys.stderr)
+                    continue
+                db.execute('insert or replace into runs values (?, ?)',
+                           (run, run_samples(runs_dir, run, history)))
+                db.executemany('insert or replace into steps values (?, ?, ?, ?, ?, ?, ?)',
+                               [(run, station) + row for row in rows])
+                db.execute('insert or replace into files values (?, ?)', (path, mtime))
+                read += 1
+    db.commit()
+    return read
+
+
+def run_order(run):
+    match = run_name.match(run)
+    return (match.group(1), int(match.group(2))) if match else (run, 0)
+
+
+def percentile(values, p):
+    '''
+    p-th percentile (0-100) of sorted [values], linear interpolation
+    '''
+    k = (len(values) - 1) * p / 100
+    f = math.floor(k)
+    c = min(f + 1, len(values) - 1)
+    return values[f] + (values[c] - values[f]) * (k - f)
+
+
+def median(values):
+    return percentile(sorted(values), 50)
+
+
+def series(db):
+    '''
+    {(station, step, samples): [(run, seconds, description)]} of the executed
+    STEPS, runs in chronological order. Samples rounded up to full columns.
+    '''
+    data = {}
+    query = '''select s.run, s.station, s.step, s.description, s.seconds, r.num_samples
+               from steps s join runs r on s.run = r.run
+               where s.executed and s.seconds is not null'''
+    for run, station, step, description, seconds, samples in db.execute(query):
+        size = math.ceil(samples / 8) * 8 if samples else 0
+        data.setdefault((station, step, size), []).append((run, seconds, description))
+    for values in data.values():
+        values.sort(key = lambda value: run_order(value[0]))
+    return data
+
+
+def regressions(data, window = 10, threshold = 0.2, min_runs = 3):
+    '''
+    (station, step, samples, run, seconds, baseline) of the STEPS slower than
+    the median of the previous [window] runs by more than [threshold]
+    '''
+    flagged = []
+    for (station, step, size), values in sorted(data.items()):
+        for i in range(min_runs, len(values)):
+            baseline = median([seconds for run, seconds, d in values[max(0, i - window):i]])
+            run, seconds, description = values[i]
+            if seconds > baseline * (1 + threshold):
+                flagged.append((station, step, size, run, seconds, baseline))
+    return flagged
+
+
+def format_seconds(seconds):
+    return '{:d}:{:02d}:{:02d}'.format(int(seconds // 3600), int(seconds % 3600 // 60),
+                                       int(seconds % 60))
+
+
+def report(db, window = 10, threshold = 0.2):
+    '''
+    Markdown report: percentiles per station, STEP and number of samples,
+    totals per run and the flagged regressions
+    '''
+    data = series(db)
+    lines = ['# Station throughput', '',
+             '| Station | Samples | STEP | Description | Runs | p50 | p90 | p95 | Max |',
+             '|---|---|---|---|---|---|---|---|---|']
+    for (station, step, size), values in sorted(data.items()):
+        seconds = sorted(v[1] for v in values)
+        lines.append('| {} | {} | {} | {} | {} | {} | {} | {} | {} |'.format(
+            station, size or '?', step, values[-1][2], len(seconds),
+            *[format_seconds(percentile(seconds, p)) for p in (50, 90, 95, 100)]))
+    lines += ['', '## Runs', '',
+              '| Run | Station | Samples | Total | Saved delays | Samples/hour |',
+              '|---|---|---|---|---|---|']
+    query = '''select s.run, s.station, r.num_samples, sum(s.seconds), sum(s.saved_delay)
+               from steps s join runs r on s.run = r.run
+               where s.executed and s.seconds is not null group by s.run, s.station'''
+    for run, station, samples, total, saved in sorted(db.execute(query),
+                                                      key = lambda row: run_order(row[0])):
+        rate = '{:.0f}'.format(samples * 3600 / total) if samples and total else ''
+        lines.append('| {} | {} | {} | {} | {:.0f} s | {} |'.format(
+            run, station, samples or '?', format_seconds(total), saved or 0, rate))
+    flagged = regressions(data, window, threshold)
+    lines += ['', '## Regressions', '',
+              'STEPS more than {:.0f}% slower than the median of the previous {} runs'.format(
+                  threshold * 100, window), '']
+    if flagged:
+        lines += ['| Run | Station | Samples | STEP | Time | Baseline |', '|---|---|---|---|---|---|']
+        for station, step, size, run, seconds, baseline in flagged:
+            lines.append('| {} | {} | {} | {} | {} | {} |'.format(
+                run, station, size or '?', step, format_seconds(seconds),
+                format_seconds(baseline)))
+    else:
+        lines.append('None')
+    return '\n'.join(lines) + '\n'
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Collect the time logs of the runs and report the throughput')
+    parser.add_argument('runs_dir')
+    parser.add_argument('database')
+    parser.add_argument('--history', help = 'run_history.txt (default: summary/ next to the RUNS folder)')
+    parser.add_argument('--report', help = 'write the markdown report to this file (default: print it)')
+    parser.add_argument('--window', type = int, default = 10, help = 'runs of the rolling baseline')
+    parser.add_argument('--threshold', type = float, default = 0.2, help = 'slowdown flagged (0.2 = 20%%)')
+    args = parser.parse_args()
+
+    history = args.history or os.path.join(args.runs_dir, '..', 'summary', 'run_history.txt')
+    db = sqlite3.connect(args.database)
+    db.executescript(schema)
+    read = collect(db, args.runs_dir, read_history(history))
+    print(str(read) + ' time logs read', file = sys.stderr)
+    text = report(db, args.window, args.threshold)
+    if args.report:
+        with open(args.report, 'wt') as f:
+            f.write(text)
+    else:
+        print(text, end = '')
+    db.close()
+
+
+if __name__ == '__main__':
+    main()
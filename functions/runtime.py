@@ -0,0 +1,857 @@
+# Shared protocol runtime
+#
+# This file is not imported by the protocols. The OT2 needs the custom
+# functions inside run(), so automation/bundle_runtime.py copies this code
+# (indented) in place of the $runtime line of every station template when the
+# protocols of a run are generated. It relies on the names every station
+# already has in scope: ctx, Point, math, datetime, tip_track, LOG_LEVEL, TRACE,
+# STEP and, on the robot, file_path (the time log).
+#
+# Fix or speed up a helper here and every station gets it on the next run.
+
+# Comments written to the run log, LOG_LEVEL of the station selects up to which
+# level. Step start/end comments are always written (time logs, estimator).
+log_levels = {'STEP': 0, 'INFO': 1, 'DEBUG': 2}
+max_log_level = log_levels.get(LOG_LEVEL, log_levels['INFO'])
+
+def comment(level, message, *args):
+    '''
+    ctx.comment only if [level] is enabled by LOG_LEVEL. The [args] are
+    formatted into [message] ('{}') after the check, so disabled comments
+    don't build any string.
+    '''
+    if log_levels[level] <= max_log_level:
+        ctx.comment(message.format(*args) if args else message)
+
+# Opt-in tracing (TRACE = True in the station): every traced helper call is
+# stored as a binary record in a ring buffer, written at the end of each STEP
+# to <station>_trace.bin next to the time log. Read it with
+# general_scripts/read_trace.py. Record: start (monotonic s), duration (s),
+# operation, pipette channels and max volume, STEP, volume, source and dest
+# wells ((slot << 9) | (row << 5) | column, 0xFFFF if none).
+class Tracer:
+    record = '<dfBBHHfHH'
+    operations = ['pick_up', 'transfer', 'mix', 'distribute', 'multi_dispense']
+
+    def __init__(self, path, capacity = 4096):
+        import struct
+        self.path = path
+        self.packer = struct.Struct(self.record)
+        self.capacity = capacity
+        self.buffer = bytearray(self.packer.size * capacity)
+        self.written = 0 # records added
+        self.flushed = 0 # records written to the file
+        self.step = None
+
+    def well_id(self, location):
+        if location is None:
+            return 0xFFFF
+        if hasattr(location, 'point'):
+            location = getattr(location.labware, 'object', location.labware)
+        if not hasattr(location, 'well_name'):
+            return 0xFFFF
+        slot = location.parent
+        while not isinstance(slot, str):
+            slot = slot.parent # labware on a module
+        name = location.well_name
+        return (int(slot) << 9) | ((ord(name[0]) - ord('A')) << 5) | int(name[1:])
+
+    def add(self, start, duration, operation, pip, volume, source, dest):
+        if STEP != self.step:
+            self.flush() # STEP boundary
+            self.step = STEP
+        self.packer.pack_into(self.buffer, self.packer.size * (self.written % self.capacity),
+                              start, duration, self.operations.index(operation),
+                              pip.channels, int(pip.max_volume), STEP, volume or 0,
+                              self.well_id(source), self.well_id(dest))
+        self.written += 1
+
+    def flush(self):
+        '''
+        Append the records not written yet to the trace file (the oldest are
+        lost if more than [capacity] were added since the last flush)
+        '''
+        first = max(self.flushed, self.written - self.capacity)
+        if self.path is None or first == self.written:
+            self.flushed = self.written
+            return
+        size = self.packer.size
+        with open(self.path, 'ab') as f:
+            for n in range(first, self.written):
+                i = n % self.capacity
+                f.write(self.buffer[i * size:(i + 1) * size])
+        self.flushed = self.written
+
+def run_file(suffix):
+    '''
+    Path of another file of the run, next to the time log: [suffix] replaces
+    the _time_log.txt (or _log.txt) ending of file_path
+    '''
+    base = file_path[:-len('.txt')]
+    for ending in ('_time_log', '_log'):
+        if base.endswith(ending):
+            base = base[:-len(ending)]
+            break
+    return base + suffix
+
+tracer = Tracer(run_file('_trace.bin') if TRACE and not ctx.is_simulating() else None)
+
+def traced(operation, volume = None, source = None, dest = None):
+    '''
+    Decorator of the helpers that take the pipette as first argument:
+    [volume], [source] and [dest] are the names of their arguments to record.
+    Without TRACE the helper is returned as it is.
+    '''
+    def decorator(function):
+        if not TRACE:
+            return function
+        import functools
+        import inspect
+        import time
+        signature = inspect.signature(function)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.monotonic()
+            result = function(*args, **kwargs)
+            duration = time.monotonic() - start
+            arguments = signature.bind(*args, **kwargs).arguments
+            tracer.add(start, duration, operation, args[0], arguments.get(volume),
+                       arguments.get(source), arguments.get(dest))
+            return result
+        return wrapper
+    return decorator
+
+# Define Reagents as objects with their properties
+class Reagent:
+    def __init__(self, name, flow_rate_aspirate, flow_rate_dispense, rinse,
+                 reagent_reservoir_volume, delay, num_wells, h_cono, v_fondo,
+                  tip_recycling = 'none', dead_vol = 0, delay_policy = 'always'):
+        self.name = name
+        self.flow_rate_aspirate = flow_rate_aspirate
+        self.flow_rate_dispense = flow_rate_dispense
+        self.rinse = bool(rinse)
+        self.reagent_reservoir_volume = reagent_reservoir_volume
+        self.delay = delay #Delay of reagent in dispense
+        self.delay_policy = delay_policy # 'always', 'droplets' or 'overlap', see settle()
+        self.num_wells = num_wells
+        self.col = 0
+        self.vol_well = 0
+        self.h_cono = h_cono
+        self.v_cono = v_fondo
+        self.unused=[]
+        self.tip_recycling = tip_recycling
+        self.vol_well_original = reagent_reservoir_volume / num_wells
+        self.dead_vol = dead_vol # Volume per well that can not be aspirated
+        self.height_model = None # HeightModel of the reservoir, see height_model()
+
+##################
+# Custom functions
+@traced('transfer', volume = 'vol', source = 'source', dest = 'dest')
+def move_vol_multichannel(pipet, reagent, source, dest, vol, air_gap_vol, x_offset,
+                   pickup_height, rinse, disp_height, blow_out, touch_tip,
+                   touch_tip_radius = 1.0, blow_out_height = -2):
+    '''
+    x_offset: list with two values. x_offset in source and x_offset in destination i.e. [-1,1]
+    pickup_height: height from bottom where volume
+    rinse: if True it will do 2 rounds of aspirate and dispense before the tranfer
+    disp_height: dispense height; by default it's close to the top (z=-2), but in case it is needed it can be lowered
+    blow_out, touch_tip: if True they will be done after dispensing
+    touch_tip_radius, blow_out_height: radius of the touch tip and height from the top of the blow out
+    '''
+    # Rinse before aspirating
+    if rinse == True:
+        custom_mix(pipet, reagent, location = source, vol = vol,
+                   rounds = 2, blow_out = True, mix_height = 0,
+                   x_offset = x_offset)
+    # SOURCE
+    s = source.bottom(pickup_height).move(Point(x = x_offset[0]))
+    pipet.aspirate(vol, s, rate = reagent.flow_rate_aspirate)  # aspirate liquid
+    if air_gap_vol != 0:  # If there is air_gap_vol, switch pipette to slow speed
+        pipet.aspirate(air_gap_vol, source.top(z = -2),
+                       rate = reagent.flow_rate_aspirate)  # air gap
+    # GO TO DESTINATION
+    drop = dest.top(z = disp_height).move(Point(x = x_offset[1]))
+    pipet.dispense(vol + air_gap_vol, drop,
+                   rate = reagent.flow_rate_dispense)  # dispense all
+    # Blow out and touch tip are done in the destination, no move to overlap
+    settle(pipet, reagent, droplets = blow_out or touch_tip,
+           back_to = None if blow_out or touch_tip else source.top())
+    if blow_out == True:
+        pipet.blow_out(dest.top(z = blow_out_height))
+    if touch_tip == True:
+        pipet.touch_tip(radius = touch_tip_radius, speed = 20, v_offset = -5)
+
+
+# Seconds of the reagent delays saved by their delay_policy in each STEP, the
+# stations add them to the time log
+saved_delays = {}
+
+def move_time(start, end):
+    '''
+    Rough time (s) of the arc move of the gantry between two Locations
+    '''
+    safe_z = ctx.deck.highest_z + 10
+    return (math.hypot(end.point.x - start.point.x, end.point.y - start.point.y) / 400
+            + (max(safe_z - start.point.z, 0) + max(safe_z - end.point.z, 0)) / 125)
+
+def settle(pipet, reagent, droplets = True, back_to = None):
+    '''
+    Wait reagent.delay seconds after a dispense, for the liquid left in the
+    tip, as the delay_policy of the reagent says:
+    'always': the whole delay where the pipette is
+    'droplets': only if a blow out or touch tip follows ([droplets])
+    'overlap': move to [back_to] (the source) first, the move is part of
+    the delay. The whole delay if there is nowhere to go (back_to None).
+    '''
+    if not reagent.delay:
+        return
+    wait = reagent.delay
+    if reagent.delay_policy == 'droplets' and not droplets:
+        wait = 0
+    elif reagent.delay_policy == 'overlap' and back_to is not None:
+        if ctx.location_cache is not None:
+            wait = max(reagent.delay - move_time(ctx.location_cache, back_to), 0)
+        pipet.move_to(back_to)
+    if wait:
+        ctx.delay(seconds = wait) # pause for x seconds depending on reagent
+    saved_delays[STEP] = saved_delays.get(STEP, 0) + reagent.delay - wait
+
+@traced('mix', volume = 'vol', source = 'location')
+def custom_mix(pipet, reagent, location, vol, rounds, blow_out, mix_height,
+x_offset, source_height = 3):
+    '''
+    Function for mixing a given [vol] in the same [location] a x number of [rounds].
+    blow_out: Blow out optional [True,False]
+    x_offset = [source, destination]
+    source_height: height from bottom to aspirate
+    mix_height: height from bottom to dispense
+    '''
+    if mix_height == 0:
+        mix_height = 3
+    # Both locations are the same for every round, compute them once
+    aspirate_location = location.bottom(z=source_height).move(Point(x=x_offset[0]))
+    dispense_location = location.bottom(z=mix_height).move(Point(x=x_offset[1]))
+    pipet.aspirate(1, location=aspirate_location, rate=reagent.flow_rate_aspirate)
+    for _ in range(rounds):
+        pipet.aspirate(vol, location=aspirate_location, rate=reagent.flow_rate_aspirate)
+        pipet.dispense(vol, location=dispense_location, rate=reagent.flow_rate_dispense)
+    pipet.dispense(1, location=dispense_location, rate=reagent.flow_rate_dispense)
+    if blow_out == True:
+        pipet.blow_out(location.top(z=-2))  # Blow out
+
+def calc_height(reagent, cross_section_area, aspirate_volume, min_height = 0.5):
+    comment('DEBUG', 'Remaining volume {}< needed volume {}?',
+            reagent.vol_well, aspirate_volume)
+    if reagent.vol_well - reagent.dead_vol < aspirate_volume:
+        reagent.unused.append(reagent.vol_well)
+        comment('DEBUG', 'Next column should be picked')
+        comment('DEBUG', 'Previous to change: {}', reagent.col)
+        # column selector position; intialize to required number
+        reagent.col = reagent.col + 1
+        comment('DEBUG', 'After change: {}', reagent.col)
+        reagent.vol_well = reagent.vol_well_original
+        comment('DEBUG', 'New volume:{}', reagent.vol_well)
+        height = liquid_height(reagent, cross_section_area, aspirate_volume)
+        reagent.vol_well = reagent.vol_well - aspirate_volume
+        comment('DEBUG', 'Remaining volume:{}', reagent.vol_well)
+        if height < min_height:
+            height = min_height
+        col_change = True
+    else:
+        height = liquid_height(reagent, cross_section_area, aspirate_volume)
+        reagent.vol_well = reagent.vol_well - aspirate_volume
+        comment('DEBUG', 'Calculated height is {}', height)
+        if height < min_height:
+            height = min_height
+        comment('DEBUG', 'Used height is {}', height)
+        col_change = False
+    return height, col_change
+
+def liquid_height(reagent, cross_section_area, aspirate_volume):
+    '''
+    Pickup height for the liquid left after aspirating [aspirate_volume]. With
+    a height_model, the immersion depth of the model below the liquid surface,
+    otherwise from the cross section and the v_fondo of the reagent.
+    '''
+    if reagent.height_model is not None:
+        return float(reagent.height_model.pickup(reagent.vol_well - aspirate_volume))
+    return (reagent.vol_well - aspirate_volume - reagent.v_cono) / cross_section_area #- reagent.h_cono
+
+@traced('distribute', volume = 'volume', source = 'src')
+def distribute_custom(pipette, volume, src, dest, waste_pool, pickup_height,
+                      extra_dispensal, disp_height = 0, air_gap_vol = 5):
+    # Custom distribute function that allows for blow_out in different location and adjustement of touch_tip
+    pipette.aspirate((len(dest) * volume) +
+                     extra_dispensal, src.bottom(pickup_height))
+    pipette.touch_tip(speed=20, v_offset=-5)
+    pipette.move_to(src.top(z=5))
+    pipette.aspirate(air_gap_vol)  # air gap
+    for d in dest:
+        pipette.dispense(air_gap_vol, d.top())
+        drop = d.top(z = disp_height)
+        pipette.dispense(volume, drop)
+        pipette.move_to(d.top(z=5))
+        pipette.aspirate(air_gap_vol)  # air gap
+    try:
+        pipette.blow_out(waste_pool.wells()[0].bottom(pickup_height + 3))
+    except:
+        pipette.blow_out(waste_pool.bottom(pickup_height + 3))
+    return (len(dest) * volume)
+
+def plan_multi_dispense(dispenses, max_volume, air_gap_vol = 0,
+                        conditioning_vol = 0):
+    '''
+    Pack a list of (destination, volume) dispenses in as few aspirations as
+    possible. Volumes to the same consecutive destination are merged and a
+    destination is never split between two aspirations, unless it doesn't fit
+    in one: then it gets equal parts (divide_volume), one aspiration each.
+    Returns a list of aspirations, each one a list of (destination, volume)
+    '''
+    capacity = max_volume - air_gap_vol - conditioning_vol
+    merged = []
+    for dest, vol in dispenses:
+        if merged and merged[-1][0] == dest:
+            merged[-1][1] += vol
+        else:
+            merged.append([dest, vol])
+    aspirations = []
+    current = []
+    free = capacity
+    for dest, vol in merged:
+        if vol > free or vol > capacity:
+            aspirations.append(current)
+            current = []
+            free = capacity
+        if vol > capacity:
+            aspirations.extend([[(dest, part)] for part in divide_volume(vol, capacity)])
+            continue
+        current.append((dest, vol))
+        free -= vol
+    aspirations.append(current)
+    return [a for a in aspirations if a]
+
+@traced('multi_dispense', source = 'source')
+def multi_dispense(pipet, reagent, source, dispenses, air_gap_vol, x_offset,
+                   pickup_height, rinse, disp_height, blow_out, touch_tip,
+                   conditioning_vol = 0, touch_tip_radius = 1.0,
+                   cross_section_area = None, max_volume = None):
+    '''
+    Distribute a reagent from one source to several destinations with as few
+    aspirations as possible (see plan_multi_dispense). Destinations must be
+    clean as the same tip serves all of them.
+    source: a well, or the list of wells (reservoir columns) of the reagent
+    conditioning_vol: extra volume aspirated and blown out back to the source
+    so every dispense is done with a wet, primed tip
+    pickup_height: height from the bottom when cross_section_area is not given
+    rinse: if True the tip is rinsed in the source before the first aspiration
+    blow_out, touch_tip: done once after the last dispense of each aspiration
+    cross_section_area: if given, pickup height and source column are
+    calculated with calc_height
+    Returns the number of aspirations
+    '''
+    if max_volume is None:
+        max_volume = pipet.max_volume
+    sources = source if isinstance(source, list) else [source]
+    source = sources[min(reagent.col, len(sources) - 1)]
+    aspirations = plan_multi_dispense(dispenses, max_volume, air_gap_vol,
+                                      conditioning_vol)
+    for n, aspiration in enumerate(aspirations):
+        vol = sum(v for d, v in aspiration) + conditioning_vol
+        if cross_section_area is not None:
+            [height, col_change] = calc_height(reagent, cross_section_area,
+                                               vol * pipet.channels)
+            if reagent.col >= len(sources):
+                raise ValueError('Not enough ' + reagent.name + ': ' +
+                                 str(vol * pipet.channels) + ' ul needed after ' +
+                                 str(len(sources)) + ' reservoir column(s)')
+            if col_change:
+                source = sources[reagent.col]
+                comment('INFO', '{} from reservoir column {}', reagent.name, reagent.col + 1)
+        else:
+            height = pickup_height
+            if reagent.dead_vol and reagent.vol_well - vol * pipet.channels < reagent.dead_vol:
+                ctx.pause('Refill ' + reagent.name + ' before resuming.')
+                reagent.vol_well = reagent.vol_well_original
+            reagent.vol_well = reagent.vol_well - vol * pipet.channels
+        if rinse == True and n == 0:
+            custom_mix(pipet, reagent, location = source, vol = vol,
+                       rounds = 2, blow_out = True, mix_height = 0,
+                       x_offset = x_offset)
+        pipet.aspirate(vol, source.bottom(height).move(Point(x = x_offset[0])),
+                       rate = reagent.flow_rate_aspirate)
+        if air_gap_vol != 0:
+            pipet.aspirate(air_gap_vol, source.top(z = -2),
+                           rate = reagent.flow_rate_aspirate)  # air gap
+        for i, (dest, dest_vol) in enumerate(aspiration):
+            if i == 0:
+                dest_vol += air_gap_vol # air gap goes out with the first dispense
+            drop = dest.top(z = disp_height).move(Point(x = x_offset[1]))
+            pipet.dispense(dest_vol, drop, rate = reagent.flow_rate_dispense)
+        overlap = reagent.delay_policy == 'overlap'
+        if not overlap:
+            settle(pipet, reagent, droplets = blow_out or touch_tip)
+        if touch_tip == True:
+            pipet.touch_tip(radius = touch_tip_radius, speed = 20, v_offset = -5)
+        if overlap:
+            # The touch tip only wipes the outside of the tip, the delay runs
+            # on the way back to the source, where the blow out is done
+            settle(pipet, reagent, back_to = source.top(z = -2))
+        if blow_out == True:
+            # Conditioning volume goes back to the reagent
+            pipet.blow_out(source.top(z = -2))
+            reagent.vol_well = reagent.vol_well + conditioning_vol * pipet.channels
+    return len(aspirations)
+
+class HeightModel:
+    '''
+    Volume (ul) -> liquid height (mm from the bottom) of a well, tabulated once
+    from its geometry.
+    shape: 'circular' or 'rectangular' (diameter or x/y dimensions in mm)
+    bottom_shape: 'flat' (prismatic), 'v' (conical/pyramidal) or 'u' (spherical)
+    bottom_height: height of the bottom part, half the well width by default
+    bottom_volume: measured volume of the bottom part (the h_cono/v_fondo of
+    the reagents), filled as a cone of bottom_height whatever the shape
+    immersion: depth of the pickup below the liquid surface (pickup())
+    '''
+    def __init__(self, shape, depth, diameter = None, x = None, y = None,
+                 bottom_shape = 'flat', bottom_height = None, points = 500,
+                 bottom_volume = None, immersion = 0):
+        import numpy as np
+        if shape == 'circular':
+            area = math.pi * diameter**2 / 4
+            radius = diameter / 2
+        else:
+            area = x * y
+            radius = min(x, y) / 2
+        if bottom_shape == 'flat' and bottom_volume is None:
+            bottom_height = 0
+        elif bottom_height is None:
+            bottom_height = min(radius, depth)
+        heights = np.linspace(0, depth, points)
+        h = np.minimum(heights, bottom_height)
+        if bottom_volume is not None:
+            bottom = bottom_volume * (h / bottom_height)**3
+        elif bottom_shape == 'v':
+            # Cone (or pyramid) with the well section at its top
+            bottom = area * h**3 / (3 * bottom_height**2)
+        elif bottom_shape == 'u':
+            # Spherical cap scaled to the well section
+            sphere_radius = (radius**2 + bottom_height**2) / (2 * bottom_height)
+            cap = math.pi * h**2 * (3 * sphere_radius - h) / 3
+            bottom = cap * area / (math.pi * radius**2)
+        else:
+            bottom = np.zeros(points)
+        self.heights = heights
+        self.volumes = bottom + area * np.maximum(heights - bottom_height, 0)
+        self.area = area
+        self.depth = depth
+        self.bottom_height = bottom_height
+        self.immersion = immersion
+
+    def height(self, volumes):
+        '''
+        Liquid height for one volume or an array of volumes (ul)
+        '''
+        import numpy as np
+        return np.interp(volumes, self.volumes, self.heights)
+
+    def pickup(self, volumes):
+        '''
+        Aspiration height, [immersion] mm below the liquid surface (can be
+        negative, the callers clamp it to their min_height)
+        '''
+        return self.height(volumes) - self.immersion
+
+    def volume(self, heights):
+        import numpy as np
+        return np.interp(heights, self.heights, self.volumes)
+
+_height_models = {}
+
+def labware_definition(labware):
+    '''
+    Definition (the labware json) of a loaded labware
+    '''
+    if isinstance(labware, dict):
+        return labware
+    try:
+        return labware._implementation.get_definition()
+    except AttributeError:
+        return labware._definition
+
+def height_model(labware, well = None, bottom_height = None, bottom_volume = None,
+                 immersion = 3):
+    '''
+    HeightModel of a loaded labware (or a labware json dictionary), cached per
+    labware type so the table is built once per run. The bottom of the wells
+    comes from the labware definition unless bottom_height and bottom_volume
+    are given. The tip goes [immersion] mm below the surface.
+    '''
+    definition = labware_definition(labware)
+    name = definition['parameters']['loadName']
+    if well is None:
+        well = definition['ordering'][0][0]
+    key = (name, well, bottom_height, bottom_volume, immersion)
+    if key not in _height_models:
+        geometry = definition['wells'][well]
+        bottom_shape = 'flat'
+        for group in definition.get('groups', []):
+            if well in group['wells']:
+                bottom_shape = group['metadata'].get('wellBottomShape', 'flat')
+        _height_models[key] = HeightModel(geometry['shape'], geometry['depth'],
+                                          geometry.get('diameter'),
+                                          geometry.get('xDimension'),
+                                          geometry.get('yDimension'),
+                                          bottom_shape, bottom_height,
+                                          bottom_volume = bottom_volume,
+                                          immersion = immersion)
+    return _height_models[key]
+
+def plan_heights(reagent, aspirate_volumes, min_height = 0.5):
+    '''
+    Pickup heights and reservoir columns for a whole sequence of aspirations,
+    with the same column change rule as calc_height but a single table lookup.
+    Updates reagent.col and reagent.vol_well as the sequence is consumed.
+    Returns two lists: heights and columns
+    '''
+    import numpy as np
+    remaining = []
+    cols = []
+    for vol in aspirate_volumes:
+        if reagent.vol_well - reagent.dead_vol < vol:
+            reagent.unused.append(reagent.vol_well)
+            reagent.col = reagent.col + 1
+            reagent.vol_well = reagent.vol_well_original
+        reagent.vol_well = reagent.vol_well - vol
+        remaining.append(reagent.vol_well)
+        cols.append(reagent.col)
+    heights = reagent.height_model.pickup(np.array(remaining))
+    return np.maximum(heights, min_height).tolist(), cols
+
+##########
+# pick up tip and if there is none left, prompt user for a new rack
+@traced('pick_up')
+def pick_up(pip):
+    # Also when simulating: the pause shows the rack swaps in the simulation
+    if tip_track['counts'][pip] == tip_track['maxes'][pip]:
+        ctx.pause('Replace ' + str(pip.max_volume) + 'µl tipracks before \
+        resuming.')
+        pip.reset_tipracks()
+        tip_track['counts'][pip] = 0
+    pip.pick_up_tip()
+
+def plan_tips(transfers, previous = None):
+    '''
+    Decide the tip of each transfer of a STEP. [transfers] is the list of
+    (reagent, contact) of the transfers of a pipette, in order; contact is
+    True when the tip touches a sample (aspirating it or dispensing into it).
+    A tip keeps serving the next transfers of the same reagent until it
+    touches a sample. [previous] is the last (reagent, contact) of the tip the
+    pipette already has. Returns a list with True where a fresh tip is
+    mandatory.
+    '''
+    new_tips = []
+    for reagent, contact in transfers:
+        new_tips.append(previous is None or previous[1] or reagent is not previous[0])
+        previous = (reagent, contact)
+    return new_tips
+
+class TipPlan:
+    '''
+    Tips needed by each pipette in each STEP, from the transfer plans of the
+    STEPS. Tells how many racks a run needs before it starts and lets the
+    racks be replaced between STEPS instead of in the middle of one.
+    '''
+    def __init__(self):
+        self.plans = {} # (STEP, pipette) -> fresh tip of each transfer
+        self.last = {} # pipette -> last planned transfer
+
+    def add(self, step, pip, transfers, keep_tip = False):
+        '''
+        Plan the [transfers] of [pip] in [step]. keep_tip: the STEP starts
+        with the tip of the previous planned STEP of the pipette.
+        '''
+        self.plans[(step, pip)] = plan_tips(transfers, self.last.get(pip) if keep_tip else None)
+        if transfers:
+            self.last[pip] = transfers[-1]
+        return self.plans[(step, pip)]
+
+    def tips(self, pip, step = None):
+        '''
+        Tips used by [pip] in [step] (all the STEPS if None)
+        '''
+        return sum(sum(new_tips) for (s, p), new_tips in self.plans.items()
+                   if p is pip and (step is None or s == step)) * pip.channels
+
+    def racks(self, pip):
+        return math.ceil(self.tips(pip) / 96)
+
+def change_tip(pip, new_tip):
+    '''
+    Drop the used tip and pick up a fresh one if [new_tip], pick up a tip if
+    the pipette has none
+    '''
+    if new_tip and pip.hw_pipette['has_tip']:
+        pip.drop_tip()
+        tip_track['counts'][pip] += pip.channels
+    if not pip.hw_pipette['has_tip']:
+        pick_up(pip)
+
+def refill_tips(pip, needed):
+    '''
+    Replace the tipracks before a STEP that needs [needed] tips if they are
+    not left, so the run doesn't stop in the middle of the STEP
+    '''
+    if (tip_track['counts'][pip] + needed > tip_track['maxes'][pip]
+        and tip_track['counts'][pip] > 0):
+        ctx.pause('Replace ' + str(pip.max_volume) + 'µl tipracks before \
+        resuming.')
+        pip.reset_tipracks()
+        tip_track['counts'][pip] = 0
+
+def free_slots():
+    return [slot for slot in range(1, 12) if ctx.deck[slot] is None]
+
+def load_tipracks(pip, tip_plan):
+    '''
+    Load in the free slots of the deck the tipracks (same type as the first
+    one) that [pip] needs for its planned STEPS on top of the loaded ones.
+    If they don't fit, comment the rack swaps that will be needed (a STEP
+    that doesn't fit in full racks is swapped during the STEP).
+    '''
+    racks = list(pip.tip_racks)
+    for slot in free_slots()[:max(tip_plan.racks(pip) - len(racks), 0)]:
+        racks.append(ctx.load_labware(racks[0].load_name, slot, racks[0].name))
+    pip.tip_racks = racks
+    tip_track['maxes'][pip] = len(racks) * 96
+    comment('INFO', '{}µl tipracks: {} needed, {} loaded', pip.max_volume,
+            tip_plan.racks(pip), len(racks))
+    # Same rules as refill_tips and pick_up
+    count = 0
+    for step in sorted(s for s, p in tip_plan.plans if p is pip):
+        needed = tip_plan.tips(pip, step)
+        if count + needed > tip_track['maxes'][pip] and count > 0:
+            ctx.comment('Tiprack swap: replace ' + str(pip.max_volume) +
+                        'µl tipracks before STEP ' + str(step))
+            count = 0
+        count += needed
+        while count > tip_track['maxes'][pip]:
+            ctx.comment('Tiprack swap: replace ' + str(pip.max_volume) +
+                        'µl tipracks during STEP ' + str(step))
+            count -= tip_track['maxes'][pip]
+
+def start_temperature(module, celsius):
+    '''
+    Set the target of a temperature module without waiting for it
+    '''
+    if ctx.api_version >= (2, 3):
+        module.start_set_temperature(celsius)
+    else:
+        module._module.start_set_temperature(celsius) # same call, API < 2.3
+
+def await_temperature(module, celsius):
+    if ctx.api_version >= (2, 3):
+        module.await_temperature(celsius)
+    else:
+        module._module.await_temperature(celsius)
+
+class ColdChain:
+    '''
+    Minutes the temperature sensitive reagents of a run spend exposed on the
+    deck. The equilibration of the temperature [module] to [celsius] starts
+    when it is created, without waiting. A reagent on the module counts as
+    exposed while the module doesn't hold the target; the rest from the
+    moment they are placed on the deck (the start of the run). Fed by
+    step(STEP) at the end of every STEP.
+    '''
+    def __init__(self, module, celsius):
+        self.module = module
+        self.celsius = celsius
+        self.start = self.last = datetime.now()
+        self.reagents = {} # name -> [on module, budget (minutes), exposed (minutes)]
+        self.waited = 0 # seconds waiting for the module
+        self.is_ready = False
+        self.log = [] # (STEP, minutes on deck, temperature, status, exposed minutes)
+        start_temperature(module, celsius)
+
+    def status(self):
+        '''
+        Status of the module as in API 2.3 (the property is not there before)
+        '''
+        target = self.module.target
+        if target is None:
+            return 'idle'
+        if abs(target - self.module.temperature) < 0.7:
+            return 'holding at target'
+        return 'cooling' if target < self.module.temperature else 'heating'
+
+    def track(self, reagent, on_module = False, budget = None):
+        '''
+        Track [reagent]; a comment warns when it is exposed more than
+        [budget] minutes
+        '''
+        self.reagents[reagent.name] = [on_module, budget, 0]
+
+    def update(self):
+        now = datetime.now()
+        minutes = (now - self.last).total_seconds() / 60
+        self.last = now
+        holding = self.status() == 'holding at target'
+        for name, values in self.reagents.items():
+            on_module, budget, exposed = values
+            if not on_module or not holding:
+                values[2] = exposed + minutes
+                if budget is not None and exposed <= budget < values[2]:
+                    ctx.comment('WARNING: ' + name + ' has been ' + str(round(values[2])) +
+                                ' minutes out of the cold chain (budget ' + str(budget) + ')')
+
+    def wait(self):
+        '''
+        Wait until the module holds the target temperature. Returns the
+        seconds waited.
+        '''
+        self.update()
+        start = datetime.now()
+        if self.status() != 'holding at target':
+            comment('INFO', 'Waiting for the temperature module to reach {} C', self.celsius)
+            await_temperature(self.module, self.celsius)
+        waited = (datetime.now() - start).total_seconds()
+        self.waited += waited
+        return waited
+
+    def ready(self, idle = None, max_idle = 0):
+        '''
+        Call right before every access to the labware on the module: the
+        first call repeats idle() (work that doesn't need the module) up to
+        [max_idle] times while the module doesn't hold the target, and then
+        waits for it. Returns the seconds waited.
+        '''
+        if self.is_ready:
+            return 0
+        rounds = 0
+        while idle is not None and rounds < max_idle and self.status() != 'holding at target':
+            idle()
+            rounds += 1
+        self.is_ready = True
+        return self.wait()
+
+    def step(self, step):
+        self.update()
+        self.log.append((step, (self.last - self.start).total_seconds() / 60,
+                         self.module.temperature, self.status(),
+                         [values[2] for values in self.reagents.values()]))
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            f.write('\t'.join(['STEP', 'minutes_on_deck', 'temperature', 'status'] +
+                              [name + '_exposed' for name in self.reagents]) + '\n')
+            for step, minutes, temperature, status, exposed in self.log:
+                f.write('\t'.join([str(step), format(round(minutes, 1)), format(temperature), status] +
+                                  [format(round(m, 1)) for m in exposed]) + '\n')
+
+class WellIndex:
+    '''
+    Integer ids (sample order) of the wells of a list of racks, as a (n, 3)
+    array of (rack, row, col), so the well of sample i is found in O(1).
+    order: 'column' (A1, B1... as wells() rack after rack), 'row'
+    (A1, A2...) or 'serpentine' (columns alternately top-down and bottom-up,
+    the shortest moves between consecutive tubes). The order sets which tube
+    goes to which destination well, the sample layout has to follow it.
+    '''
+    orders = ('column', 'row', 'serpentine')
+
+    def __init__(self, racks, order = 'column'):
+        import numpy as np
+        if order not in self.orders:
+            raise ValueError('Unknown well order ' + str(order))
+        self.grids = [rack.rows() for rack in racks]
+        tables = []
+        for i, grid in enumerate(self.grids):
+            rows, cols = np.indices((len(grid), len(grid[0])))
+            if order == 'row':
+                rows, cols = rows.ravel(), cols.ravel()
+            else:
+                if order == 'serpentine':
+                    rows[:, 1::2] = rows[::-1, 1::2]
+                rows, cols = rows.T.ravel(), cols.T.ravel()
+            tables.append(np.stack([np.full(rows.size, i), rows, cols], axis = 1))
+        self.table = np.concatenate(tables)
+
+    def __len__(self):
+        return len(self.table)
+
+    def __getitem__(self, i):
+        '''
+        Well of sample i, or the list of wells of a slice
+        '''
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        rack, row, col = self.table[i]
+        return self.grids[rack][row][col]
+
+_well_indexes = {}
+
+def well_index(racks, order = 'column'):
+    '''
+    WellIndex of [racks], cached per run
+    '''
+    key = (tuple(id(rack) for rack in racks), order)
+    if key not in _well_indexes:
+        _well_indexes[key] = WellIndex(racks, order)
+    return _well_indexes[key]
+
+def divide_destinations(l, n):
+    # Divide the list of destinations in size n lists.
+    for i in range(0, len(l), n):
+        yield l[i:i + n]
+
+def divide_volume(volume, max_vol):
+    num_transfers=math.ceil(volume/max_vol)
+    vol_roundup=math.ceil(volume/num_transfers)
+    last_vol=volume-vol_roundup*(num_transfers-1)
+    vol_list=[vol_roundup for v in range(1,num_transfers)]
+    vol_list.append(last_vol)
+    return vol_list
+
+class StagePlan:
+    '''
+    Master mix through a stage column: the single channel fills one well per
+    row of a stage plate and the multichannel takes it to the destination
+    plate column by column. Times in seconds per transfer (as predicted by
+    general_scripts/estimate_run_time.py).
+    '''
+    def __init__(self, num_samples, volume, single_max_volume, single_air_gap,
+                 multi_max_volume, multi_air_gap, stage_well_volume = 200,
+                 stage_dead_vol = 10, single_time = 11, multi_time = 19):
+        num_cols = math.ceil(num_samples / 8)
+        self.trips = divide_volume(volume, multi_max_volume - multi_air_gap)
+        # Stage columns needed and destination columns served by each one
+        stage_cols = math.ceil(num_cols * volume / (stage_well_volume - stage_dead_vol))
+        self.stage_col = [col * stage_cols // num_cols for col in range(num_cols)]
+        self.stage_volumes = [self.stage_col.count(c) * volume + stage_dead_vol
+                              for c in range(stage_cols)]
+        self.stage_fills = [divide_volume(vol, single_max_volume - single_air_gap)
+                            for vol in self.stage_volumes]
+        # Left in the stage wells and dispensed to the empty wells of the last column
+        self.dead_volume = 8 * stage_cols * stage_dead_vol + (8 * num_cols - num_samples) * volume
+        self.single_time = num_samples * single_time
+        self.multi_time = (8 * sum(len(fill) for fill in self.stage_fills) * single_time
+                           + num_cols * len(self.trips) * multi_time)
+        self.saved_time = self.single_time - self.multi_time
+
+    def volume(self):
+        '''
+        Master mix taken from the tubes (stage wells)
+        '''
+        return 8 * sum(self.stage_volumes)
+
+def find_side(col):
+    '''
+    Detects if the current column has the magnet at its left or right side
+    '''
+    if col % 2 == 0:
+        side = -1  # left
+    else:
+        side = 1
+    return side
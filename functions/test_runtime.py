@@ -0,0 +1,308 @@
+#How to use
+#python3 -m pytest functions/test_runtime.py
+#
+# Checks of the runtime helpers that don't need the robot. runtime.py is not a
+# module (see its header), so it is executed in a namespace with the names the
+# stations give it and a fake protocol context that records the pipette moves.
+import collections
+import datetime
+import math
+import os
+
+import pytest
+
+runtime_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'runtime.py')
+Point = collections.namedtuple('Point', 'x y z', defaults = (0, 0, 0))
+
+
+class Location:
+    def __init__(self, well, z):
+        self.well = well
+        self.z = z
+
+    def move(self, point):
+        return self
+
+
+class Well:
+    def __init__(self, name):
+        self.well_name = name
+
+    def bottom(self, z = 0):
+        return Location(self, z)
+
+    def top(self, z = 0):
+        return Location(self, z)
+
+
+class Pipette:
+    def __init__(self, channels = 8, max_volume = 200):
+        self.channels = channels
+        self.max_volume = max_volume
+        self.aspirations = [] # (volume, Location)
+        self.dispenses = []
+
+    def aspirate(self, volume, location = None, rate = 1):
+        self.aspirations.append((volume, location))
+
+    def dispense(self, volume, location = None, rate = 1):
+        self.dispenses.append((volume, location))
+
+    def blow_out(self, location = None):
+        pass
+
+    def touch_tip(self, **kwargs):
+        pass
+
+    def move_to(self, location):
+        pass
+
+
+class Context:
+    location_cache = None
+
+    def __init__(self):
+        self.comments = []
+        self.pauses = []
+
+    def is_simulating(self):
+        return True
+
+    def comment(self, message):
+        self.comments.append(message)
+
+    def pause(self, message):
+        self.pauses.append(message)
+
+    def delay(self, seconds = 0):
+        pass
+
+
+def load_runtime():
+    namespace = {'ctx': Context(), 'Point': Point, 'math': math, 'datetime': datetime,
+                 'tip_track': {'counts': {}, 'maxes': {}}, 'LOG_LEVEL': 'INFO',
+                 'TRACE': False, 'STEP': 1, 'file_path': 'KB_test_time_log.txt'}
+    with open(runtime_path, 'rt') as f:
+        exec(compile(f.read(), runtime_path, 'exec'), namespace)
+    return namespace
+
+
+@pytest.fixture
+def rt():
+    return load_runtime()
+
+
+# TipPlan
+
+def test_tip_plan_reuses_tips_until_contact(rt):
+    m20 = Pipette(channels = 8)
+    p300 = Pipette(channels = 1)
+    plan = rt['TipPlan']()
+    # Master mix to clean wells with one tip, samples with a tip each
+    assert plan.add(1, m20, [('MMIX', False)] * 12) == [True] + [False] * 11
+    assert plan.add(2, m20, [('Sample', True)] * 12) == [True] * 12
+    assert plan.add(2, p300, [('Beads', False), ('Beads', False), ('Sample', True)]) == \
+        [True, False, True]
+    assert plan.tips(m20) == 13 * 8
+    assert plan.tips(m20, step = 1) == 8
+    assert plan.tips(p300) == 2
+    assert plan.racks(m20) == 2
+
+
+def test_tip_plan_keep_tip(rt):
+    m20 = Pipette(channels = 8)
+    plan = rt['TipPlan']()
+    plan.add(1, m20, [('MMIX', False)])
+    assert plan.add(2, m20, [('MMIX', False)], keep_tip = True) == [False]
+    assert plan.add(3, m20, [('Water', False)], keep_tip = True) == [True]
+    plan.add(4, m20, [('Water', True)])
+    assert plan.add(5, m20, [('Water', False)], keep_tip = True) == [True]
+
+
+def reagent(rt, volume, num_wells, dead_vol = 0):
+    r = rt['Reagent'](name = 'Elution', flow_rate_aspirate = 1, flow_rate_dispense = 1,
+                      rinse = False, reagent_reservoir_volume = volume, delay = 0,
+                      num_wells = num_wells, h_cono = 1.95, v_fondo = 695,
+                      dead_vol = dead_vol)
+    r.vol_well = r.vol_well_original
+    return r
+
+
+# plan_multi_dispense
+
+def dispensed(aspirations):
+    totals = collections.OrderedDict()
+    for aspiration in aspirations:
+        for dest, vol in aspiration:
+            totals[dest] = totals.get(dest, 0) + vol
+    return totals
+
+
+def test_plan_multi_dispense_packs_the_capacity(rt):
+    dispenses = [(col, 50) for col in range(8)]
+    aspirations = rt['plan_multi_dispense'](dispenses, 200, air_gap_vol = 10, conditioning_vol = 20)
+    assert dispensed(aspirations) == dict(dispenses)
+    assert all(sum(v for d, v in a) <= 170 for a in aspirations)
+    assert len(aspirations) == math.ceil(8 * 50 / 170)
+
+
+def test_plan_multi_dispense_merges_without_splitting(rt):
+    aspirations = rt['plan_multi_dispense']([('A', 60), ('A', 60), ('B', 150)], 200)
+    assert aspirations == [[('A', 120)], [('B', 150)]]
+
+
+def test_plan_multi_dispense_large_volume(rt):
+    aspirations = rt['plan_multi_dispense']([('B', 20), ('A', 450), ('C', 20)], 200)
+    assert aspirations == [[('B', 20)], [('A', 150)], [('A', 150)], [('A', 150)], [('C', 20)]]
+
+
+def test_plan_multi_dispense_plate_filling(rt):
+    # KB plate filling, P300 multichannel: 50 ul of elution buffer to 12 columns
+    # (air gap 5, conditioning 10) and 2 x 150 ul of wash buffer (air gap 15)
+    elution = rt['plan_multi_dispense']([(col, 50) for col in range(12)], 300,
+                                        air_gap_vol = 5, conditioning_vol = 10)
+    assert elution == [[(col, 50) for col in range(0, 5)],
+                       [(col, 50) for col in range(5, 10)],
+                       [(10, 50), (11, 50)]]
+    wash = rt['plan_multi_dispense']([(col, 150) for col in range(12) for n in range(2)],
+                                     300, air_gap_vol = 15, conditioning_vol = 10)
+    assert wash == [[(col, 150)] for col in range(12) for n in range(2)]
+
+
+# multi_dispense
+
+def test_multi_dispense_changes_column(rt):
+    pipet = Pipette()
+    elution = reagent(rt, 2 * 2000, 2)
+    sources = [Well('A1'), Well('A2')]
+    dests = [Well('A' + str(col)) for col in range(1, 9)]
+    n = rt['multi_dispense'](pipet, elution, sources, [(d, 50) for d in dests],
+                             air_gap_vol = 0, x_offset = [0, 0], pickup_height = 20,
+                             rinse = False, disp_height = -2, blow_out = False,
+                             touch_tip = False, cross_section_area = 8.2 * 71.2)
+    assert n == 2
+    # 1600 ul per aspiration of the 8 channels, the second one from the next column
+    assert [loc.well for v, loc in pipet.aspirations] == sources
+    assert elution.col == 1
+    assert elution.vol_well == 2000 - 1600
+    # The height comes from the liquid left, not from pickup_height
+    assert all(loc.z < 20 for v, loc in pipet.aspirations)
+
+
+def test_multi_dispense_not_enough_reagent(rt):
+    pipet = Pipette()
+    elution = reagent(rt, 2000, 1)
+    with pytest.raises(ValueError, match = 'Not enough Elution'):
+        rt['multi_dispense'](pipet, elution, Well('A1'), [(Well('A' + str(col)), 50)
+                                                            for col in range(1, 9)],
+                             air_gap_vol = 0, x_offset = [0, 0], pickup_height = 1,
+                             rinse = False, disp_height = -2, blow_out = False,
+                             touch_tip = False, cross_section_area = 8.2 * 71.2)
+    assert len(pipet.aspirations) == 1
+
+
+def test_multi_dispense_fixed_height_refill(rt):
+    pipet = Pipette()
+    elution = reagent(rt, 2000, 1, dead_vol = 300)
+    rt['multi_dispense'](pipet, elution, Well('A1'), [(Well('A' + str(col)), 50)
+                                                      for col in range(1, 9)],
+                         air_gap_vol = 0, x_offset = [0, 0], pickup_height = 1,
+                         rinse = False, disp_height = -2, blow_out = False,
+                         touch_tip = False)
+    assert [loc.z for v, loc in pipet.aspirations] == [1, 1]
+    assert len(rt['ctx'].pauses) == 1
+
+
+# calc_height
+
+def test_calc_height_keeps_dead_volume(rt):
+    elution = reagent(rt, 2 * 2000, 2, dead_vol = 300)
+    height, col_change = rt['calc_height'](elution, 8.2 * 71.2, 1600)
+    assert not col_change
+    height, col_change = rt['calc_height'](elution, 8.2 * 71.2, 200)
+    assert col_change and elution.col == 1
+    assert height >= 0.5
+
+
+# HeightModel
+
+def test_height_model_flat_cylinder(rt):
+    model = rt['HeightModel']('circular', 40, diameter = 10)
+    area = math.pi * 25
+    assert float(model.height(area * 12)) == pytest.approx(12, abs = 0.1)
+    assert float(model.volume(model.height(1000))) == pytest.approx(1000, rel = 1e-3)
+
+
+def test_height_model_cone_bottom(rt):
+    model = rt['HeightModel']('rectangular', 26.85, x = 8.2, y = 71.2,
+                              bottom_shape = 'v', bottom_height = 2)
+    area = 8.2 * 71.2
+    assert float(model.volume(2)) == pytest.approx(area * 2 / 3, rel = 1e-2)
+    assert float(model.height(area * 2 / 3 + area * 10)) == pytest.approx(12, abs = 0.1)
+
+
+def test_height_model_pickup_below_surface(rt):
+    model = rt['HeightModel']('circular', 42, diameter = 8.5, bottom_shape = 'v',
+                              immersion = 3)
+    assert float(model.pickup(1000)) == pytest.approx(float(model.height(1000)) - 3)
+
+
+@pytest.mark.parametrize('geometry, area, h_cono, v_cono, max_volume', [
+    # nest_12_reservoir_15ml with the h_cono/v_fondo of the reagents
+    (dict(shape = 'rectangular', depth = 26.85, x = 8.2, y = 71.2, bottom_shape = 'v'),
+     8.2 * 71.2, 1.95, 695, 15000),
+    # 2 ml screwcap of the master mix
+    (dict(shape = 'circular', depth = 42, diameter = 8.5, bottom_shape = 'v'),
+     math.pi * 8.25**2 / 4, 50 * 3 / (math.pi * 8.25**2 / 4), 50, 2000)])
+def test_height_model_not_above_cross_section_height(rt, geometry, area, h_cono, v_cono,
+                                                      max_volume):
+    '''
+    The pickup heights of the model are never above the ones of the cross
+    section formula they replace, clamped to the same min_height
+    '''
+    model = rt['HeightModel'](bottom_height = h_cono, bottom_volume = v_cono,
+                              immersion = 3, **geometry)
+    for volume in range(0, max_volume + 1, 10):
+        old = max((volume - v_cono) / area, 0.5)
+        assert max(float(model.pickup(volume)), 0.5) <= old + 1e-6
+
+
+def test_height_model_cache(rt):
+    definition = {'parameters': {'loadName': 'nest_12_reservoir_15ml'},
+                  'ordering': [['A1']],
+                  'wells': {'A1': {'shape': 'rectangular', 'depth': 26.85,
+                                   'xDimension': 8.2, 'yDimension': 71.2}},
+                  'groups': [{'wells': ['A1'], 'metadata': {'wellBottomShape': 'v'}}]}
+    model = rt['height_model'](definition, bottom_height = 1.95, bottom_volume = 695)
+    assert rt['height_model'](definition, bottom_height = 1.95, bottom_volume = 695) is model
+    assert rt['height_model'](definition, bottom_height = 1.95, bottom_volume = 695,
+                              immersion = 0) is not model
+    assert float(model.volume(1.95)) == pytest.approx(695, rel = 1e-2)
+
+
+# StagePlan
+
+def test_divide_volume(rt):
+    assert rt['divide_volume'](20, 18) == [10, 10]
+    assert rt['divide_volume'](450, 180) == [150, 150, 150]
+    assert sum(rt['divide_volume'](101, 30)) == 101
+
+
+@pytest.mark.parametrize('num_samples', [8, 20, 95, 96])
+def test_stage_plan_volume(rt, num_samples):
+    stage = rt['StagePlan'](num_samples, 20, 200, 5, 20, 2)
+    num_cols = math.ceil(num_samples / 8)
+    assert len(stage.stage_col) == num_cols
+    assert all(vol <= 200 for vol in stage.stage_volumes)
+    # Every destination column served, the stage volume is the mix plus the dead volume
+    assert sorted(set(stage.stage_col)) == list(range(len(stage.stage_volumes)))
+    assert stage.volume() == num_samples * 20 + stage.dead_volume
+    assert stage.trips == [10, 10]
+
+
+def test_stage_plan_saved_time(rt):
+    stage = rt['StagePlan'](96, 20, 200, 5, 20, 2)
+    assert stage.dead_volume == 8 * 2 * 10
+    assert stage.single_time == 96 * 11
+    assert stage.saved_time == stage.single_time - stage.multi_time > 0
+    assert rt['StagePlan'](8, 20, 200, 5, 20, 2).saved_time < 0
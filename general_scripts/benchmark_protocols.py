@@ -0,0 +1,170 @@
+#How to use
+#python3 benchmark_protocols.py -n 8 24 48 96 --history benchmark_history.json
+#
+# Simulation benchmark of every station: the protocols of Kingfisher_protocols/,
+# Panther_pools_protocols/ and automation/*_config/ (placeholders filled as in
+# estimate_run_time.py) are simulated for each number of samples, one process
+# per run. For each run it records the wall time of the simulator, the number
+# of commands and tips, the robot time predicted by the estimator and the peak
+# memory, appends them to a JSON history and prints the change against the
+# previous entry, so the effect of a change of functions/runtime.py shows up
+# before it reaches the robots.
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+from estimate_run_time import (MotionModel, simulate_protocol, estimate_commands,
+                               load_labware_definitions, labware_path, format_seconds)
+
+repo_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+protocol_globs = ['Kingfisher_protocols/*/Station*.py',
+                  'Panther_pools_protocols/*/Station*.py',
+                  'automation/*_config/Station*.py']
+
+
+def find_protocols():
+    protocols = []
+    for pattern in protocol_globs:
+        protocols += sorted(glob.glob(os.path.join(repo_path, pattern)))
+    return protocols
+
+
+def peak_memory_mb():
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes in linux, bytes in macOS
+    return peak / 1024**2 if sys.platform == 'darwin' else peak / 1024
+
+
+def measure(protocol, num_samples, labware, results):
+    '''
+    Simulate one run (in its own process, for the peak memory) and put its
+    measures in the [results] queue
+    '''
+    measures = {'protocol': os.path.relpath(protocol, repo_path), 'num_samples': num_samples}
+    try:
+        start = time.perf_counter()
+        ctx, recorder = simulate_protocol(protocol, num_samples, load_labware_definitions(labware))
+        measures['wall_time'] = time.perf_counter() - start
+        model = MotionModel()
+        commands = tips = predicted = 0
+        for step_commands in recorder.steps.values():
+            seconds, counts, pauses = estimate_commands(step_commands, model)
+            predicted += seconds
+            commands += sum(counts.values())
+            tips += counts.get('PICK_UP_TIP', 0)
+        measures.update({'commands': commands, 'tips': tips, 'predicted_time': predicted})
+        if not commands:
+            # e.g. the robot only gpio import of the stations that switch the lights at the start
+            measures['error'] = 'no commands recorded'
+    except Exception as e:
+        measures['error'] = type(e).__name__ + ': ' + ' '.join(str(e).split())[:200]
+    measures['peak_memory_mb'] = peak_memory_mb()
+    results.put(measures)
+
+
+def run_benchmark(protocols, sizes, labware = labware_path, timeout = 900):
+    context = multiprocessing.get_context('spawn') # clean interpreter for each run
+    runs = []
+    for protocol in protocols:
+        for n in sizes:
+            results = context.Queue()
+            process = context.Process(target = measure, args = (protocol, n, labware, results))
+            process.start()
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+                measures = {'protocol': os.path.relpath(protocol, repo_path), 'num_samples': n,
+                            'error': 'timeout after ' + str(timeout) + ' s'}
+            else:
+                try:
+                    measures = results.get(timeout = 10)
+                except queue.Empty: # the process died
+                    measures = {'protocol': os.path.relpath(protocol, repo_path), 'num_samples': n,
+                                'error': 'exit code ' + str(process.exitcode)}
+            print_measures(measures)
+            runs.append(measures)
+    return runs
+
+
+def print_measures(m):
+    if 'error' in m:
+        print(m['protocol'], m['num_samples'], 'ERROR ' + m['error'], sep = '\t', file = sys.stderr)
+        return
+    print(m['protocol'], m['num_samples'], '{:.1f} s'.format(m['wall_time']), m['commands'],
+          m['tips'], format_seconds(m['predicted_time']), '{:.0f} MB'.format(m['peak_memory_mb']),
+          sep = '\t', file = sys.stderr)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd = repo_path,
+                                       universal_newlines = True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def read_history(path):
+    if path and os.path.isfile(path):
+        with open(path, 'rt') as f:
+            return json.load(f)
+    return []
+
+
+def compare(previous, current):
+    '''
+    Lines with the changes of predicted time, tips and wall time of the runs
+    measured in both entries
+    '''
+    before = {(r['protocol'], r['num_samples']): r for r in previous['runs'] if 'error' not in r}
+    lines = []
+    for r in current['runs']:
+        old = before.get((r['protocol'], r['num_samples']))
+        if old is None or 'error' in r:
+            continue
+        delta = r['predicted_time'] - old['predicted_time']
+        if abs(delta) >= 1 or r['tips'] != old['tips']:
+            lines.append('\t'.join([r['protocol'], str(r['num_samples']),
+                                    '{:+.0f} s robot'.format(delta),
+                                    '{:+d} tips'.format(r['tips'] - old['tips']),
+                                    '{:+.1f} s simulator'.format(r['wall_time'] - old['wall_time'])]))
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Simulate every station protocol and keep a history of the measures')
+    parser.add_argument('protocols', nargs = '*', help = 'default: every station of the repository')
+    parser.add_argument('-n', '--num_samples', nargs = '+', type = int, default = [8, 24, 48, 96])
+    parser.add_argument('-L', '--labware', default = labware_path)
+    parser.add_argument('--history', default = 'benchmark_history.json', help = 'JSON history file')
+    parser.add_argument('--timeout', type = int, default = 900, help = 'seconds per simulation')
+    args = parser.parse_args()
+
+    print('protocol', 'samples', 'simulator', 'commands', 'tips', 'robot', 'peak memory',
+          sep = '\t', file = sys.stderr)
+    entry = {'date': datetime.now().strftime('%Y/%m/%d %H:%M:%S'), 'commit': git_commit(),
+             'host': platform.node(), 'python': platform.python_version(),
+             'runs': run_benchmark(args.protocols or find_protocols(), args.num_samples,
+                                   args.labware, args.timeout)}
+    history = read_history(args.history)
+    if history:
+        print('Changes since ' + history[-1]['date'] + ' (' + history[-1]['commit'] + '):')
+        print('\n'.join(compare(history[-1], entry)) or 'None')
+    history.append(entry)
+    tmp = args.history + '.tmp'
+    with open(tmp, 'wt') as f:
+        json.dump(history, f, indent = 1)
+    os.replace(tmp, args.history)
+
+
+if __name__ == '__main__':
+    main()
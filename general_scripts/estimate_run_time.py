@@ -0,0 +1,343 @@
+#How to use
+#python3 estimate_run_time.py ../automation/KF_config/Station_KB_PlateFilling_pathogen_tec.py -n 8 24 48 96
+#
+# Offline estimation of the robot time of a station protocol. The protocol is
+# run on a simulated ProtocolContext, every published command (aspirate,
+# dispense, move_to, delay, blow_out, touch_tip, tips...) is recorded and a
+# kinematic cost model is applied to obtain the predicted time of each STEP.
+# The pauses of the run (tiprack swaps) are listed with their predicted time
+# from the start of the run.
+import argparse
+import json
+import math
+import os
+import re
+import sys
+
+base_path = os.path.dirname(os.path.abspath(__file__))
+labware_path = os.path.join(base_path, '..', 'labware_simulate')
+sys.path.append(os.path.join(base_path, '..', 'automation'))
+from bundle_runtime import bundle_runtime
+from pools import pool_positions, pool_sizes, assign_pools, robot_pools
+
+# Values used to fill the $placeholders of the automation templates
+default_values = {
+    '$technician': '\'estimate\'',
+    '$date': '\'estimate\'',
+    '$run_id': '\'estimate\'',
+    '$five_ml_rack': 'False',
+    '$racked_samples': 'False',
+    '$mmix_mode': '\'single\'',
+    '$pool_size': '4', # also the size of the $pools
+    '$log_level': '\'STEP\'', # only the step comments are needed
+}
+
+step_start = re.compile(r'^Step (\d+): (.*)$')
+
+
+class MotionModel:
+    '''
+    Kinematic cost model of the OT2. Speeds in mm/s, accelerations in mm/s2,
+    times in seconds.
+    '''
+    def __init__(self, speed_xy = 400, speed_z = 125, accel_xy = 800,
+                 accel_z = 300, arc_clearance = 10, same_labware_clearance = 1,
+                 pick_up_tip = 4.5, drop_tip = 4, home = 10, blow_out = 1,
+                 touch_tip = 2, touch_tip_radius = 3, plunger_overhead = 0.3):
+        self.speed_xy = speed_xy
+        self.speed_z = speed_z
+        self.accel_xy = accel_xy
+        self.accel_z = accel_z
+        self.arc_clearance = arc_clearance # above the highest labware of the deck
+        self.same_labware_clearance = same_labware_clearance # above the well top
+        self.pick_up_tip = pick_up_tip
+        self.drop_tip = drop_tip
+        self.home = home
+        self.blow_out = blow_out
+        self.touch_tip = touch_tip
+        self.touch_tip_radius = touch_tip_radius
+        self.plunger_overhead = plunger_overhead # plunger start/stop per action
+
+    def travel(self, distance, speed, accel):
+        '''
+        Time to travel [distance] with a trapezoidal speed profile
+        '''
+        distance = abs(distance)
+        if distance == 0:
+            return 0
+        if distance < speed**2 / accel:
+            return 2 * math.sqrt(distance / accel)
+        return distance / speed + speed / accel
+
+    def move(self, start, end, safe_z):
+        '''
+        Time of an arc move: up to safe_z, XY travel and down to the target.
+        start and end are (x, y, z) tuples, safe_z None means a direct move.
+        '''
+        dxy = math.hypot(end[0] - start[0], end[1] - start[1])
+        if safe_z is None:
+            return max(self.travel(dxy, self.speed_xy, self.accel_xy),
+                       self.travel(end[2] - start[2], self.speed_z, self.accel_z))
+        up = max(safe_z - start[2], 0)
+        down = max(safe_z - end[2], 0)
+        return (self.travel(up, self.speed_z, self.accel_z)
+                + self.travel(dxy, self.speed_xy, self.accel_xy)
+                + self.travel(down, self.speed_z, self.accel_z))
+
+    def plunger(self, volume, flow_rate):
+        '''
+        Time to aspirate or dispense [volume] at [flow_rate] ul/s
+        '''
+        if not volume or not flow_rate:
+            return self.plunger_overhead
+        return volume / flow_rate + self.plunger_overhead
+
+
+def render_protocol(data, num_samples, values = default_values):
+    '''
+    Fill the $placeholders of an automation template (as rep_data does in
+    input_file_tecnico_macs.py) and force NUM_SAMPLES in finished protocols
+    '''
+    data = bundle_runtime(data)
+    data = data.replace('$num_samples', str(num_samples))
+    if '$pools' in data:
+        # Samples in pools of $pool_size in the 24 tubes of the pool rack
+        wells = [row + str(col) for col in range(1, 7) for row in 'ABCD']
+        pools = assign_pools(list(range(num_samples)), pool_positions({w: w for w in wells}),
+                             pool_sizes(num_samples, int(values.get('$pool_size', '4'))))
+        data = data.replace('$pools', robot_pools(pools))
+    for key, value in values.items():
+        data = data.replace(key, value)
+    return re.sub(r'^NUM_SAMPLES = \d+', 'NUM_SAMPLES = ' + str(num_samples),
+                  data, flags = re.M)
+
+
+def load_labware_definitions(path = labware_path):
+    '''
+    Read the custom labware json files used by opentrons_simulate -L
+    '''
+    definitions = {}
+    for file in os.listdir(path):
+        if file.endswith('.json'):
+            with open(os.path.join(path, file)) as f:
+                definition = json.load(f)
+            definitions[definition['parameters']['loadName']] = definition
+    return definitions
+
+
+class CommandRecorder:
+    '''
+    Subscribes to the broker of a simulated ProtocolContext and stores the
+    published commands grouped by protocol STEP
+    '''
+    def __init__(self, ctx):
+        self.ctx = ctx
+        self.steps = {}
+        self.descriptions = {'setup': 'Labware load and setup',
+                             'other': 'Outside of the STEPS'}
+        self.pending = []
+
+    def __call__(self, message):
+        if message.get('$') != 'before':
+            return
+        name = message['name']
+        payload = message['payload']
+        if name == 'command.COMMENT':
+            self.comment(payload.get('text', ''))
+            return
+        self.pending.append((name, payload, self.safe_z()))
+
+    def comment(self, text):
+        match = step_start.match(text)
+        if match is None:
+            return
+        step = int(match.group(1))
+        description = match.group(2)
+        if ' took ' in description:
+            # Step finished: everything since the last step belongs to it
+            self.descriptions.setdefault(step, description.split(' took ')[0])
+            self.steps.setdefault(step, []).extend(self.pending)
+        else:
+            self.flush()
+            self.descriptions[step] = description
+            self.steps[step] = []
+        self.pending = []
+
+    def flush(self):
+        '''
+        Commands outside of a step go to setup (before the first step) or other
+        '''
+        if self.pending:
+            self.steps.setdefault('other' if self.steps else 'setup', []).extend(self.pending)
+        self.pending = []
+
+    def safe_z(self):
+        heights = [lw.highest_z for lw in self.ctx.loaded_labwares.values()]
+        return max(heights) if heights else 0
+
+
+def location_point(location):
+    '''
+    (x, y, z) and parent labware of a published location, well or Location
+    '''
+    if location is None:
+        return None, None
+    if hasattr(location, 'point'):
+        labware = location.labware
+        labware = getattr(labware, 'object', labware) # LabwareLike wrapper
+    else:
+        labware = location
+        location = location.top()
+    if hasattr(labware, 'parent') and not hasattr(labware, 'wells'):
+        labware = labware.parent # Well -> Labware
+    p = location.point
+    return (p.x, p.y, p.z), labware
+
+
+def estimate_commands(commands, model):
+    '''
+    Predicted seconds of a list of (name, payload, safe_z) commands, command
+    counts and (seconds, message) of the pauses
+    '''
+    seconds = 0
+    position = None
+    current_labware = None
+    counts = {}
+    pauses = []
+
+    def go_to(location, safe_z):
+        nonlocal position, current_labware
+        target, labware = location_point(location)
+        if target is None:
+            return 0
+        if position is None:
+            t = model.move((target[0], target[1], safe_z), target, None)
+        elif labware is not None and labware == current_labware: # wrappers of the same labware
+            t = model.move(position, target,
+                           max(position[2], target[2]) + model.same_labware_clearance
+                           if target[:2] != position[:2] else None)
+        else:
+            t = model.move(position, target, safe_z + model.arc_clearance)
+        position = target
+        current_labware = labware
+        return t
+
+    for name, payload, safe_z in commands:
+        key = name.replace('command.', '')
+        counts[key] = counts.get(key, 0) + 1
+        instrument = payload.get('instrument')
+        location = payload.get('location')
+        if key in ('ASPIRATE', 'DISPENSE'):
+            seconds += go_to(location, safe_z)
+            flow = getattr(instrument.flow_rate, key.lower()) * payload.get('rate', 1)
+            seconds += model.plunger(payload.get('volume'), flow)
+        elif key == 'MOVE_TO':
+            seconds += go_to(location, safe_z)
+        elif key == 'BLOW_OUT':
+            seconds += go_to(location, safe_z) + model.blow_out
+        elif key == 'TOUCH_TIP':
+            speed = payload.get('speed') or 60
+            seconds += model.touch_tip + 4 * model.touch_tip_radius / speed
+        elif key == 'PICK_UP_TIP':
+            seconds += go_to(location, safe_z) + model.pick_up_tip
+        elif key in ('DROP_TIP', 'RETURN_TIP'):
+            seconds += go_to(location, safe_z) + model.drop_tip
+        elif key == 'DELAY':
+            seconds += payload.get('minutes', 0) * 60 + payload.get('seconds', 0)
+        elif key == 'HOME':
+            seconds += model.home
+            position = None
+        elif key == 'PAUSE':
+            pauses.append((seconds, payload.get('userMessage') or payload.get('text')))
+    return seconds, counts, pauses
+
+
+def simulate_protocol(protocol_path, num_samples, definitions = None):
+    '''
+    Run the protocol for [num_samples] on a simulated ProtocolContext and
+    return the context and the CommandRecorder with its commands
+    '''
+    from opentrons import simulate
+    from opentrons.commands import types as command_types
+    if definitions is None:
+        definitions = load_labware_definitions()
+    with open(protocol_path, 'rt') as f:
+        data = render_protocol(f.read(), num_samples)
+    namespace = {'__name__': 'protocol', '__file__': protocol_path}
+    exec(compile(data, protocol_path, 'exec'), namespace)
+    api_level = namespace.get('metadata', {}).get('apiLevel', '2.0')
+    ctx = simulate.get_protocol_api(api_level, extra_labware = definitions)
+    recorder = CommandRecorder(ctx)
+    unsubscribe = ctx.broker.subscribe(command_types.COMMAND, recorder)
+    try:
+        namespace['run'](ctx)
+    except ImportError as e:
+        # Robot only drivers (gpio lights at the end of the run) are not
+        # available off the robot, the STEPS are already recorded
+        print('Warning: ' + str(e), file = sys.stderr)
+    finally:
+        unsubscribe()
+    recorder.flush()
+    return ctx, recorder
+
+
+def estimate(protocol_path, num_samples, model = None, definitions = None):
+    '''
+    Simulate the protocol for [num_samples] and return a dictionary with the
+    predicted time (seconds), description, command counts and pauses of each
+    STEP
+    '''
+    model = model or MotionModel()
+    ctx, recorder = simulate_protocol(protocol_path, num_samples, definitions)
+    result = {}
+    for step, commands in recorder.steps.items():
+        seconds, counts, pauses = estimate_commands(commands, model)
+        result[step] = {'description': recorder.descriptions.get(step, ''),
+                        'seconds': seconds, 'commands': counts,
+                        'pauses': pauses}
+    return result
+
+
+def format_seconds(seconds):
+    return '{:d}:{:02d}:{:02d}'.format(int(seconds // 3600),
+                                       int(seconds % 3600 // 60),
+                                       int(seconds % 60))
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Predict the robot time of each STEP of a protocol')
+    parser.add_argument('protocols', nargs = '+')
+    parser.add_argument('-n', '--num_samples', nargs = '+', type = int, default = [96])
+    parser.add_argument('-L', '--labware', default = labware_path)
+    parser.add_argument('--json', action = 'store_true', help = 'print the results as json')
+    args = parser.parse_args()
+
+    definitions = load_labware_definitions(args.labware)
+    results = {}
+    for protocol in args.protocols:
+        for n in args.num_samples:
+            try:
+                steps = estimate(protocol, n, definitions = definitions)
+            except ValueError as e:
+                # e.g. the Panther pools of n samples would leave one alone
+                print('### ' + os.path.basename(protocol) + ' - ' + str(n)
+                      + ' samples not simulated: ' + str(e), file = sys.stderr)
+                results[os.path.basename(protocol) + ':' + str(n)] = {'error': str(e)}
+                continue
+            results[os.path.basename(protocol) + ':' + str(n)] = steps
+            if args.json:
+                continue
+            print('### ' + os.path.basename(protocol) + ' - ' + str(n) + ' samples')
+            total = 0
+            for step, values in steps.items():
+                for seconds, message in values['pauses']:
+                    print('Pause', ' '.join(message.split()), format_seconds(total + seconds), sep = '\t')
+                total += values['seconds']
+                print(str(step), values['description'], format_seconds(values['seconds']), sep = '\t')
+            print('Total', '', format_seconds(total), sep = '\t')
+    if args.json:
+        print(json.dumps(results, indent = 2, default = str))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+#How to use
+#python3 optimize_deck_layout.py ../automation/KF_config/Station_KB_PlateFilling_pathogen_tec.py -n 96 -o Station_KB_PlateFilling_optimized.py
+#
+# Deck layout of a station by traffic. The protocol is simulated as in
+# estimate_run_time.py, every move of the gantry between two labware is
+# counted and the slots of the labware loaded with a fixed slot in the
+# template are permuted to minimize the XY travel time of those moves.
+# Modules, the trash and the tipracks loaded in free slots stay where they
+# are. The recommended slot map is printed and, with -o, written into a copy
+# of the template.
+import argparse
+import itertools
+import math
+import random
+import re
+
+from estimate_run_time import (MotionModel, simulate_protocol, location_point,
+                               load_labware_definitions, labware_path)
+
+slot_literal = re.compile(r"'(\d{1,2})'")
+# Slots of the template: arguments of load_labware/load_module calls and the
+# slot lists of the comprehensions
+load_call = re.compile(r"load_(?:labware|module)\((?:[^()]|\([^()]*\))*\)")
+slot_loop = re.compile(r"slot in .*")
+deck_slots = [str(slot) for slot in range(1, 12)] # 12 is the fixed trash
+
+
+def template_slots(data):
+    slots = set()
+    for pattern in (load_call, slot_loop):
+        for match in pattern.finditer(data):
+            slots.update(slot_literal.findall(match.group(0)))
+    return slots
+
+
+def patch_slots(data, mapping):
+    '''
+    Template with the slots of the load calls changed as in [mapping]
+    ({old slot: new slot}, all the slots are replaced at once)
+    '''
+    def replace(match):
+        return slot_literal.sub(lambda m: "'" + mapping.get(m.group(1), m.group(1)) + "'",
+                                match.group(0))
+    return slot_loop.sub(replace, load_call.sub(replace, data))
+
+
+def slot_of(labware):
+    parent = labware.parent
+    while not isinstance(parent, str):
+        parent = parent.parent # labware on a module
+    return parent
+
+
+def traffic(recorder):
+    '''
+    {(slot a, slot b): moves} of the gantry between labware of different
+    slots, in the order the commands were published in each STEP
+    '''
+    moves = {}
+    for commands in recorder.steps.values():
+        previous = None
+        for name, payload, safe_z in commands:
+            point, labware = location_point(payload.get('location'))
+            if labware is None:
+                continue
+            slot = slot_of(labware)
+            if previous is not None and slot != previous:
+                pair = tuple(sorted((previous, slot)))
+                moves[pair] = moves.get(pair, 0) + 1
+            previous = slot
+    return moves
+
+
+class LayoutCost:
+    '''
+    XY travel time (s) of the traffic for a layout {labware slot: new slot}
+    '''
+    def __init__(self, ctx, moves, model):
+        centers = {}
+        for slot in deck_slots + ['12']:
+            p = ctx.deck.position_for(slot).point
+            centers[slot] = (p.x + 64, p.y + 43) # slot footprint 128 x 86 mm
+        self.time = {}
+        for a, b in itertools.product(centers, repeat = 2):
+            distance = math.hypot(centers[a][0] - centers[b][0], centers[a][1] - centers[b][1])
+            self.time[a, b] = model.travel(distance, model.speed_xy, model.accel_xy)
+        self.moves = moves
+
+    def __call__(self, layout):
+        return sum(n * self.time[layout.get(a, a), layout.get(b, b)]
+                   for (a, b), n in self.moves.items())
+
+
+def search(cost, movable, candidates, restarts = 50, seed = 0, penalty = 0.1):
+    '''
+    Best layout {slot: new slot} of the [movable] slots among the [candidates]
+    slots: hill climbing with pairwise swaps from the current layout and from
+    [restarts] random ones. Each moved labware costs [penalty] seconds, so
+    the layout changes only where it saves time.
+    '''
+    def total(layout):
+        return cost(layout) + penalty * sum(1 for slot in layout if layout[slot] != slot)
+
+    rng = random.Random(seed)
+    best = {slot: slot for slot in movable}
+    best_cost = total(best)
+    starts = [list(movable)]
+    for _ in range(restarts):
+        starts.append(rng.sample(candidates, len(movable)))
+    for start in starts:
+        layout = dict(zip(movable, start))
+        current = total(layout)
+        improved = True
+        while improved:
+            improved = False
+            for slot, other in itertools.product(movable, candidates):
+                trial = dict(layout)
+                owner = [s for s in movable if layout[s] == other]
+                if owner:
+                    trial[owner[0]] = layout[slot]
+                trial[slot] = other
+                value = total(trial)
+                if value < current - 1e-9:
+                    layout, current, improved = trial, value, True
+        if current < best_cost - 1e-9:
+            best, best_cost = layout, current
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Recommend the slots of the labware of a protocol by traffic')
+    parser.add_argument('protocol')
+    parser.add_argument('-n', '--num_samples', type = int, default = 96)
+    parser.add_argument('-L', '--labware', default = labware_path)
+    parser.add_argument('-o', '--output', help = 'write the template with the new slots')
+    parser.add_argument('--restarts', type = int, default = 50)
+    args = parser.parse_args()
+
+    with open(args.protocol, 'rt') as f:
+        data = f.read()
+    ctx, recorder = simulate_protocol(args.protocol, args.num_samples,
+                                      load_labware_definitions(args.labware))
+    moves = traffic(recorder)
+    cost = LayoutCost(ctx, moves, MotionModel())
+    labels = {}
+    for slot, labware in ctx.loaded_labwares.items():
+        labels[str(slot)] = labware.name
+    fixed = set(str(slot) for slot in ctx.deck if ctx.deck[slot] is not None) - template_slots(data)
+    fixed.update(str(slot) for slot in ctx.loaded_modules)
+    movable = sorted((set(labels) & template_slots(data)) - fixed, key = int)
+    candidates = [slot for slot in deck_slots if slot not in fixed]
+    layout = search(cost, movable, candidates, args.restarts)
+
+    print('Moves between slots:')
+    for (a, b), n in sorted(moves.items(), key = lambda item: -item[1]):
+        print(a, b, n, sep = '\t')
+    print('Slot map:')
+    for slot in movable:
+        print(slot, '->', layout[slot], labels.get(slot, ''), sep = '\t')
+    current = cost({})
+    print('XY travel: {:.0f} s -> {:.0f} s ({:.0f} s less)'.format(current, cost(layout),
+                                                                  current - cost(layout)))
+    if args.output:
+        with open(args.output, 'wt') as f:
+            f.write(patch_slots(data, layout))
+
+
+if __name__ == '__main__':
+    main()
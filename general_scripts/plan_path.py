@@ -0,0 +1,164 @@
+#How to use
+#python3 plan_path.py ../automation/KF_config/Station_KB_sample-prep_pathogen_tec.py -n 96
+#
+# Order of the independent moves of a STEP that shortens the gantry travel
+# between them: nearest neighbour and 2-opt over the deck coordinates. The
+# protocol is simulated as in estimate_run_time.py, the moves of each STEP
+# (aspirations and the dispenses that follow them) are taken in the order of
+# the run and the travel from the destination of each move to the source of
+# the next one is compared with the planned order. It pays off for moves
+# that share a tip; when every move takes a fresh tip, the trips to the trash
+# and the tiprack take most of the travel and the order hardly changes.
+#
+# No station uses the planned order yet; plan_path() can be copied into
+# functions/runtime.py for the STEP that needs it.
+import argparse
+import math
+
+from estimate_run_time import (simulate_protocol, location_point,
+                               load_labware_definitions, labware_path)
+
+
+def travel_cost(a, b):
+    '''
+    Gantry travel (mm) between two points: XY distance plus the Z change
+    '''
+    return math.hypot(a[0] - b[0], a[1] - b[1]) + abs(a[2] - b[2])
+
+
+def point_of(well):
+    # (x, y, z) of the top of a well, points are used as they are
+    return well if isinstance(well, tuple) else tuple(well.top().point)
+
+
+def plan_path(moves, ranks = None, via = None, passes = 20):
+    '''
+    Order of the (source, dest) [moves] of a STEP that shortens the travel
+    from the destination of each move to the source of the next one:
+    nearest neighbour and 2-opt over the deck coordinates of the wells
+    (or (x, y, z) points).
+    ranks: ordering constraints, moves of a lower rank go first (e.g. MS2
+    before beads) and only moves of the same rank are reordered.
+    via: wells visited between two moves, e.g. the trash and the tiprack
+    when every move takes a fresh tip.
+    Returns the list of indices of the moves.
+    '''
+    if ranks is None:
+        ranks = [0] * len(moves)
+    sources = [point_of(s) for s, d in moves]
+    dests = [point_of(d) for s, d in moves]
+    stops = [point_of(w) for w in via or []]
+    # cost[i][j]: from the destination of move i to the source of move j
+    cost = []
+    for a in dests:
+        detour = sum(travel_cost(p, q) for p, q in zip([a] + stops, stops))
+        start = stops[-1] if stops else a
+        cost.append([detour + travel_cost(start, b) for b in sources])
+    order = []
+    for rank in sorted(set(ranks)):
+        group = [i for i, r in enumerate(ranks) if r == rank]
+        # Nearest neighbour from the end of the previous group
+        path = []
+        left = set(group)
+        current = order[-1] if order else None
+        while left:
+            if current is None:
+                current = group[0]
+            else:
+                current = min(left, key = lambda j: (cost[current][j], j))
+            path.append(current)
+            left.discard(current)
+        order.extend(two_opt(path, cost, order[-1] if order else None, passes))
+    return order
+
+
+def two_opt(path, cost, previous = None, passes = 20):
+    '''
+    Reverse segments of [path] while the total cost decreases. The cost is
+    not symmetric, so a reversed segment is costed in its new direction.
+    previous: move done before the path, if any
+    '''
+    def prefix_sums(path):
+        # Forward and backward costs of the path up to each move
+        forward = [0]
+        backward = [0]
+        for a, b in zip(path, path[1:]):
+            forward.append(forward[-1] + cost[a][b])
+            backward.append(backward[-1] + cost[b][a])
+        return forward, backward
+
+    path = list(path)
+    n = len(path)
+    for _ in range(passes):
+        improved = False
+        forward, backward = prefix_sums(path)
+        for i in range(n - 1):
+            before = path[i - 1] if i > 0 else previous
+            for j in range(i + 1, n):
+                old = forward[j] - forward[i]
+                new = backward[j] - backward[i]
+                if before is not None:
+                    old += cost[before][path[i]]
+                    new += cost[before][path[j]]
+                if j < n - 1:
+                    old += cost[path[j]][path[j + 1]]
+                    new += cost[path[i]][path[j + 1]]
+                if new < old - 1e-6:
+                    path[i:j + 1] = path[i:j + 1][::-1]
+                    forward, backward = prefix_sums(path)
+                    improved = True
+        if not improved:
+            break
+    return path
+
+
+def step_moves(commands):
+    '''
+    (source, dest) points of the moves of a STEP: the first aspiration and
+    the last dispense of each aspirate ... dispense sequence
+    '''
+    moves = []
+    source = dest = None
+    for name, payload, safe_z in commands:
+        key = name.replace('command.', '')
+        if key not in ('ASPIRATE', 'DISPENSE'):
+            continue
+        point = location_point(payload.get('location'))[0]
+        if point is None:
+            continue
+        if key == 'ASPIRATE' and dest is not None:
+            moves.append((source, dest))
+            source = dest = None
+        if key == 'ASPIRATE' and source is None:
+            source = point
+        elif key == 'DISPENSE':
+            dest = point
+    if source is not None and dest is not None:
+        moves.append((source, dest))
+    return moves
+
+
+def path_travel(moves, order):
+    return sum(travel_cost(moves[i][1], moves[j][0]) for i, j in zip(order, order[1:]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Travel between the moves of each STEP, as run and planned')
+    parser.add_argument('protocol')
+    parser.add_argument('-n', '--num_samples', type = int, default = 96)
+    parser.add_argument('-L', '--labware', default = labware_path)
+    args = parser.parse_args()
+
+    ctx, recorder = simulate_protocol(args.protocol, args.num_samples,
+                                      load_labware_definitions(args.labware))
+    print('STEP', 'moves', 'travel (mm)', 'planned (mm)', sep = '\t')
+    for step, commands in recorder.steps.items():
+        moves = step_moves(commands)
+        if len(moves) < 2:
+            continue
+        print(step, len(moves), '{:.0f}'.format(path_travel(moves, range(len(moves)))),
+              '{:.0f}'.format(path_travel(moves, plan_path(moves))), sep = '\t')
+
+
+if __name__ == '__main__':
+    main()
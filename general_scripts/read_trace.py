@@ -0,0 +1,73 @@
+#How to use
+#python3 read_trace.py KB_PlateFilling_viral_path2_trace.bin [-o trace.tsv]
+#
+# Reads the trace of a run (written by the stations with TRACE = True, see
+# the Tracer of functions/runtime.py) and prints the time of each operation
+# per STEP: number of calls, total, mean and maximum duration. With -o every
+# record is written to a tsv file.
+import argparse
+import struct
+
+record = struct.Struct('<dfBBHHfHH') # Tracer.record
+operations = ['pick_up', 'transfer', 'mix', 'distribute', 'multi_dispense']
+
+
+def well_name(well_id):
+    '''
+    Slot and well of a traced well id: (slot << 9) | (row << 5) | column
+    '''
+    if well_id == 0xFFFF:
+        return ''
+    return '{}:{}{}'.format(well_id >> 9, chr(ord('A') + (well_id >> 5 & 0xF)), well_id & 0x1F)
+
+
+def read_trace(path):
+    '''
+    Records of a trace file as dicts, in the order they were added
+    '''
+    with open(path, 'rb') as f:
+        data = f.read()
+    records = []
+    for fields in record.iter_unpack(data[:len(data) - len(data) % record.size]):
+        start, duration, operation, channels, max_volume, step, volume, source, dest = fields
+        records.append({'start': start, 'duration': duration, 'operation': operations[operation],
+                        'pipette': 'P{}{}'.format(max_volume, ' multi' if channels > 1 else ''),
+                        'step': step, 'volume': volume,
+                        'source': well_name(source), 'dest': well_name(dest)})
+    return records
+
+
+def summary(records):
+    '''
+    {(step, operation): [calls, total seconds, max seconds]}
+    '''
+    totals = {}
+    for r in records:
+        total = totals.setdefault((r['step'], r['operation']), [0, 0, 0])
+        total[0] += 1
+        total[1] += r['duration']
+        total[2] = max(total[2], r['duration'])
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Summary of the trace of a station run')
+    parser.add_argument('trace')
+    parser.add_argument('-o', '--output', help = 'write every record to this tsv file')
+    args = parser.parse_args()
+
+    records = read_trace(args.trace)
+    if args.output:
+        columns = ['start', 'duration', 'operation', 'pipette', 'step', 'volume', 'source', 'dest']
+        with open(args.output, 'wt') as f:
+            f.write('\t'.join(columns) + '\n')
+            for r in records:
+                f.write('\t'.join(format(r[c]) for c in columns) + '\n')
+    print('STEP', 'operation', 'calls', 'total (s)', 'mean (s)', 'max (s)', sep = '\t')
+    for (step, operation), (calls, total, longest) in sorted(summary(records).items()):
+        print(step, operation, calls, '{:.1f}'.format(total), '{:.2f}'.format(total / calls),
+              '{:.2f}'.format(longest), sep = '\t')
+
+
+if __name__ == '__main__':
+    main()